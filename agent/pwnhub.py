@@ -11,21 +11,45 @@ Add the following section to /etc/pwnagotchi/config.toml:
     hub_url = "http://10.67.0.1:5000"
     auth_token = ""
     heartbeat_interval = 300
+    heartbeat_jitter = 0.2
+    heartbeat_max_interval = 3600
     push_handshakes = true
     upload_method = "http"
     handshake_path = "~/handshakes"
     agent_id_file = "~/.pwnhub_agent_state.json"
+    upload_chunk_size = 262144
+    upload_queue_file = "~/.pwnhub_upload_queue.db"
+    upload_queue_max = 500
+    retry_base_delay = 30
+    retry_max_delay = 3600
+    upload_workers = 2
+    upload_rate_limit = 0
+    watch_poll_interval = 30
+    reconcile_interval = 0
+    upload_compression = "auto"
     log_level = "INFO"
 
 CONFIGURATION OPTIONS:
     enabled (bool): Enable or disable the plugin (default: true)
     hub_url (str): URL of the PwnHub server API (default: "http://10.67.0.1:5000")
     auth_token (str): Authentication token for hub communication (default: "", not enforced yet)
-    heartbeat_interval (int): Seconds between heartbeat messages (default: 300)
+    heartbeat_interval (int): Seconds between heartbeat messages; the hub may suggest another (default: 300)
+    heartbeat_jitter (float): Each wait is randomly lengthened or shortened by up to this fraction (default: 0.2)
+    heartbeat_max_interval (int): Longest wait between heartbeats while backing off from hub errors (default: 3600)
     push_handshakes (bool): Automatically upload captured handshakes (default: true)
     upload_method (str): Method for uploads - "http" or "ssh" (default: "http")
     handshake_path (str): Local path to handshake files (default: "~/handshakes")
     agent_id_file (str): Path to agent state file for tracking device identity (default: "~/.pwnhub_agent_state.json")
+    upload_chunk_size (int): Files larger than this are sent in resumable chunks of this many bytes; 0 always sends in one request (default: 262144)
+    upload_queue_file (str): SQLite file holding the upload queue, kept across reboots (default: "~/.pwnhub_upload_queue.db")
+    upload_queue_max (int): Most files waiting in the upload queue; more are picked up by a rescan once it drains (default: 500)
+    retry_base_delay (int): Seconds before the first retry of a failed upload, doubled per failure with jitter (default: 30)
+    retry_max_delay (int): Longest wait between retries of one upload (default: 3600)
+    upload_workers (int): Uploads sent at the same time when draining the queue (default: 2)
+    upload_rate_limit (int): Cap on upload bandwidth in KiB/s shared by all workers; 0 for no cap (default: 0)
+    watch_poll_interval (int): Seconds between checks of handshake_path when inotify is unavailable, at least 1 (default: 30)
+    reconcile_interval (int): Seconds between full rescans of handshake_path; 0 rescans only at startup (default: 0)
+    upload_compression (str): Compress upload bodies - "auto" (zstd if both sides have it, else gzip), "gzip", "zstd" or "none" (default: "auto")
     log_level (str): Logging level - DEBUG, INFO, WARNING, ERROR (default: "INFO")
 
 INSTALLATION:
@@ -36,23 +60,407 @@ INSTALLATION:
 
 FEATURES:
 - Automatic device registration with hub
-- Periodic heartbeat messages
-- Automatic handshake file upload
-- Retry failed uploads when internet becomes available
+- Periodic heartbeat messages, jittered and backing off when the hub is busy or failing
+- Automatic handshake file upload, with new captures picked up by inotify (polling where unavailable)
+- Persistent upload queue: each capture is sent once, failed uploads are retried with backoff
+- Resumable chunked uploads for large captures over flaky links
+- Compressed uploads, and no upload at all for content the hub already has
 - Device identity tracking (CPU serial, machine-id, SSH fingerprint)
 - Image generation detection (tracks when device is re-imaged on same hardware)
 """
 
+import ctypes
+import ctypes.util
+import email.utils
+import errno
+import gzip
+import hashlib
 import logging
+import os
+import random
+import select
+import struct
 import requests
 import json
+import sqlite3
 import time
 import threading
 import subprocess
 import socket
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 import pwnagotchi.plugins as plugins
 
+try:
+    import zstandard
+except ImportError:  # optional; upload_compression falls back to gzip
+    zstandard = None
+
+HANDSHAKE_EXTENSIONS = ('.cap', '.pcap', '.hccapx')
+
+
+class UploadQueue:
+    """Captures waiting to be uploaded, in a small SQLite file that survives reboots.
+
+    A file is queued once per path (re-queuing an unchanged path is a
+    no-op) and its sha256 is recorded, so content that was already sent,
+    or is queued under another name, is only uploaded once.
+    Failed uploads are retried after an exponentially growing, jittered
+    delay. At most max_items files wait at once; files that don't fit
+    stay on disk and are queued by a later scan. After close() the queue
+    reads as empty and changes are dropped, so a late caller can't crash.
+    """
+
+    # sha256s of sent captures remembered for dedup
+    MAX_UPLOADED = 10000
+
+    def __init__(self, path, max_items=500, base_delay=30, max_delay=3600):
+        self.path = Path(path).expanduser()
+        self.max_items = max_items
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Used from the background thread and pwnagotchi's callbacks, under self.lock
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS queue (
+                path TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                added_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_queue_next ON queue (next_attempt)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS uploaded (
+                sha256 TEXT PRIMARY KEY,
+                uploaded_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        """Close the database; calling it again does nothing."""
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def add(self, file_path, sha256_func):
+        """Queue file_path; returns False if the queue is full.
+
+        sha256_func(file_path) is only called for new or changed files.
+        """
+        stat = file_path.stat()
+        key = str(file_path)
+        with self.lock:
+            if self.conn is None:
+                return False
+            row = self.conn.execute("SELECT size, mtime FROM queue WHERE path = ?", (key,)).fetchone()
+            if row == (stat.st_size, int(stat.st_mtime)):
+                return True
+            if row is None:
+                count = self.conn.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+                if count >= self.max_items:
+                    return False
+        # Hash outside the lock; captures are small but a Pi Zero is slow
+        sha256 = sha256_func(file_path)
+        with self.lock:
+            if self.conn is None:
+                return False
+            self.conn.execute("""
+                INSERT INTO queue (path, sha256, size, mtime, added_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    sha256 = excluded.sha256, size = excluded.size, mtime = excluded.mtime,
+                    attempts = 0, next_attempt = 0, last_error = NULL
+            """, (key, sha256, stat.st_size, int(stat.st_mtime), time.time()))
+            self.conn.commit()
+        return True
+
+    def due(self):
+        """(path, sha256, attempts, size) of every upload that is due, oldest first.
+
+        A copy of content queued earlier under another path waits for that
+        one, so it is skipped rather than sent twice.
+        """
+        with self.lock:
+            if self.conn is None:
+                return []
+            return self.conn.execute("""
+                SELECT q.path, q.sha256, q.attempts, q.size FROM queue q
+                WHERE q.next_attempt <= ? AND NOT EXISTS (
+                    SELECT 1 FROM queue e WHERE e.sha256 = q.sha256
+                    AND (e.added_at < q.added_at OR (e.added_at = q.added_at AND e.path < q.path))
+                )
+                ORDER BY q.next_attempt, q.added_at
+            """, (time.time(),)).fetchall()
+
+    def is_sent(self, sha256):
+        """True if content with this sha256 was uploaded before."""
+        with self.lock:
+            if self.conn is None:
+                return False
+            return self.conn.execute("SELECT 1 FROM uploaded WHERE sha256 = ?", (sha256,)).fetchone() is not None
+
+    def done(self, path, sha256=None):
+        """Remove path from the queue, remembering sha256 as uploaded."""
+        with self.lock:
+            if self.conn is None:
+                return
+            self.conn.execute("DELETE FROM queue WHERE path = ?", (path,))
+            if sha256:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO uploaded (sha256, uploaded_at) VALUES (?, ?)",
+                    (sha256, time.time())
+                )
+                self.conn.execute(
+                    "DELETE FROM uploaded WHERE sha256 NOT IN "
+                    "(SELECT sha256 FROM uploaded ORDER BY uploaded_at DESC LIMIT ?)",
+                    (self.MAX_UPLOADED,)
+                )
+            self.conn.commit()
+
+    def failed(self, path, attempts, error):
+        """Schedule a retry after base_delay * 2^attempts (capped), less up to half for jitter."""
+        delay = min(self.max_delay, self.base_delay * (2 ** attempts))
+        delay = random.uniform(delay / 2, delay)
+        with self.lock:
+            if self.conn is None:
+                return delay
+            self.conn.execute(
+                "UPDATE queue SET attempts = attempts + 1, next_attempt = ?, last_error = ? WHERE path = ?",
+                (time.time() + delay, str(error)[:500], path)
+            )
+            self.conn.commit()
+        return delay
+
+    def count(self):
+        with self.lock:
+            if self.conn is None:
+                return 0
+            return self.conn.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+
+class RateLimiter:
+    """Token bucket shared by the upload workers; rate is in bytes per second, 0 for no limit."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.allowance = rate
+        self.checked = time.monotonic()
+
+    def consume(self, size):
+        """Block until size bytes may be sent."""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # Allow at most a second's worth of burst after an idle spell
+            self.allowance = min(self.rate, self.allowance + (now - self.checked) * self.rate)
+            self.checked = now
+            self.allowance -= size
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HandshakeWatcher:
+    """Tracks the capture files in a directory without rescanning it.
+
+    Uses inotify (through ctypes, so no extra packages are needed) and
+    falls back to polling the directory's mtime, rescanning only when it
+    changes, where inotify isn't available. The set of capture names is
+    kept in memory for heartbeats; on_new(path) is called for each file
+    that is finished being written. A full scan happens at start, on
+    reconcile(), and when inotify loses events.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                  | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct('iIII')
+    # Polling can't see a close, so a new file must be this old before it's reported
+    SETTLE_SECONDS = 2
+
+    def __init__(self, path, extensions, on_new, poll_interval=30, logger=None):
+        self.path = Path(path).expanduser()
+        self.extensions = set(extensions)
+        self.on_new = on_new
+        # Never below 1s: 0 would rescan handshake_path in a tight loop
+        self.poll_interval = max(1, int(poll_interval))
+        self.logger = logger or logging.getLogger('PwnHub')
+        self.files = set()
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.fd = None
+        self.dir_mtime = None
+        # Polling: new names still being written
+        self.settling = set()
+
+    @property
+    def count(self):
+        with self.lock:
+            return len(self.files)
+
+    @property
+    def mode(self):
+        return 'inotify' if self.fd is not None else 'polling'
+
+    def start(self):
+        self.running = True
+        self.fd = self.open_inotify()
+        self.reconcile()
+        self.thread = threading.Thread(target=self.run, name='pwnhub-watcher', daemon=True)
+        self.thread.start()
+        self.logger.info(f"Watching {self.path} ({self.mode}), {self.count} captures")
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.close_inotify()
+
+    def is_capture(self, name):
+        return Path(name).suffix.lower() in self.extensions
+
+    def scan(self):
+        """Names of the captures in the directory; scandir's d_type saves a stat per file."""
+        try:
+            with os.scandir(self.path) as entries:
+                return {entry.name for entry in entries if entry.is_file() and self.is_capture(entry.name)}
+        except FileNotFoundError:
+            return set()
+
+    def reconcile(self):
+        """Rescan the directory and report every capture in it to on_new."""
+        try:
+            self.dir_mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            self.dir_mtime = None
+        names = self.scan()
+        with self.lock:
+            self.files = names
+        for name in sorted(names):
+            self.on_new(self.path / name)
+        return len(names)
+
+    def open_inotify(self):
+        """An inotify fd watching the directory, or None to poll instead."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if libc.inotify_add_watch(fd, str(self.path).encode(), self.WATCH_MASK) < 0:
+                err = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(err, os.strerror(err))
+            return fd
+        except (OSError, AttributeError) as e:
+            self.logger.info(f"inotify unavailable for {self.path} ({e}), polling every {self.poll_interval}s")
+            return None
+
+    def close_inotify(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def run(self):
+        while self.running:
+            try:
+                if self.fd is not None:
+                    self.read_events()
+                else:
+                    self.poll()
+            except Exception as e:
+                self.logger.error(f"Error watching {self.path}: {e}")
+                time.sleep(5)
+
+    def read_events(self):
+        readable, _, _ = select.select([self.fd], [], [], 1.0)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+            offset += length
+            if mask & (self.IN_Q_OVERFLOW | self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                # Events were lost, or the directory went away: start over
+                self.logger.info(f"Lost track of {self.path}, rescanning")
+                self.close_inotify()
+                self.fd = self.open_inotify()
+                self.reconcile()
+                return
+            if mask & self.IN_ISDIR or not self.is_capture(name):
+                continue
+            if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                with self.lock:
+                    self.files.discard(name)
+            elif mask & (self.IN_CREATE | self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                with self.lock:
+                    self.files.add(name)
+                # IN_CREATE only counts it; the file may still be being written
+                if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    self.on_new(self.path / name)
+
+    def poll(self):
+        for _ in range(self.poll_interval):
+            if not self.running:
+                return
+            time.sleep(1)
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.dir_mtime and not self.settling:
+            return
+        if self.dir_mtime is None and mtime is not None:
+            # The directory appeared; inotify may work now
+            self.fd = self.open_inotify()
+        self.dir_mtime = mtime
+        names = self.scan()
+        with self.lock:
+            added = (names - self.files) | (self.settling & names)
+            self.files = names
+        self.settling = set()
+        now = time.time()
+        for name in sorted(added):
+            try:
+                if now - (self.path / name).stat().st_mtime < self.SETTLE_SECONDS:
+                    self.settling.add(name)
+                    continue
+            except FileNotFoundError:
+                continue
+            self.on_new(self.path / name)
+
 
 class PwnHub(plugins.Plugin):
     __author__ = 'PwnHub Team'
@@ -69,10 +477,22 @@ class PwnHub(plugins.Plugin):
             'hub_url': 'http://10.67.0.1:5000',
             'auth_token': '',
             'heartbeat_interval': 300,
+            'heartbeat_jitter': 0.2,
+            'heartbeat_max_interval': 3600,
             'push_handshakes': True,
             'upload_method': 'http',
             'handshake_path': '~/handshakes',
             'agent_id_file': '~/.pwnhub_agent_state.json',
+            'upload_chunk_size': 262144,
+            'upload_queue_file': '~/.pwnhub_upload_queue.db',
+            'upload_queue_max': 500,
+            'retry_base_delay': 30,
+            'retry_max_delay': 3600,
+            'upload_workers': 2,
+            'upload_rate_limit': 0,
+            'watch_poll_interval': 30,
+            'reconcile_interval': 0,
+            'upload_compression': 'auto',
             'log_level': 'INFO'
         }
         self.device_serial = None
@@ -82,12 +502,34 @@ class PwnHub(plugins.Plugin):
         self.image_gen = 0
         self.state_file = None
         self.state = {}
+        # Re-entrant: upload state is changed and saved under it
+        self.state_lock = threading.RLock()
         self.background_thread = None
         self.running = False
         self.logger = logging.getLogger('PwnHub')
         self.agent = None  # Store agent reference
         self.last_registration_attempt = 0
-        self.pending_handshakes = []  # Track failed uploads to retry
+        self.upload_queue = None
+        self.session = None
+        self.rate_limiter = RateLimiter(0)
+        # Upload encodings the hub accepts, as of its last /check reply
+        self.hub_encodings = ()
+        self.stats_lock = threading.Lock()
+        # Upload body bytes sent, after compression
+        self.bytes_sent = 0
+        # Held by whichever thread is draining the upload queue
+        self.upload_lock = threading.Lock()
+        self.watcher = None
+        # Set by the watcher to drain the queue without waiting for the next heartbeat
+        self.upload_wakeup = threading.Event()
+        # A capture was refused by a full queue and needs a rescan to be found again
+        self.queue_refused = False
+        self.last_reconcile = 0
+        # Heartbeat schedule: consecutive failures, the hub's suggested
+        # interval and a Retry-After from its last reply
+        self.heartbeat_failures = 0
+        self.hub_heartbeat_interval = None
+        self.heartbeat_retry_after = None
 
     def on_loaded(self):
         """Called when plugin is loaded."""
@@ -127,6 +569,31 @@ class PwnHub(plugins.Plugin):
         # Save updated state
         self.save_state()
         
+        # Open the persistent upload queue
+        try:
+            self.upload_queue = UploadQueue(
+                self.options.get('upload_queue_file', '~/.pwnhub_upload_queue.db'),
+                max_items=int(self.options.get('upload_queue_max', 500)),
+                base_delay=float(self.options.get('retry_base_delay', 30)),
+                max_delay=float(self.options.get('retry_max_delay', 3600))
+            )
+            self.logger.info(f"Upload queue: {self.upload_queue.count()} files waiting")
+        except Exception as e:
+            self.logger.error(f"Error opening upload queue: {e}")
+            return
+        
+        self.session = self.create_session()
+        self.rate_limiter = RateLimiter(int(self.options.get('upload_rate_limit', 0)) * 1024)
+        
+        # Started by the background thread, whose first full scan it does
+        self.watcher = HandshakeWatcher(
+            self.options.get('handshake_path', '~/handshakes'),
+            HANDSHAKE_EXTENSIONS,
+            self.on_new_capture,
+            poll_interval=int(self.options.get('watch_poll_interval', 30)),
+            logger=self.logger
+        )
+        
         # Start background thread
         self.running = True
         self.background_thread = threading.Thread(target=self._background_loop, daemon=True)
@@ -141,10 +608,43 @@ class PwnHub(plugins.Plugin):
     def on_unload(self, ui):
         """Called when plugin is unloaded."""
         self.running = False
+        if self.watcher:
+            self.watcher.stop()
         if self.background_thread:
             self.background_thread.join(timeout=5)
+        if self.background_thread and self.background_thread.is_alive():
+            # Uploads can outlast the join (a big file on a slow link); the
+            # thread closes the queue and session itself once they finish
+            self.logger.info("Uploads still in progress, closing the upload queue when they finish")
+        else:
+            self.close_resources()
         self.logger.info("Plugin unloaded")
 
+    def close_resources(self):
+        """Close the upload queue and HTTP session once nothing uses them; safe to call twice."""
+        if self.upload_queue:
+            self.upload_queue.close()
+        if self.session:
+            self.session.close()
+
+    def create_session(self):
+        """HTTP session kept alive across register, heartbeat and upload calls.
+
+        The pool holds a connection per upload worker plus one for the
+        background loop, so concurrent uploads don't reconnect to the hub.
+        """
+        workers = max(1, int(self.options.get('upload_workers', 2)))
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers + 1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def http(self):
+        """The shared session, or the requests module before on_loaded has run."""
+        return self.session or requests
+
     def get_cpu_serial(self):
         """Read CPU serial from /proc/cpuinfo."""
         try:
@@ -210,17 +710,19 @@ class PwnHub(plugins.Plugin):
             return "unknown"
 
     def get_handshake_count(self):
-        """Count handshake files in handshake_path."""
+        """Count handshake files in handshake_path; the watcher keeps this in memory."""
+        if self.watcher and self.watcher.running:
+            return self.watcher.count
+        
         handshake_path_str = self.options.get('handshake_path', '~/handshakes')
         handshake_path = Path(handshake_path_str).expanduser()
         if not handshake_path.exists():
             return 0
         
-        extensions = ['.cap', '.pcap', '.hccapx']
         count = 0
         try:
             for file_path in handshake_path.iterdir():
-                if file_path.is_file() and file_path.suffix.lower() in extensions:
+                if file_path.is_file() and file_path.suffix.lower() in HANDSHAKE_EXTENSIONS:
                     count += 1
         except Exception as e:
             self.logger.warning(f"Error counting handshakes: {e}")
@@ -246,8 +748,10 @@ class PwnHub(plugins.Plugin):
         """Save state to agent_id_file."""
         try:
             self.state_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(self.state_file, 'w') as f:
-                json.dump(self.state, f, indent=2)
+            # Uploads on the background thread and on_handshake both save
+            with self.state_lock:
+                with open(self.state_file, 'w') as f:
+                    json.dump(self.state, f, indent=2)
             self.logger.debug("State saved to file")
         except Exception as e:
             self.logger.error(f"Error saving state file: {e}")
@@ -303,7 +807,7 @@ class PwnHub(plugins.Plugin):
         }
         
         try:
-            response = requests.post(
+            response = self.http.post(
                 register_url,
                 json=payload,
                 timeout=10,
@@ -343,99 +847,478 @@ class PwnHub(plugins.Plugin):
             self.device_hostname = current_hostname
         
         try:
-            response = requests.post(
+            response = self.http.post(
                 heartbeat_url,
                 json=payload,
                 timeout=10,
                 headers={'Content-Type': 'application/json'}
             )
+            if response.status_code in (429, 503):
+                self.heartbeat_retry_after = self.parse_retry_after(response.headers.get('Retry-After'))
             response.raise_for_status()
+            reply = response.json()
             
             self.logger.debug("Heartbeat sent successfully")
+            self.heartbeat_failures = 0
+            interval = reply.get('heartbeat_interval') if isinstance(reply, dict) else None
+            self.hub_heartbeat_interval = interval if isinstance(interval, (int, float)) and interval > 0 else None
             return True
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.heartbeat_failures += 1
             self.logger.warning(f"Error sending heartbeat: {e}")
             return False
 
-    def upload_handshake_file(self, file_path):
-        """Upload a handshake file to the hub."""
+    def parse_retry_after(self, value):
+        """Seconds from a Retry-After header (delay or HTTP date), or None."""
+        if not value:
+            return None
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+        try:
+            return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def next_heartbeat_delay(self):
+        """Seconds until the next heartbeat.
+
+        The hub's suggested interval wins over heartbeat_interval. After
+        failures it doubles per failure up to heartbeat_max_interval, and
+        a Retry-After is always waited out. Jitter keeps a fleet that
+        booted together from reporting in lockstep.
+        """
+        interval = float(self.hub_heartbeat_interval or self.options.get('heartbeat_interval', 300))
+        # Never below 10s, whatever the hub says
+        interval = max(interval, 10)
+        if self.heartbeat_failures:
+            max_interval = max(float(self.options.get('heartbeat_max_interval', 3600)), interval)
+            interval = min(max_interval, interval * 2 ** min(self.heartbeat_failures, 16))
+        jitter = min(max(float(self.options.get('heartbeat_jitter', 0.2)), 0), 1)
+        delay = interval * random.uniform(1 - jitter, 1 + jitter)
+        if self.heartbeat_retry_after is not None:
+            # Spread the retries too, but only ever later than asked
+            delay = max(delay, self.heartbeat_retry_after * random.uniform(1, 1 + jitter))
+            self.heartbeat_retry_after = None
+        return delay
+
+    def wait(self, seconds):
+        """Sleep up to seconds, uploading new captures as the watcher reports them."""
+        deadline = time.time() + seconds
+        while self.running and time.time() < deadline:
+            if self.upload_wakeup.wait(min(1, max(deadline - time.time(), 0))):
+                self.upload_wakeup.clear()
+                self.process_upload_queue()
+
+    def upload_handshake_file(self, file_path, sha256=None):
+        """Upload a handshake file to the hub and delete it locally; raises on failure.
+
+        The hub is asked first whether it already has the content (sha256,
+        hashed here if not given); if it does, no bytes are sent.
+        """
+        sha256 = sha256 or self.file_sha256(file_path)
+        check = self.check_hub(file_path, sha256)
+        if check is not None and check.get('exists'):
+            self.logger.info(f"Hub already has {file_path.name}, not sending it")
+            self.forget_upload(str(file_path))
+            self.delete_local_file(file_path)
+            return True
+        
+        chunk_size = int(self.options.get('upload_chunk_size', 262144))
+        result = None
+        if chunk_size > 0 and file_path.stat().st_size > chunk_size:
+            result = self.upload_resumable(file_path, chunk_size, sha256)
+        if result is None:
+            # Small file, or a hub without resumable uploads
+            result = self.upload_single_request(file_path)
+        
+        if result.get('status') != 'ok':
+            raise RuntimeError(f"Upload failed: {result}")
+        self.logger.info(f"Handshake uploaded successfully: {file_path.name}")
+        self.delete_local_file(file_path)
+        return True
+
+    def check_hub(self, file_path, sha256):
+        """Ask the hub whether it holds this content; its reply, or None if it can't say.
+
+        A hit records the handshake for this device on the hub. The reply
+        also lists the upload encodings the hub accepts.
+        """
         hub_url = self.options.get('hub_url', 'http://10.67.0.1:5000')
-        upload_url = f"{hub_url}/api/handshakes/upload"
+        response = self.http.post(
+            f"{hub_url}/api/handshakes/check",
+            json={'serial': self.device_serial, 'filename': file_path.name, 'sha256': sha256},
+            timeout=10
+        )
+        if response.status_code in (404, 405):
+            return None
+        response.raise_for_status()
+        result = response.json()
+        if not result.get('exists'):
+            self.hub_encodings = tuple(result.get('accept_encoding', ()))
+        return result
+
+    def upload_encoding(self):
+        """Content-Encoding to compress upload bodies with, or None."""
+        wanted = str(self.options.get('upload_compression', 'auto')).lower()
+        if wanted == 'auto':
+            candidates = ('zstd', 'gzip')
+        elif wanted in ('gzip', 'zstd'):
+            candidates = (wanted,)
+        else:
+            return None
+        for encoding in candidates:
+            if encoding in self.hub_encodings and (encoding != 'zstd' or zstandard is not None):
+                return encoding
+        return None
+
+    def compress(self, data, encoding):
+        if encoding == 'zstd':
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        return gzip.compress(data, compresslevel=6, mtime=0)
+
+    def send_body(self, method, url, body, headers, timeout, params=None):
+        """Send an upload body, compressed if the hub accepts it and it gets smaller.
+
+        If the hub refuses the encoding (415) its Accept-Encoding is
+        remembered and the body is sent again uncompressed.
+        """
+        encoding = self.upload_encoding()
+        data = body
+        if encoding:
+            compressed = self.compress(body, encoding)
+            if len(compressed) < len(body):
+                data = compressed
+                headers = {**headers, 'Content-Encoding': encoding}
         
+        self.rate_limiter.consume(len(data))
+        response = self.http.request(method, url, params=params, data=data, headers=headers, timeout=timeout)
+        if response.status_code == 415 and 'Content-Encoding' in headers:
+            accepted = response.headers.get('Accept-Encoding', '')
+            self.hub_encodings = tuple(e.strip().lower() for e in accepted.split(',') if e.strip())
+            self.logger.warning(f"Hub refused {encoding} uploads, sending uncompressed")
+            headers = {k: v for k, v in headers.items() if k != 'Content-Encoding'}
+            data = body
+            self.rate_limiter.consume(len(data))
+            response = self.http.request(method, url, params=params, data=data, headers=headers, timeout=timeout)
+        with self.stats_lock:
+            self.bytes_sent += len(data)
+        return response
+
+    def delete_local_file(self, file_path):
+        """Remove a capture the hub has."""
         try:
-            with open(file_path, 'rb') as f:
-                files = {'file': (file_path.name, f, 'application/octet-stream')}
-                data = {'serial': self.device_serial}
-                
-                response = requests.post(
-                    upload_url,
-                    files=files,
-                    data=data,
-                    timeout=30
-                )
-                response.raise_for_status()
-                
-                result = response.json()
-                if result.get('status') == 'ok':
-                    self.logger.info(f"Handshake uploaded successfully: {file_path.name}")
-                    # Delete file on success
-                    try:
-                        file_path.unlink()
-                        self.logger.info(f"Deleted local file: {file_path.name}")
-                    except Exception as e:
-                        self.logger.warning(f"Could not delete file {file_path.name}: {e}")
-                    return True
-                else:
-                    self.logger.error(f"Upload failed: {result}")
-                    return False
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Error uploading handshake {file_path.name}: {e}")
-            # Add to pending list for retry
-            if file_path.exists():
-                self.pending_handshakes.append(file_path)
-            return False
+            file_path.unlink()
+            self.logger.info(f"Deleted local file: {file_path.name}")
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            self.logger.error(f"Unexpected error uploading {file_path.name}: {e}")
-            # Add to pending list for retry
-            if file_path.exists():
-                self.pending_handshakes.append(file_path)
-            return False
+            self.logger.warning(f"Could not delete file {file_path.name}: {e}")
 
-    def sync_handshakes(self):
-        """Walk handshake_path and upload any .cap/.pcap/.hccapx files."""
-        if not self.options.get('push_handshakes', True):
-            return
+    def queue_handshake(self, file_path):
+        """Add a capture to the upload queue; False if it didn't fit."""
+        try:
+            if self.upload_queue.add(file_path, self.file_sha256):
+                return True
+            if not self.queue_refused:
+                self.logger.warning(f"Upload queue full, {file_path.name} and later captures will be queued once it drains")
+            self.queue_refused = True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.error(f"Error queuing {file_path.name}: {e}")
+        return False
+
+    def process_upload_queue(self):
+        """Upload every queued capture that is due; returns how many were sent.
+
+        Uploads run on upload_workers threads. Only one thread drains the
+        queue at a time; captures queued while it runs are picked up
+        before it returns, but each file is tried at most once per call.
+        Each batch logs its count, bytes and rate.
+        """
+        if self.upload_queue is None or not self.upload_lock.acquire(blocking=False):
+            return 0
+        sent = 0
+        tried = set()
+        try:
+            workers = max(1, int(self.options.get('upload_workers', 2)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pwnhub-upload') as pool:
+                while self.running:
+                    batch = [item for item in self.upload_queue.due() if item[0] not in tried]
+                    if not batch:
+                        break
+                    tried.update(item[0] for item in batch)
+                    started = time.monotonic()
+                    sent_before = self.bytes_sent
+                    results = list(pool.map(self.upload_queued, batch))
+                    elapsed = max(time.monotonic() - started, 0.001)
+                    uploaded = [size for size in results if size is not None]
+                    total = sum(uploaded)
+                    sent += len(uploaded)
+                    if uploaded:
+                        self.logger.info(
+                            f"Upload batch: {len(uploaded)} of {len(batch)} files, {total} bytes "
+                            f"({self.bytes_sent - sent_before} sent) in {elapsed:.1f}s "
+                            f"({total / 1024 / elapsed:.1f} KiB/s, {workers} workers)"
+                        )
+        finally:
+            self.upload_lock.release()
+        return sent
+
+    def upload_queued(self, item):
+        """Send one queued capture; returns its size if it was uploaded, else None."""
+        path, sha256, attempts, size = item
+        if not self.running:
+            return None
+        file_path = Path(path)
+        if not file_path.exists():
+            self.upload_queue.done(path)
+            return None
+        if self.upload_queue.is_sent(sha256):
+            # Same content as a capture already sent; don't spend airtime on it
+            self.logger.info(f"{file_path.name} was already uploaded, skipping")
+            self.delete_local_file(file_path)
+            self.upload_queue.done(path)
+            return None
+        try:
+            self.upload_handshake_file(file_path, sha256)
+        except Exception as e:
+            delay = self.upload_queue.failed(path, attempts, e)
+            self.logger.error(
+                f"Error uploading handshake {file_path.name} (attempt {attempts + 1}): {e}; "
+                f"retrying in {int(delay)}s"
+            )
+            return None
+        self.upload_queue.done(path, sha256)
+        return size
+
+    def upload_single_request(self, file_path):
+        """Post the whole file as one multipart request; returns the hub's JSON reply."""
+        hub_url = self.options.get('hub_url', 'http://10.67.0.1:5000')
+        upload_url = f"{hub_url}/api/handshakes/upload"
         
-        if self.options.get('upload_method') != 'http':
-            return
+        with open(file_path, 'rb') as f:
+            files = {'file': (file_path.name, f, 'application/octet-stream')}
+            data = {'serial': self.device_serial}
+            # Encode the form here so the whole body can be compressed
+            prepared = requests.Request('POST', upload_url, files=files, data=data).prepare()
         
-        handshake_path_str = self.options.get('handshake_path', '~/handshakes')
-        handshake_path = Path(handshake_path_str).expanduser()
-        if not handshake_path.exists():
-            return
+        response = self.send_body(
+            'POST',
+            upload_url,
+            prepared.body,
+            {'Content-Type': prepared.headers['Content-Type']},
+            timeout=30
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def file_sha256(self, file_path, offset=0, length=None):
+        """sha256 of a file, or of length bytes from offset."""
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            remaining = length
+            while remaining is None or remaining > 0:
+                block = f.read(65536 if remaining is None else min(65536, remaining))
+                if not block:
+                    break
+                sha256.update(block)
+                if remaining is not None:
+                    remaining -= len(block)
+        return sha256.hexdigest()
+
+    def upload_resumable(self, file_path, chunk_size, sha256=None):
+        """Send a file in chunks that survive dropped connections and restarts.
+
+        The upload id and offset are kept in the state file under
+        'uploads', so an interrupted upload continues where the hub left
+        off instead of starting over. Returns None if the hub doesn't
+        support resumable uploads.
+        """
+        hub_url = self.options.get('hub_url', 'http://10.67.0.1:5000')
+        uploads_url = f"{hub_url}/api/handshakes/uploads"
+        key = str(file_path)
+        stat = file_path.stat()
+        
+        with self.state_lock:
+            entry = self.state.setdefault('uploads', {}).get(key)
+        if entry and (entry.get('size') != stat.st_size or entry.get('mtime') != int(stat.st_mtime)):
+            # File changed since the upload started
+            entry = None
+        
+        offset = None
+        if entry:
+            offset, result = self.resume_offset(uploads_url, entry, file_path)
+            if result is not None:
+                self.forget_upload(key)
+                return result
         
-        extensions = ['.cap', '.pcap', '.hccapx']
+        if offset is None:
+            sha256 = sha256 or self.file_sha256(file_path)
+            response = self.http.post(
+                uploads_url,
+                json={
+                    'serial': self.device_serial,
+                    'filename': file_path.name,
+                    'size': stat.st_size,
+                    'sha256': sha256
+                },
+                timeout=10
+            )
+            if response.status_code in (404, 405):
+                return None
+            response.raise_for_status()
+            session = response.json()
+            entry = {
+                'upload_id': session['upload_id'],
+                'sha256': sha256,
+                'size': stat.st_size,
+                'mtime': int(stat.st_mtime),
+                'chunk_size': session.get('chunk_size', chunk_size),
+                'offset': 0
+            }
+            with self.state_lock:
+                self.state['uploads'][key] = entry
+                self.save_state()
+            offset = 0
+        else:
+            self.logger.info(f"Resuming upload of {file_path.name} at byte {offset} of {stat.st_size}")
         
+        chunk_url = f"{uploads_url}/{entry['upload_id']}"
+        chunk_size = min(chunk_size, entry.get('chunk_size') or chunk_size)
+        conflicts = 0
+        with open(file_path, 'rb') as f:
+            while offset < stat.st_size:
+                f.seek(offset)
+                data = f.read(chunk_size)
+                response = self.send_body(
+                    'PUT',
+                    chunk_url,
+                    data,
+                    {
+                        'Content-Type': 'application/octet-stream',
+                        'X-Chunk-SHA256': hashlib.sha256(data).hexdigest()
+                    },
+                    timeout=30,
+                    params={'offset': offset}
+                )
+                if response.status_code == 409 and 'Upload-Offset' in response.headers and conflicts < 3:
+                    # Another attempt moved the hub's offset; continue from there
+                    conflicts += 1
+                    offset = int(response.headers['Upload-Offset'])
+                    continue
+                response.raise_for_status()
+                offset = response.json()['offset']
+                entry['offset'] = offset
+                self.save_state()
+        
+        response = self.http.post(f"{chunk_url}/finalize", timeout=60)
+        if response.status_code == 422:
+            # What the hub assembled doesn't hash to our file; start over next time
+            self.forget_upload(key)
+        response.raise_for_status()
+        self.forget_upload(key)
+        return response.json()
+
+    def resume_offset(self, uploads_url, entry, file_path):
+        """Where to continue a saved upload: (offset, None), or (None, result) if it's done.
+
+        Chunks the hub holds are checked against the local file and the
+        upload rewinds to the first one that differs. offset is None if
+        the hub no longer has the session.
+        """
+        response = self.http.get(f"{uploads_url}/{entry['upload_id']}", timeout=10)
+        if response.status_code != 404:
+            response.raise_for_status()
+            session = response.json()
+            for chunk in session.get('chunks', []):
+                if self.file_sha256(file_path, chunk['offset'], chunk['length']) != chunk['sha256']:
+                    return chunk['offset'], None
+            return session['offset'], None
+        
+        # Expired, or finalized but the reply was lost: ask whether the hub
+        # has the content (this also records it for us if it does)
+        hub_url = self.options.get('hub_url', 'http://10.67.0.1:5000')
+        response = self.http.post(
+            f"{hub_url}/api/handshakes/check",
+            json={'serial': self.device_serial, 'filename': file_path.name, 'sha256': entry['sha256']},
+            timeout=10
+        )
+        response.raise_for_status()
+        result = response.json()
+        if result.get('exists'):
+            return None, {'status': 'ok', **result}
+        return None, None
+
+    def forget_upload(self, key):
+        """Drop a finished or abandoned upload from the state file."""
+        with self.state_lock:
+            if self.state.get('uploads', {}).pop(key, None) is not None:
+                self.save_state()
+
+    def pushing_handshakes(self):
+        return self.options.get('push_handshakes', True) and self.options.get('upload_method') == 'http'
+
+    def on_new_capture(self, file_path):
+        """Watcher callback for a capture that appeared in handshake_path."""
+        if self.pushing_handshakes() and self.queue_handshake(file_path):
+            self.upload_wakeup.set()
+
+    def reconcile_handshakes(self):
+        """Rescan handshake_path in full, queuing every capture in it."""
+        self.queue_refused = False
+        self.last_reconcile = time.time()
         try:
-            for file_path in handshake_path.iterdir():
-                if file_path.is_file() and file_path.suffix.lower() in extensions:
-                    self.logger.info(f"Found handshake file: {file_path.name}")
-                    self.upload_handshake_file(file_path)
+            count = self.watcher.reconcile()
+            self.logger.info(f"Rescanned handshake_path: {count} captures")
         except Exception as e:
-            self.logger.error(f"Error syncing handshakes: {e}")
+            self.logger.error(f"Error rescanning handshakes: {e}")
+
+    def sync_handshakes(self):
+        """Upload what is due in the queue, rescanning handshake_path first if needed.
+
+        New captures reach the queue through the watcher, so the directory
+        is only rescanned every reconcile_interval seconds, or after a full
+        queue has drained enough to take the captures it refused.
+        """
+        if not self.pushing_handshakes():
+            return
+        
+        reconcile_interval = int(self.options.get('reconcile_interval', 0))
+        if reconcile_interval > 0 and time.time() - self.last_reconcile >= reconcile_interval:
+            self.reconcile_handshakes()
+        sent = self.process_upload_queue()
+        while sent and self.queue_refused and self.upload_queue.count() < self.upload_queue.max_items:
+            self.reconcile_handshakes()
+            sent = self.process_upload_queue()
 
     def _background_loop(self):
         """Background thread loop for periodic operations."""
-        heartbeat_interval = self.options.get('heartbeat_interval', 300)
-        
-        # Register immediately on startup
-        self.logger.info("Registering device on startup")
+        try:
+            self._run_background()
+        finally:
+            # on_unload leaves closing to us if uploads outlasted its join
+            if not self.running:
+                self.close_resources()
+
+    def _run_background(self):
+        # Units that boot together (after a power cut, say) start out of step
+        jitter = min(max(float(self.options.get('heartbeat_jitter', 0.2)), 0), 1)
+        splay = random.uniform(0, float(self.options.get('heartbeat_interval', 300)) * jitter)
+        self.logger.info(f"Registering device in {splay:.0f}s")
+        self.wait(splay)
+        if not self.running:
+            return
         self.register_device()
         
-        # Initial handshake sync
-        if self.options.get('push_handshakes', True):
-            self.logger.info("Performing initial handshake sync")
-            self.sync_handshakes()
+        # Initial full scan, after which the watcher reports new captures
+        self.logger.info("Performing initial handshake sync")
+        self.last_reconcile = time.time()
+        self.watcher.start()
+        self.sync_handshakes()
         
         # Main loop
         while self.running:
@@ -444,18 +1327,16 @@ class PwnHub(plugins.Plugin):
                 self.send_heartbeat()
                 
                 # Sync handshakes
-                if self.options.get('push_handshakes', True):
-                    self.sync_handshakes()
+                self.sync_handshakes()
                 
-                # Sleep for heartbeat interval
-                for _ in range(heartbeat_interval):
-                    if not self.running:
-                        break
-                    time.sleep(1)
+                delay = self.next_heartbeat_delay()
+                if self.heartbeat_failures:
+                    self.logger.info(f"Hub unavailable, next heartbeat in {delay:.0f}s")
+                self.wait(delay)
                     
             except Exception as e:
                 self.logger.error(f"Error in background loop: {e}")
-                time.sleep(60)  # Wait a minute before retrying
+                self.wait(60)  # Wait a minute before retrying
 
     def on_handshake(self, agent, filename, access_point, client_station):
         """Called when a handshake is captured."""
@@ -470,8 +1351,9 @@ class PwnHub(plugins.Plugin):
         file_path = handshake_path / filename
         
         if file_path.exists():
-            # Upload immediately
-            self.upload_handshake_file(file_path)
+            # The watcher usually has it already; either way the background
+            # thread uploads it now rather than blocking this callback
+            self.on_new_capture(file_path)
         else:
             self.logger.warning(f"Handshake file not found: {file_path}")
     
@@ -486,27 +1368,9 @@ class PwnHub(plugins.Plugin):
             if self.register_device():
                 self.last_registration_attempt = current_time
         
-        # Retry any pending handshake uploads
-        if self.pending_handshakes:
-            self.logger.info(f"Retrying {len(self.pending_handshakes)} pending handshake uploads")
-            retry_list = self.pending_handshakes.copy()
-            self.pending_handshakes = []
-            
-            for file_path in retry_list:
-                if file_path.exists():
-                    self.logger.info(f"Retrying upload: {file_path.name}")
-                    if self.upload_handshake_file(file_path):
-                        # Successfully uploaded, file will be deleted
-                        pass
-                    else:
-                        # Still failed, add back to pending
-                        self.pending_handshakes.append(file_path)
-                else:
-                    self.logger.warning(f"Pending handshake file no longer exists: {file_path}")
-        
-        # Also sync any new handshakes
-        if self.options.get('push_handshakes', True):
-            self.sync_handshakes()
+        # Send whatever is due (failed uploads keep their backoff, so a
+        # flapping link doesn't resend in a loop)
+        self.sync_handshakes()
     
     def on_rebooting(self, agent):
         """Called when the agent is rebooting the board."""
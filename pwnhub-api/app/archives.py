@@ -0,0 +1,231 @@
+"""On-the-fly device archives.
+
+GET /api/devices/{serial}/archive streams a tar or zip of a device's
+handshakes straight from the blob store. Nothing is staged on disk: the
+archive is produced a read at a time (ARCHIVE_READ_SIZE bytes of one
+blob), so memory use doesn't depend on the number or size of files.
+
+Tar streams can be gzip or zstd compressed as a whole; zip archives
+deflate each entry instead, as zip readers expect.
+"""
+
+import logging
+import sqlite3
+import tarfile
+import time
+import zipfile
+import zlib
+from typing import Optional
+from app.compression import IDENTITY, open_blob, zstandard
+from app.backups import uploaded_at_timestamp
+from app.database import get_pool
+from app.executors import run_io
+from app.storage import blob_path
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_READ_SIZE = 256 * 1024
+# Rows fetched per pooled connection while archiving
+ARCHIVE_BATCH_SIZE = 500
+
+# (format, compression) -> (media type, file extension)
+ARCHIVE_TYPES = {
+    ("tar", "none"): ("application/x-tar", "tar"),
+    ("tar", "gzip"): ("application/gzip", "tar.gz"),
+    ("tar", "zstd"): ("application/zstd", "tar.zst"),
+    ("zip", "none"): ("application/zip", "zip"),
+    ("zip", "gzip"): ("application/zip", "zip"),
+}
+
+TAR_BLOCK = tarfile.BLOCKSIZE
+TAR_RECORD = tarfile.RECORDSIZE
+# zip can't store dates before 1980
+ZIP_EPOCH = 315532800
+
+
+def archive_type(archive_format: str, compression: str) -> Optional[tuple]:
+    """(media type, extension) for a format/compression pair, None if unsupported."""
+    if compression == "zstd" and zstandard is None:
+        return None
+    return ARCHIVE_TYPES.get((archive_format, compression))
+
+
+class _Sink:
+    """Write-only file object collecting output until it is taken, optionally compressing it."""
+
+    def __init__(self, compression: str = "none"):
+        self._buffer = bytearray()
+        if compression == "gzip":
+            # wbits=31: gzip container, header mtime 0
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif compression == "zstd":
+            self._compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            self._compressor = None
+
+    def write(self, data) -> int:
+        self._buffer += self._compressor.compress(data) if self._compressor else data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self._compressor:
+            self._buffer += self._compressor.flush()
+
+    def take(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+class _TarBuilder:
+    """Writes ustar/pax entries by hand so file content can be streamed in pieces."""
+
+    def __init__(self, sink: _Sink):
+        self._sink = sink
+        self._written = 0
+        self._size = 0
+        self._offset = 0
+
+    def _write(self, data: bytes):
+        self._sink.write(data)
+        self._offset += len(data)
+
+    def start(self, filename: str, size: int, mtime: float):
+        info = tarfile.TarInfo(filename)
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        self._write(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+        self._size = size
+        self._written = 0
+
+    def write(self, data: bytes):
+        # Never past the size in the header, or the archive is unreadable
+        data = data[:self._size - self._written]
+        self._write(data)
+        self._written += len(data)
+
+    def end(self):
+        # A blob shorter than recorded is zero-filled to keep the archive valid
+        if self._written < self._size:
+            self._write(bytes(self._size - self._written))
+        remainder = self._size % TAR_BLOCK
+        if remainder:
+            self._write(bytes(TAR_BLOCK - remainder))
+
+    def close(self):
+        self._write(bytes(TAR_BLOCK * 2))
+        remainder = self._offset % TAR_RECORD
+        if remainder:
+            self._write(bytes(TAR_RECORD - remainder))
+
+
+class _ZipBuilder:
+    """Streams zip entries with data descriptors (the sink isn't seekable)."""
+
+    def __init__(self, sink: _Sink, compression: str):
+        method = zipfile.ZIP_DEFLATED if compression == "gzip" else zipfile.ZIP_STORED
+        self._zip = zipfile.ZipFile(sink, "w", compression=method, allowZip64=True)
+        self._entry = None
+
+    def start(self, filename: str, size: int, mtime: float):
+        info = zipfile.ZipInfo(filename, time.gmtime(max(mtime, ZIP_EPOCH))[:6])
+        info.compress_type = self._zip.compression
+        info.file_size = size
+        info.external_attr = 0o644 << 16
+        self._entry = self._zip.open(info, "w")
+
+    def write(self, data: bytes):
+        self._entry.write(data)
+
+    def end(self):
+        self._entry.close()
+        self._entry = None
+
+    def close(self):
+        if self._entry is not None:
+            self._entry.close()
+        self._zip.close()
+
+
+def _fetch_archive_batch(conn: sqlite3.Connection, clauses: list, params: list, after_id: int) -> list:
+    """Up to ARCHIVE_BATCH_SIZE selected handshakes after after_id, oldest first, with how their blobs are stored."""
+    where = " AND ".join(f"h.{clause}" for clause in [*clauses, "id > ?"])
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT h.id, h.filename, h.sha256, h.bytes, h.uploaded_at, COALESCE(b.encoding, ?)
+        FROM handshakes h LEFT JOIN blobs b ON b.sha256 = h.sha256
+        WHERE {where}
+        ORDER BY h.id
+        LIMIT ?
+    """, [IDENTITY, *params, after_id, ARCHIVE_BATCH_SIZE])
+    return cursor.fetchall()
+
+
+def _archive_rows(clauses: list, params: list):
+    """Yield the selected handshakes, taking a pooled connection only while a batch is fetched. Blocking."""
+    pool = get_pool()
+    after_id = 0
+    while True:
+        with pool.connection() as conn:
+            rows = pool.run_with_retry(conn, _fetch_archive_batch, clauses, params, after_id)
+        if not rows:
+            return
+        for row in rows:
+            yield row[1:]
+        after_id = rows[-1][0]
+
+
+def iter_archive(rows, archive_format: str, compression: str):
+    """Yield the archive of rows in pieces. Blocking; each step reads at most one ARCHIVE_READ_SIZE."""
+    sink = _Sink(compression if archive_format == "tar" else "none")
+    builder = _TarBuilder(sink) if archive_format == "tar" else _ZipBuilder(sink, compression)
+    for filename, sha256, size, uploaded_at, encoding in rows:
+        try:
+            raw = open_blob(blob_path(sha256), encoding)
+        except FileNotFoundError:
+            # Removed by retention after the query started
+            logger.warning(f"Skipping {filename} in archive: blob {sha256} is missing")
+            continue
+        with raw:
+            builder.start(filename, size, uploaded_at_timestamp(uploaded_at))
+            while True:
+                data = raw.read(ARCHIVE_READ_SIZE)
+                if not data:
+                    break
+                builder.write(data)
+                chunk = sink.take()
+                if chunk:
+                    yield chunk
+            builder.end()
+    builder.close()
+    sink.finish()
+    chunk = sink.take()
+    if chunk:
+        yield chunk
+
+
+async def stream_archive(clauses: list, params: list, archive_format: str, compression: str):
+    """Yield an archive of the handshakes matching clauses.
+
+    Like the catalog export, rows are fetched a batch at a time, so no
+    pooled connection is held between pieces and a dropped client leaves
+    nothing checked out.
+    """
+    pieces = iter_archive(_archive_rows(clauses, params), archive_format, compression)
+    try:
+        while True:
+            chunk = await run_io(next, pieces, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        # Not awaited, so it can't be cancelled along with the stream
+        try:
+            pieces.close()
+        except ValueError:
+            # Still running on the I/O pool; it closes when collected
+            pass
@@ -0,0 +1,380 @@
+"""Device backup engine.
+
+POST /api/devices/{serial}/backup queues a job and returns its id right
+away. Jobs run on a small dedicated thread pool and record their
+progress in the backup_jobs table, so any API worker can report on them.
+
+Backups are incremental: an archive holds only the handshakes added since
+the device's last completed backup (by handshakes.id) unless a full one
+is asked for. The tar stream is gzipped in fixed-size blocks on
+BACKUP_COMPRESS_THREADS threads, one gzip member per block (gzip and tar
+read that as a single stream), so memory stays bounded and compression
+isn't limited to one core.
+
+Next to every archive is <archive>.manifest.json with the sha256 of each
+file, checked against the content as it is archived, and of the archive
+itself, so restores can be verified.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tarfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+from app.compression import open_blob
+from app.database import ConnectionPool, get_backup_storage_path
+from app.events import event_hub
+from app.storage import blob_path
+
+logger = logging.getLogger(__name__)
+
+# Job and compression parallelism (see deploy/env.example)
+BACKUP_MAX_JOBS = int(os.getenv("BACKUP_MAX_JOBS", "1"))
+BACKUP_COMPRESS_THREADS = int(os.getenv("BACKUP_COMPRESS_THREADS", str(max(1, min(4, os.cpu_count() or 1)))))
+BACKUP_COMPRESSION_LEVEL = int(os.getenv("BACKUP_COMPRESSION_LEVEL", "6"))
+BACKUP_BLOCK_SIZE = int(os.getenv("BACKUP_BLOCK_SIZE", str(1024 * 1024)))
+# A queued or running job with no progress for this long is marked failed
+BACKUP_STALE_SECONDS = float(os.getenv("BACKUP_STALE_SECONDS", "600"))
+
+# Seconds between progress writes to backup_jobs
+PROGRESS_INTERVAL = 2.0
+
+JOB_COLUMNS = ("id", "serial", "kind", "status", "base_id", "since_id", "last_id", "files",
+               "files_total", "bytes", "archive", "archive_bytes", "error", "created_at",
+               "started_at", "updated_at", "finished_at")
+
+
+class ParallelGzipWriter:
+    """Write-only file object that gzips fixed-size blocks in parallel, in order.
+
+    The output is a multi-member gzip stream. zlib releases the GIL, so
+    blocks are compressed concurrently on executor's threads; at most
+    max_pending blocks are in flight, which bounds memory.
+    """
+
+    def __init__(self, fileobj, executor: ThreadPoolExecutor, max_pending: int,
+                 block_size: int = BACKUP_BLOCK_SIZE, level: int = BACKUP_COMPRESSION_LEVEL):
+        self._out = fileobj
+        self._executor = executor
+        self._max_pending = max(1, max_pending)
+        self._block_size = block_size
+        self._level = level
+        self._buffer = bytearray()
+        self._pending = deque()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self._pending.append(self._executor.submit(gzip.compress, block, self._level, mtime=0))
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        compressed = self._pending.popleft().result()
+        self._out.write(compressed)
+        self.sha256.update(compressed)
+        self.size += len(compressed)
+
+    def close(self):
+        """Compress what's left and write every pending block."""
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._write_next()
+
+
+class _HashingReader:
+    """Passes reads through while hashing them, to verify content as it's archived."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._raw.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def _job_dict(row: tuple) -> dict:
+    job = dict(zip(JOB_COLUMNS, row))
+    job["job_id"] = job.pop("id")
+    job["manifest"] = f"{job['archive']}.manifest.json" if job["archive"] else None
+    return job
+
+
+def get_backup_job(conn: sqlite3.Connection, job_id: str) -> Optional[dict]:
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM backup_jobs WHERE id = ?", (job_id,))
+    row = cursor.fetchone()
+    return _job_dict(row) if row else None
+
+
+def list_backup_jobs(conn: sqlite3.Connection, serial: str, limit: int) -> list:
+    """A device's backup jobs, newest first."""
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT {', '.join(JOB_COLUMNS)} FROM backup_jobs
+        WHERE serial = ? ORDER BY created_at DESC LIMIT ?
+    """, (serial, limit))
+    return [_job_dict(row) for row in cursor.fetchall()]
+
+
+def device_backup_dir(serial: str) -> Path:
+    return get_backup_storage_path() / serial
+
+
+def create_backup_job_tx(conn: sqlite3.Connection, serial: str, full: bool) -> tuple:
+    """Queue a backup of serial; returns (job, created).
+
+    If the device already has a queued or running job that one is
+    returned instead. Incremental jobs start after the newest completed
+    backup whose archive is still on disk (or that had nothing to pack).
+    """
+    now = time.time()
+    cursor = conn.cursor()
+    # Jobs whose worker died never finish; don't let them block new ones
+    cursor.execute("""
+        UPDATE backup_jobs SET status = 'failed', error = 'interrupted', finished_at = ?
+        WHERE status IN ('queued', 'running') AND updated_at < ?
+    """, (now, now - BACKUP_STALE_SECONDS))
+
+    cursor.execute(f"""
+        SELECT {', '.join(JOB_COLUMNS)} FROM backup_jobs
+        WHERE serial = ? AND status IN ('queued', 'running')
+        ORDER BY created_at DESC LIMIT 1
+    """, (serial,))
+    row = cursor.fetchone()
+    if row:
+        conn.commit()
+        return _job_dict(row), False
+
+    base_id, since_id = None, 0
+    if not full:
+        cursor.execute("""
+            SELECT id, last_id, archive FROM backup_jobs
+            WHERE serial = ? AND status = 'done'
+            ORDER BY finished_at DESC
+        """, (serial,))
+        for job_id, last_id, archive in cursor.fetchall():
+            if archive is None or (device_backup_dir(serial) / archive).exists():
+                base_id, since_id = job_id, last_id or 0
+                break
+
+    job_id = uuid.uuid4().hex
+    cursor.execute("""
+        INSERT INTO backup_jobs (id, serial, kind, status, base_id, since_id, created_at, updated_at)
+        VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)
+    """, (job_id, serial, "incremental" if base_id else "full", base_id, since_id, now, now))
+    conn.commit()
+    return get_backup_job(conn, job_id), True
+
+
+def _update_job_tx(conn: sqlite3.Connection, job_id: str, **fields):
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    conn.execute(f"UPDATE backup_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+    conn.commit()
+
+
+def _claim_job_tx(conn: sqlite3.Connection, job_id: str) -> bool:
+    """Move a queued job to running; False if it is no longer queued."""
+    now = time.time()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE backup_jobs SET status = 'running', started_at = ?, updated_at = ?
+        WHERE id = ? AND status = 'queued'
+    """, (now, now, job_id))
+    claimed = cursor.rowcount == 1
+    conn.commit()
+    return claimed
+
+
+def _list_backup_files(conn: sqlite3.Connection, serial: str, since_id: int) -> list:
+    """Handshakes of serial added after since_id, with how their blobs are stored."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT h.id, h.filename, h.sha256, h.bytes, h.uploaded_at, COALESCE(b.encoding, 'identity')
+        FROM handshakes h LEFT JOIN blobs b ON b.sha256 = h.sha256
+        WHERE h.serial = ? AND h.id > ?
+        ORDER BY h.id
+    """, (serial, since_id))
+    return cursor.fetchall()
+
+
+def uploaded_at_timestamp(uploaded_at: str) -> float:
+    """uploaded_at (CURRENT_TIMESTAMP, UTC) as a Unix time for tar mtimes."""
+    try:
+        return datetime.strptime(uploaded_at, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+
+class BackupCancelled(Exception):
+    """Raised inside a job when the engine is shutting down."""
+
+
+class BackupEngine:
+    """Runs queued backup jobs on a dedicated thread pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stop = threading.Event()
+
+    def submit(self, pool: ConnectionPool, job_id: str):
+        with self._lock:
+            if self._executor is None:
+                self._stop.clear()
+                self._executor = ThreadPoolExecutor(max_workers=BACKUP_MAX_JOBS, thread_name_prefix="pwnhub-backup")
+            self._executor.submit(self.run_job, pool, job_id)
+
+    def stop(self):
+        """Cancel queued jobs and stop running ones at the next file. Blocking."""
+        self._stop.set()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def run_job(self, pool: ConnectionPool, job_id: str):
+        """Build one job's archive and manifest, recording the outcome in backup_jobs."""
+        with pool.connection() as conn:
+            if not pool.run_with_retry(conn, _claim_job_tx, job_id):
+                # Marked stale while it waited in the queue
+                return
+            job = get_backup_job(conn, job_id)
+            files = _list_backup_files(conn, job["serial"], job["since_id"])
+
+        serial = job["serial"]
+        try:
+            if not files:
+                result = {"status": "done", "last_id": job["since_id"], "files_total": 0}
+            else:
+                result = self._write_archive(pool, job, files)
+        except Exception as e:
+            error = "cancelled" if isinstance(e, BackupCancelled) else str(e)
+            logger.error(f"Backup {job_id} of {serial} failed: {error}")
+            result = {"status": "failed", "error": error}
+
+        with pool.connection() as conn:
+            pool.run_with_retry(conn, _update_job_tx, job_id, finished_at=time.time(), **result)
+            job = get_backup_job(conn, job_id)
+        event_hub.publish("backup_finished", {
+            "serial": serial,
+            "job_id": job_id,
+            "status": job["status"],
+            "filename": job["archive"],
+            "size_bytes": job["archive_bytes"],
+            "files": job["files"],
+        })
+
+    def _write_archive(self, pool: ConnectionPool, job: dict, files: list) -> dict:
+        """Pack files into a new archive plus manifest; returns the backup_jobs fields to set."""
+        started = datetime.now(timezone.utc)
+        directory = device_backup_dir(job["serial"])
+        directory.mkdir(parents=True, exist_ok=True)
+        archive = f"{started.strftime('%Y%m%d_%H%M%S')}-{job['kind']}-{job['job_id'][:8]}.tar.gz"
+        temp_path = directory / f".{archive}.part"
+
+        entries = []
+        missing = []
+        packed_bytes = 0
+        last_progress = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=BACKUP_COMPRESS_THREADS,
+                                    thread_name_prefix="pwnhub-backup-gzip") as compress_executor, \
+                    open(temp_path, "wb") as out:
+                writer = ParallelGzipWriter(out, compress_executor, max_pending=BACKUP_COMPRESS_THREADS * 2)
+                with tarfile.open(fileobj=writer, mode="w|") as tar:
+                    for handshake_id, filename, sha256, size, uploaded_at, encoding in files:
+                        if self._stop.is_set():
+                            raise BackupCancelled()
+                        try:
+                            raw = open_blob(blob_path(sha256), encoding)
+                        except FileNotFoundError:
+                            # Removed by retention since the job started
+                            missing.append(filename)
+                            continue
+                        info = tarfile.TarInfo(filename)
+                        info.size = size
+                        info.mtime = uploaded_at_timestamp(uploaded_at)
+                        info.mode = 0o644
+                        with raw:
+                            reader = _HashingReader(raw)
+                            tar.addfile(info, reader)
+                        entries.append({
+                            "filename": filename,
+                            "sha256": sha256,
+                            "bytes": size,
+                            "uploaded_at": uploaded_at,
+                            "verified": reader.sha256.hexdigest() == sha256,
+                        })
+                        packed_bytes += size
+                        if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                            last_progress = time.monotonic()
+                            with pool.connection() as conn:
+                                pool.run_with_retry(conn, _update_job_tx, job["job_id"], files=len(entries),
+                                                    files_total=len(files), bytes=packed_bytes)
+                writer.close()
+                out.flush()
+                os.fsync(out.fileno())
+
+            os.replace(temp_path, directory / archive)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        corrupt = [entry["filename"] for entry in entries if not entry["verified"]]
+        if corrupt:
+            logger.warning(f"Backup {job['job_id']}: {len(corrupt)} blobs didn't match their sha256")
+        manifest = {
+            "job_id": job["job_id"],
+            "serial": job["serial"],
+            "kind": job["kind"],
+            "base_job_id": job["base_id"],
+            "created_at": started.isoformat(),
+            "since_id": job["since_id"],
+            "last_id": files[-1][0],
+            "archive": archive,
+            "archive_sha256": writer.sha256.hexdigest(),
+            "archive_bytes": writer.size,
+            "files": entries,
+            "missing": missing,
+            "corrupt": corrupt,
+        }
+        manifest_path = directory / f"{archive}.manifest.json"
+        manifest_temp = directory / f".{archive}.manifest.json.part"
+        with open(manifest_temp, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_temp, manifest_path)
+
+        return {
+            "status": "done",
+            "last_id": files[-1][0],
+            "files": len(entries),
+            "files_total": len(files),
+            "bytes": packed_bytes,
+            "archive": archive,
+            "archive_bytes": writer.size,
+        }
+
+
+backup_engine = BackupEngine()
@@ -0,0 +1,178 @@
+"""At-rest compression for the blob store.
+
+With STORAGE_COMPRESSION set, new blobs are written gzip or zstd
+compressed; blobs.encoding records how each one is stored, so the
+setting can change at any time and old blobs stay readable. Encodings
+use their HTTP Content-Encoding names, so a stored blob can be sent
+as-is to a client that accepts it.
+"""
+
+import gzip
+import logging
+import os
+import shutil
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional; STORAGE_COMPRESSION=zstd falls back to gzip
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+IDENTITY = "identity"
+ENCODINGS = (IDENTITY, "gzip", "zstd")
+
+# Codec for new blobs and its level, 0 = codec default (see deploy/env.example)
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "none").lower()
+STORAGE_COMPRESSION_LEVEL = int(os.getenv("STORAGE_COMPRESSION_LEVEL", "0"))
+
+COPY_BUFFER_SIZE = 1024 * 1024
+# Compressed bytes fed to a zstd upload decoder per step
+ZSTD_FEED_SIZE = 128
+
+
+def _resolve_encoding(name: str) -> str:
+    if name in ("", "none", IDENTITY):
+        return IDENTITY
+    if name not in ENCODINGS:
+        logger.error(f"Unknown STORAGE_COMPRESSION {name!r}, storing blobs uncompressed")
+        return IDENTITY
+    if name == "zstd" and zstandard is None:
+        logger.warning("STORAGE_COMPRESSION=zstd needs the zstandard package, using gzip")
+        return "gzip"
+    return name
+
+
+STORAGE_ENCODING = _resolve_encoding(STORAGE_COMPRESSION)
+
+# Content-Encodings agents may compress upload bodies with
+UPLOAD_ENCODINGS = ("gzip", "zstd") if zstandard is not None else ("gzip",)
+# What a decoder raises on corrupt input
+DECODE_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard is not None else (zlib.error,)
+
+
+def compress_file(source: str, target: str, encoding: str, level: int = STORAGE_COMPRESSION_LEVEL) -> int:
+    """Write a compressed copy of source to target and return its size.
+
+    CPU-bound; a top-level function so it can run on the process pool.
+    """
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        if encoding == "gzip":
+            # mtime=0 keeps the output identical for identical content
+            with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=level or 6, mtime=0) as out:
+                shutil.copyfileobj(src, out, COPY_BUFFER_SIZE)
+        elif encoding == "zstd":
+            compressor = zstandard.ZstdCompressor(level=level or 3)
+            compressor.copy_stream(src, dst, size=os.fstat(src.fileno()).st_size)
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+    return os.path.getsize(target)
+
+
+def open_blob(path, encoding: str):
+    """Open a stored blob for reading its original bytes."""
+    if encoding == "gzip":
+        return gzip.open(path, "rb")
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is needed to read zstd blobs")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """True if an Accept-Encoding header allows a response in encoding."""
+    if encoding == IDENTITY:
+        return True
+    wildcard = False
+    for item in (accept_encoding or "").split(","):
+        token, _, params = item.strip().partition(";")
+        token = token.strip().lower()
+        quality = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if token == encoding:
+            return quality > 0
+        if token == "*":
+            wildcard = quality > 0
+    return wildcard
+
+
+class _GzipDecoder:
+    """Incremental gzip decoding with bounded output per step."""
+
+    def __init__(self):
+        # wbits=31: gzip container only
+        self._inflater = zlib.decompressobj(31)
+
+    @property
+    def eof(self) -> bool:
+        return self._inflater.eof
+
+    @property
+    def unused_data(self) -> bytes:
+        return self._inflater.unused_data
+
+    def decompress(self, data: bytes, max_length: int):
+        """Yield data's output in pieces of at most max_length bytes."""
+        while not self._inflater.eof:
+            out = self._inflater.decompress(data, max_length)
+            data = self._inflater.unconsumed_tail
+            if out:
+                yield out
+            # A full piece may leave output pending even with no input left
+            if not data and len(out) < max_length:
+                break
+
+
+class _ZstdDecoder:
+    """Incremental zstd decoding with bounded output per step.
+
+    zstandard's decompressobj has no max_length, so input is fed
+    ZSTD_FEED_SIZE bytes at a time: a block decodes to at most 128 KiB and
+    takes at least 4 bytes, so each step yields at most 4 MiB.
+    """
+
+    def __init__(self):
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self.unused_data = b""
+
+    @property
+    def eof(self) -> bool:
+        return self._decompressor.eof
+
+    def decompress(self, data: bytes, max_length: int):
+        """Yield data's output a step at a time (max_length is implied by ZSTD_FEED_SIZE)."""
+        view = memoryview(data)
+        for start in range(0, len(view), ZSTD_FEED_SIZE):
+            if self._decompressor.eof:
+                self.unused_data = self._decompressor.unused_data + bytes(view[start:])
+                return
+            out = self._decompressor.decompress(view[start:start + ZSTD_FEED_SIZE])
+            if out:
+                yield out
+        if self._decompressor.eof:
+            self.unused_data = self._decompressor.unused_data
+
+
+def stream_decoder(encoding: str):
+    """Incremental decoder for an upload body sent with this Content-Encoding.
+
+    Returns None for identity and raises ValueError for an encoding not
+    in UPLOAD_ENCODINGS. The decoder's decompress(data, max_length) yields
+    the output a bounded piece at a time, so a small compressed body can't
+    inflate into memory all at once; it also has eof and unused_data.
+    """
+    encoding = (encoding or IDENTITY).strip().lower()
+    if encoding == IDENTITY:
+        return None
+    if encoding not in UPLOAD_ENCODINGS:
+        raise ValueError(f"Unsupported encoding: {encoding}")
+    if encoding == "gzip":
+        return _GzipDecoder()
+    return _ZstdDecoder()
@@ -1,5 +1,24 @@
+import logging
+import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Optional
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# Connection pool tuning (see deploy/env.example)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_BUSY_RETRIES = int(os.getenv("DB_BUSY_RETRIES", "5"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
 
 
 def get_db_path() -> Path:
@@ -15,6 +34,10 @@ def init_db():
     conn = sqlite3.connect(str(db_path))
     cursor = conn.cursor()
 
+    # WAL is persistent in the database file, so setting it once here covers
+    # every connection opened afterwards (readers no longer block the writer)
+    cursor.execute("PRAGMA journal_mode=WAL")
+
     # Create devices table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS devices (
@@ -30,7 +53,7 @@ def init_db():
             ssh_provisioned INTEGER DEFAULT 0
         )
     """)
-    
+
     # Add ssh_provisioned column if it doesn't exist (for existing databases)
     try:
         cursor.execute("ALTER TABLE devices ADD COLUMN ssh_provisioned INTEGER DEFAULT 0")
@@ -47,19 +70,477 @@ def init_db():
             bytes INTEGER NOT NULL,
             sha256 TEXT NOT NULL,
             uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            stored_bytes INTEGER,
             FOREIGN KEY (serial) REFERENCES devices(serial)
         )
     """)
 
+    # Content-addressed blob store: one row per distinct file content,
+    # reference-counted by the handshakes rows that point at it. bytes is
+    # the content's size, stored_bytes its size on disk after compression
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            bytes INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            stored_bytes INTEGER,
+            encoding TEXT NOT NULL DEFAULT 'identity'
+        )
+    """)
+
+    # Add at-rest compression columns (for existing databases); everything
+    # stored before them is uncompressed
+    for table in ("handshakes", "blobs"):
+        try:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN stored_bytes INTEGER")
+            cursor.execute(f"UPDATE {table} SET stored_bytes = bytes")
+        except sqlite3.OperationalError:
+            # Column already exists, ignore
+            pass
+    try:
+        cursor.execute("ALTER TABLE blobs ADD COLUMN encoding TEXT NOT NULL DEFAULT 'identity'")
+    except sqlite3.OperationalError:
+        # Column already exists, ignore
+        pass
+
+    # Dedup lookup for re-uploads of the same capture by the same device
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_handshakes_serial_sha256
+        ON handshakes (serial, sha256)
+    """)
+
+    # Keyset pagination on (uploaded_at, id), globally and per device,
+    # plus sha256 lookups across devices
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_handshakes_uploaded_at_id
+        ON handshakes (uploaded_at, id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_handshakes_serial_uploaded_at_id
+        ON handshakes (serial, uploaded_at, id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_handshakes_sha256
+        ON handshakes (sha256)
+    """)
+
+    # Per-device storage aggregates, kept current by triggers on handshakes
+    # so readers never have to scan it
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS device_stats (
+            serial TEXT PRIMARY KEY,
+            handshake_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            oldest_upload TIMESTAMP,
+            newest_upload TIMESTAMP,
+            total_stored_bytes INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Databases from before at-rest compression: add the stored total and
+    # replace the triggers below with versions that maintain it
+    try:
+        cursor.execute("ALTER TABLE device_stats ADD COLUMN total_stored_bytes INTEGER NOT NULL DEFAULT 0")
+        for event in ("insert", "delete", "update"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS trg_handshakes_stats_{event}")
+        cursor.execute("""
+            UPDATE device_stats SET total_stored_bytes = (
+                SELECT COALESCE(SUM(stored_bytes), 0) FROM handshakes h WHERE h.serial = device_stats.serial
+            )
+        """)
+    except sqlite3.OperationalError:
+        # Column already exists, ignore
+        pass
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_handshakes_stats_insert
+        AFTER INSERT ON handshakes
+        BEGIN
+            INSERT INTO device_stats (serial, handshake_count, total_bytes, oldest_upload, newest_upload,
+                                      total_stored_bytes)
+            VALUES (NEW.serial, 1, NEW.bytes, NEW.uploaded_at, NEW.uploaded_at,
+                    COALESCE(NEW.stored_bytes, NEW.bytes))
+            ON CONFLICT(serial) DO UPDATE SET
+                handshake_count = handshake_count + 1,
+                total_bytes = total_bytes + excluded.total_bytes,
+                total_stored_bytes = total_stored_bytes + excluded.total_stored_bytes,
+                oldest_upload = COALESCE(MIN(oldest_upload, excluded.oldest_upload), excluded.oldest_upload),
+                newest_upload = COALESCE(MAX(newest_upload, excluded.newest_upload), excluded.newest_upload);
+        END
+    """)
+    # Oldest/newest only need a lookup (on the serial, uploaded_at index)
+    # when the deleted row was the boundary
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_handshakes_stats_delete
+        AFTER DELETE ON handshakes
+        BEGIN
+            UPDATE device_stats SET
+                handshake_count = handshake_count - 1,
+                total_bytes = total_bytes - OLD.bytes,
+                total_stored_bytes = total_stored_bytes - COALESCE(OLD.stored_bytes, OLD.bytes),
+                oldest_upload = CASE WHEN OLD.uploaded_at <= oldest_upload
+                    THEN (SELECT MIN(uploaded_at) FROM handshakes WHERE serial = OLD.serial)
+                    ELSE oldest_upload END,
+                newest_upload = CASE WHEN OLD.uploaded_at >= newest_upload
+                    THEN (SELECT MAX(uploaded_at) FROM handshakes WHERE serial = OLD.serial)
+                    ELSE newest_upload END
+            WHERE serial = OLD.serial;
+        END
+    """)
+    # Rows are practically never updated; just recompute both devices
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_handshakes_stats_update
+        AFTER UPDATE OF serial, bytes, stored_bytes, uploaded_at ON handshakes
+        BEGIN
+            INSERT OR REPLACE INTO device_stats (serial, handshake_count, total_bytes, oldest_upload, newest_upload,
+                                                 total_stored_bytes)
+            SELECT serial, COUNT(*), COALESCE(SUM(bytes), 0), MIN(uploaded_at), MAX(uploaded_at),
+                   COALESCE(SUM(COALESCE(stored_bytes, bytes)), 0)
+            FROM handshakes WHERE serial IN (OLD.serial, NEW.serial)
+            GROUP BY serial;
+            DELETE FROM device_stats
+            WHERE serial = OLD.serial AND NOT EXISTS (SELECT 1 FROM handshakes WHERE serial = OLD.serial);
+        END
+    """)
+    # Backfill databases created before device_stats existed
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM device_stats)")
+    if not cursor.fetchone()[0]:
+        cursor.execute("""
+            INSERT INTO device_stats (serial, handshake_count, total_bytes, oldest_upload, newest_upload,
+                                      total_stored_bytes)
+            SELECT serial, COUNT(*), COALESCE(SUM(bytes), 0), MIN(uploaded_at), MAX(uploaded_at),
+                   COALESCE(SUM(COALESCE(stored_bytes, bytes)), 0)
+            FROM handshakes GROUP BY serial
+        """)
+
+    # Change counters for cached views. Bumped by triggers, so writes from
+    # any worker process invalidate every worker's cached copy
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('devices', 0)")
+    for table in ("devices", "device_stats"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE data_versions SET version = version + 1 WHERE name = 'devices';
+                END
+            """)
+
+    # Leases for background jobs that must run on only one worker at a time
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS job_locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+
+    # Resumable uploads in progress (see app/resumable.py); kept in the
+    # database so any worker can accept the next chunk
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            serial TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            start INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            PRIMARY KEY (upload_id, start)
+        ) WITHOUT ROWID
+    """)
+
+    # Device backup jobs (see app/backups.py). last_id is the highest
+    # handshakes.id a completed backup covers; the next one starts after it
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS backup_jobs (
+            id TEXT PRIMARY KEY,
+            serial TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            base_id TEXT,
+            since_id INTEGER NOT NULL DEFAULT 0,
+            last_id INTEGER,
+            files INTEGER NOT NULL DEFAULT 0,
+            files_total INTEGER,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            archive TEXT,
+            archive_bytes INTEGER,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            updated_at REAL NOT NULL,
+            finished_at REAL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_backup_jobs_serial_created
+        ON backup_jobs (serial, created_at)
+    """)
+
     conn.commit()
     conn.close()
     return db_path
 
 
-def get_conn():
-    """Get a database connection."""
-    db_path = get_db_path()
-    return sqlite3.connect(str(db_path), check_same_thread=False)
+def is_busy_error(exc: Exception) -> bool:
+    """Return True if exc is SQLite reporting a locked/busy database."""
+    if not isinstance(exc, sqlite3.OperationalError):
+        return False
+    message = str(exc).lower()
+    return "locked" in message or "busy" in message
+
+
+def get_data_version(conn: sqlite3.Connection, name: str) -> int:
+    """Current change counter for a cached view (see data_versions)."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT version FROM data_versions WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def acquire_lease(conn: sqlite3.Connection, name: str, owner: str, ttl: float) -> bool:
+    """Take the named job lease for ttl seconds unless another owner holds a live one.
+
+    Works across processes sharing the database, so only one uvicorn
+    worker runs a given background job at a time.
+    """
+    now = time.time()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO job_locks (name, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE job_locks.expires_at < ? OR job_locks.owner = excluded.owner
+    """, (name, owner, now + ttl, now))
+    acquired = cursor.rowcount == 1
+    conn.commit()
+    return acquired
+
+
+def renew_lease(conn: sqlite3.Connection, name: str, owner: str, ttl: float) -> bool:
+    """Extend a lease we hold; False if it expired and was taken over."""
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE job_locks SET expires_at = ? WHERE name = ? AND owner = ?",
+        (time.time() + ttl, name, owner)
+    )
+    renewed = cursor.rowcount == 1
+    conn.commit()
+    return renewed
+
+
+def release_lease(conn: sqlite3.Connection, name: str, owner: str):
+    """Give up a lease we hold."""
+    conn.execute("DELETE FROM job_locks WHERE name = ? AND owner = ?", (name, owner))
+    conn.commit()
+
+
+def get_lease(conn: sqlite3.Connection, name: str) -> Optional[dict]:
+    """Current holder of a lease, or None if it's free."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT owner, expires_at FROM job_locks WHERE name = ? AND expires_at >= ?",
+                   (name, time.time()))
+    row = cursor.fetchone()
+    return {"owner": row[0], "expires_at": row[1]} if row else None
+
+
+class ConnectionPool:
+    """Bounded pool of pre-opened, pre-configured SQLite connections.
+
+    Connections are opened once at startup with WAL-friendly pragmas and a
+    per-connection prepared-statement cache, then checked out and returned
+    for each request instead of being reopened every time.
+    """
+
+    def __init__(self, db_path: Path, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=self.size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # Metrics
+        self.checkouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+        self.busy_retries = 0
+        self.busy_failures = 0
+
+        for _ in range(self.size):
+            self._idle.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection and apply the performance pragmas."""
+        conn = sqlite3.connect(
+            str(self.db_path),
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        # Negative cache_size is in KiB rather than pages
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Check out a connection, waiting up to the pool timeout."""
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"Timed out after {self.timeout}s waiting for a database connection")
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool, discarding any open transaction."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Broken connection, replace it with a fresh one
+            conn.close()
+            conn = self._connect()
+        with self._lock:
+            self.in_use -= 1
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks out a connection and returns it afterwards."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def run_with_retry(self, conn: sqlite3.Connection, func, *args, **kwargs):
+        """Call func(conn, ...), retrying with backoff while SQLite reports the database busy.
+
+        busy_timeout already covers short waits inside SQLite; this catches
+        the cases it can't (e.g. a read transaction upgraded to a write).
+        The transaction is rolled back before each retry, so func must be a
+        complete unit of work that commits its own changes.
+        """
+        delay = 0.01
+        for attempt in range(DB_BUSY_RETRIES + 1):
+            try:
+                return func(conn, *args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e):
+                    raise
+                if conn.in_transaction:
+                    conn.rollback()
+                if attempt == DB_BUSY_RETRIES:
+                    with self._lock:
+                        self.busy_failures += 1
+                    raise
+                with self._lock:
+                    self.busy_retries += 1
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+
+    def stats(self) -> dict:
+        """Snapshot of pool metrics."""
+        with self._lock:
+            return {
+                "size": self.size,
+                "idle": self._idle.qsize(),
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "checkouts": self.checkouts,
+                "wait_time_total_ms": round(self.wait_time_total * 1000, 3),
+                "wait_time_avg_ms": round(self.wait_time_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                "wait_time_max_ms": round(self.wait_time_max * 1000, 3),
+                "timeouts": self.timeouts,
+                "busy_retries": self.busy_retries,
+                "busy_failures": self.busy_failures,
+            }
+
+    def close(self):
+        """Close all idle connections; checked-out ones are closed on release."""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool: Optional[ConnectionPool] = None
+
+
+def init_pool(db_path: Path) -> ConnectionPool:
+    """Create the process-wide connection pool. Called once at startup."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+    _pool = ConnectionPool(db_path)
+    logger.info(f"Database pool ready: {_pool.size} connections to {db_path}")
+    return _pool
+
+
+def get_pool() -> ConnectionPool:
+    """Get the process-wide connection pool, creating it on first use."""
+    if _pool is None:
+        return init_pool(init_db())
+    return _pool
+
+
+def close_pool():
+    """Close the process-wide connection pool."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+
+def get_db():
+    """FastAPI dependency yielding a pooled database connection."""
+    pool = get_pool()
+    try:
+        conn = pool.acquire()
+    except TimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
 
 
 def get_handshake_storage_path() -> Path:
@@ -75,3 +556,9 @@ def get_backup_storage_path() -> Path:
     storage_dir.mkdir(parents=True, exist_ok=True)
     return storage_dir / "backups"
 
+
+def get_blob_storage_path() -> Path:
+    """Get the content-addressed blob storage path. Uses /srv/pwnhub in Docker, ./storage locally."""
+    storage_dir = Path("/srv/pwnhub") if Path("/srv/pwnhub").exists() else Path("./storage")
+    storage_dir.mkdir(parents=True, exist_ok=True)
+    return storage_dir / "blobs"
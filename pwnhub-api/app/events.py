@@ -0,0 +1,119 @@
+"""In-process pub/sub for dashboard change events, served over SSE.
+
+Each subscriber gets a bounded queue of pending events. Events published
+with a coalescing key replace the pending event with the same key, so a
+slow client sees the latest heartbeat per device instead of a backlog.
+A client that still falls too far behind gets its queue dropped and a
+single "resync" event telling it to reload the device list.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Pending events per client before it is told to resync (see deploy/env.example)
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "256"))
+# Comment line sent on idle streams so proxies don't time them out
+EVENTS_KEEPALIVE_SECONDS = float(os.getenv("EVENTS_KEEPALIVE_SECONDS", "15"))
+# Streams are closed after this long and the browser reconnects; keeps
+# shutdowns and proxy connection limits from waiting on idle dashboards
+EVENTS_MAX_STREAM_SECONDS = float(os.getenv("EVENTS_MAX_STREAM_SECONDS", "60"))
+
+
+class Subscription:
+    """One client's bounded, coalescing queue. Only touched on the event loop."""
+
+    def __init__(self, maxsize: int = EVENTS_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self._pending = OrderedDict()
+        self._wakeup = asyncio.Event()
+
+    def put(self, key, message: tuple):
+        if key in self._pending:
+            # Latest wins, delivered in the position of the newest update
+            del self._pending[key]
+        elif len(self._pending) >= self.maxsize:
+            self._pending.clear()
+            self._pending[("resync",)] = (message[0], "resync", "{}")
+            self._wakeup.set()
+            return
+        self._pending[key] = message
+        self._wakeup.set()
+
+    async def get(self, timeout: float) -> list:
+        """Wait up to timeout for events; returns every pending (id, event, data)."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._wakeup.clear()
+        messages = list(self._pending.values())
+        self._pending.clear()
+        return messages
+
+
+class EventHub:
+    """Fan-out of published events to every subscribed client.
+
+    publish() may be called from the event loop or from worker threads
+    (retention, the I/O pool); delivery always happens on the loop.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def has_subscribers(self) -> bool:
+        """Cheap check so publishers can skip building payloads nobody reads."""
+        return bool(self._subscribers)
+
+    def subscribe(self) -> Subscription:
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription()
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+
+    def publish(self, event: str, data: dict, key=None):
+        """Queue event for every subscriber; events with the same key coalesce."""
+        if not self._subscribers or self._loop is None:
+            return
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        # Serialized once here, not once per subscriber
+        message = (seq, event, json.dumps(data))
+        key = (event, key) if key is not None else (event, seq)
+        try:
+            if asyncio.get_running_loop() is self._loop:
+                self._dispatch(key, message)
+                return
+        except RuntimeError:
+            pass
+        try:
+            self._loop.call_soon_threadsafe(self._dispatch, key, message)
+        except RuntimeError:
+            # Loop already closed during shutdown
+            pass
+
+    def _dispatch(self, key, message: tuple):
+        for subscription in list(self._subscribers):
+            subscription.put(key, message)
+
+
+event_hub = EventHub()
+
+
+def format_sse(messages: list) -> str:
+    """Encode (id, event, data) tuples as one Server-Sent Events chunk."""
+    return "".join(f"id: {seq}\nevent: {event}\ndata: {data}\n\n" for seq, event, data in messages)
@@ -0,0 +1,178 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+from app.database import get_pool
+
+logger = logging.getLogger(__name__)
+
+# Executor sizing (see deploy/env.example)
+IO_THREADS = int(os.getenv("IO_THREADS", "16"))
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(max(1, min(4, os.cpu_count() or 1)))))
+LOOP_LAG_INTERVAL_MS = int(os.getenv("LOOP_LAG_INTERVAL_MS", "50"))
+
+_io_executor: Optional[ThreadPoolExecutor] = None
+_cpu_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_io_executor() -> ThreadPoolExecutor:
+    """Thread pool for blocking database and disk work."""
+    global _io_executor
+    with _executor_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="pwnhub-io")
+        return _io_executor
+
+
+def get_cpu_executor() -> ProcessPoolExecutor:
+    """Process pool for CPU-heavy work such as hashing and compression."""
+    global _cpu_executor
+    with _executor_lock:
+        if _cpu_executor is None:
+            # spawn rather than fork: the parent is multi-threaded (uvicorn,
+            # the I/O pool, pooled sqlite connections)
+            _cpu_executor = ProcessPoolExecutor(
+                max_workers=CPU_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _cpu_executor
+
+
+def shutdown_executors():
+    """Shut down both executors, waiting for in-flight work."""
+    global _io_executor, _cpu_executor
+    with _executor_lock:
+        if _io_executor is not None:
+            _io_executor.shutdown(wait=True)
+            _io_executor = None
+        if _cpu_executor is not None:
+            _cpu_executor.shutdown(wait=True)
+            _cpu_executor = None
+
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking function on the I/O thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_io_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def run_cpu(func, *args):
+    """Run a CPU-bound, picklable top-level function on the process pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_cpu_executor(), func, *args)
+
+
+def _run_db_sync(func, args, kwargs):
+    pool = get_pool()
+    with pool.connection() as conn:
+        return pool.run_with_retry(conn, func, *args, **kwargs)
+
+
+async def run_db(func, *args, **kwargs):
+    """Run func(conn, ...) on the I/O thread pool with a short-lived pooled connection.
+
+    Used by routes that do long non-database work (uploads, subprocesses,
+    archiving) so they don't pin a pooled connection for the whole request.
+    """
+    return await run_io(_run_db_sync, func, args, kwargs)
+
+
+async def run_subprocess(args: list, timeout: float) -> tuple:
+    """Run a subprocess without blocking the loop; returns (returncode, stdout, stderr).
+
+    Raises asyncio.TimeoutError (after killing the process) on timeout.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+
+class LoopLagProbe:
+    """Measures event loop lag while a single request is in flight.
+
+    A timer is re-armed every interval; how late it fires is the lag. On
+    stop, the overdue time of the pending timer is counted too, so a
+    handler that blocks the loop until it returns is still caught.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.max_lag = 0.0
+        self._due = self.loop.time() + interval
+        self._handle = self.loop.call_at(self._due, self._tick)
+
+    def _tick(self):
+        now = self.loop.time()
+        self.max_lag = max(self.max_lag, now - self._due)
+        self._due = now + self.interval
+        self._handle = self.loop.call_at(self._due, self._tick)
+
+    def stop(self) -> float:
+        """Cancel the probe and return the max lag observed, in seconds."""
+        self._handle.cancel()
+        self.max_lag = max(self.max_lag, self.loop.time() - self._due)
+        return self.max_lag
+
+
+class LoopLagStats:
+    """Per-route aggregate of event loop lag observed during requests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route: str, lag: float):
+        with self._lock:
+            stats = self._routes.setdefault(route, {"requests": 0, "lag_total": 0.0, "lag_max": 0.0})
+            stats["requests"] += 1
+            stats["lag_total"] += lag
+            stats["lag_max"] = max(stats["lag_max"], lag)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                route: {
+                    "requests": stats["requests"],
+                    "lag_avg_ms": round(stats["lag_total"] * 1000 / stats["requests"], 3),
+                    "lag_max_ms": round(stats["lag_max"] * 1000, 3),
+                }
+                for route, stats in self._routes.items()
+            }
+
+
+loop_lag_stats = LoopLagStats()
+
+
+class LoopLagMiddleware:
+    """ASGI middleware recording loop lag per route template, body streaming included."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        probe = LoopLagProbe()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # The router stores the matched route in scope; group unmatched
+            # paths together so stray URLs can't grow the table unbounded
+            route = scope.get("route")
+            loop_lag_stats.record(getattr(route, "path", "<unmatched>"), probe.stop())
@@ -0,0 +1,334 @@
+"""Fleet sync: pull handshakes from every provisioned device over SSH.
+
+For each device with ssh_provisioned set and a last_ip, one SSH command
+lists the capture files in the device's handshake directory with their
+sha256. Files the device already has on the hub are skipped; files whose
+content the hub holds for another device are recorded without being
+transferred (as POST /api/handshakes/check does); only the rest are
+pulled, streamed from `cat` on the device into the blob staging area and
+stored through ingest_handshake like an upload.
+
+Devices are synced SYNC_CONCURRENCY at a time, each within
+SYNC_DEVICE_TIMEOUT seconds. The default SSH command multiplexes one
+connection per device. SYNC_SSH_COMMAND (or --ssh-command) replaces it,
+e.g. with a local stand-in for testing; it is called like ssh, with
+user@host and the remote command as its last two arguments.
+
+    python -m app.fleet_sync [--serial S ...] [--concurrency N] [--timeout S] [--json]
+
+Runs hold the "fleet-sync" job lease, so overlapping cron runs skip.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import shlex
+import socket
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+from app.database import acquire_lease, close_pool, get_blob_storage_path, get_pool, init_db, init_pool, release_lease
+from app.executors import run_db, run_io, shutdown_executors
+from app.storage import blob_temp_dir, ingest_handshake, link_handshake_tx, publish_handshake_event
+from app.uploads import HashingFileWriter
+
+logger = logging.getLogger(__name__)
+
+# Parallelism and time limits (see deploy/env.example)
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", "4"))
+SYNC_DEVICE_TIMEOUT = float(os.getenv("SYNC_DEVICE_TIMEOUT", "600"))
+SYNC_CONNECT_TIMEOUT = int(os.getenv("SYNC_CONNECT_TIMEOUT", "10"))
+# Where captures are on the devices and how to reach them
+SYNC_SSH_USER = os.getenv("SYNC_SSH_USER", "pi")
+SYNC_REMOTE_PATH = os.getenv("SYNC_REMOTE_PATH", "/root/handshakes")
+SYNC_SUDO = os.getenv("SYNC_SUDO", "true").lower() == "true"
+SYNC_SSH_COMMAND = os.getenv("SYNC_SSH_COMMAND", "")
+
+SYNC_LOCK_NAME = "fleet-sync"
+SYNC_LOCK_TTL = 300
+CAPTURE_EXTENSIONS = (".cap", ".pcap", ".hccapx")
+PULL_READ_SIZE = 256 * 1024
+
+IP_PATTERN = re.compile(r"^(\d{1,3}\.){3}\d{1,3}$")
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+MB = 1024 * 1024
+
+
+def ssh_key_path() -> Path:
+    return get_blob_storage_path().parent / "keys" / "pwnhub_id_ed25519"
+
+
+def default_ssh_command(control_dir: str) -> list:
+    """ssh with the hub key, no prompts, and one shared connection per device."""
+    return [
+        "ssh", "-i", str(ssh_key_path()),
+        "-o", "BatchMode=yes",
+        "-o", "StrictHostKeyChecking=accept-new",
+        "-o", f"ConnectTimeout={SYNC_CONNECT_TIMEOUT}",
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={control_dir}/%C",
+        "-o", "ControlPersist=30",
+    ]
+
+
+def _remote_path(path: str) -> str:
+    """Shell-quote path, leaving a leading ~/ for the remote shell to expand."""
+    if path.startswith("~/"):
+        return '"$HOME"/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+def _remote_shell(script: str, sudo: bool) -> str:
+    return f"sudo -n sh -c {shlex.quote(script)}" if sudo else script
+
+
+def list_command(remote_path: str, sudo: bool) -> str:
+    """Remote command printing `sha256  ./name` for each capture file."""
+    names = " -o ".join(f"-iname '*{extension}'" for extension in CAPTURE_EXTENSIONS)
+    script = (f"cd {_remote_path(remote_path)} && "
+              f"find . -maxdepth 1 -type f \\( {names} \\) -exec sha256sum {{}} +")
+    return _remote_shell(script, sudo)
+
+
+def pull_command(remote_path: str, name: str, sudo: bool) -> str:
+    return _remote_shell(f"cd {_remote_path(remote_path)} && cat -- {shlex.quote('./' + name)}", sudo)
+
+
+def parse_listing(output: str) -> list:
+    """(sha256, filename) pairs from sha256sum output, skipping anything odd."""
+    files = []
+    for line in output.splitlines():
+        sha256, _, name = line.partition("  ")
+        name = name[2:] if name.startswith("./") else name
+        sha256 = sha256.lstrip("\\").lower()
+        if SHA256_PATTERN.match(sha256) and name and "/" not in name:
+            files.append((sha256, name))
+    return files
+
+
+def _list_sync_targets(conn, serials: Optional[list]) -> list:
+    """(serial, last_ip) of provisioned devices, optionally only the given serials."""
+    query = "SELECT serial, last_ip FROM devices WHERE ssh_provisioned = 1 AND last_ip IS NOT NULL"
+    params = []
+    if serials:
+        query += f" AND serial IN ({', '.join('?' for _ in serials)})"
+        params = list(serials)
+    cursor = conn.cursor()
+    cursor.execute(query + " ORDER BY serial", params)
+    return cursor.fetchall()
+
+
+class FleetSync:
+    """One sync run across the fleet."""
+
+    def __init__(self, ssh_command: list, user: str = SYNC_SSH_USER, remote_path: str = SYNC_REMOTE_PATH,
+                 sudo: bool = SYNC_SUDO, concurrency: int = SYNC_CONCURRENCY,
+                 device_timeout: float = SYNC_DEVICE_TIMEOUT):
+        self.ssh_command = ssh_command
+        self.user = user
+        self.remote_path = remote_path
+        self.sudo = sudo
+        self.concurrency = max(1, concurrency)
+        self.device_timeout = device_timeout
+
+    def _argv(self, ip: str, command: str) -> list:
+        return [*self.ssh_command, f"{self.user}@{ip}", command]
+
+    async def _run(self, ip: str, command: str) -> str:
+        process = await asyncio.create_subprocess_exec(
+            *self._argv(ip, command), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await process.communicate()
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        if process.returncode != 0:
+            raise RuntimeError(stderr.decode(errors="replace").strip() or f"exit status {process.returncode}")
+        return stdout.decode(errors="replace")
+
+    async def _pull(self, serial: str, ip: str, name: str) -> tuple:
+        """Stream one file from the device into the hub; returns (result, bytes)."""
+        writer = await run_io(HashingFileWriter, blob_temp_dir())
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self._argv(ip, pull_command(self.remote_path, name, self.sudo)),
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                while True:
+                    chunk = await process.stdout.read(PULL_READ_SIZE)
+                    if not chunk:
+                        break
+                    await run_io(writer.write, chunk)
+                stderr = await process.stderr.read()
+                await process.wait()
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+            if process.returncode != 0:
+                raise RuntimeError(stderr.decode(errors="replace").strip() or f"exit status {process.returncode}")
+            size = writer.size
+            return await ingest_handshake(serial, name, writer), size
+        except BaseException:
+            # ingest_handshake cleans up after itself; this covers failures before it
+            await run_io(writer.abort)
+            raise
+
+    async def sync_device(self, serial: str, ip: str) -> dict:
+        """List, dedup and pull one device's captures."""
+        stats = {
+            "serial": serial, "ip": ip, "listed": 0, "present": 0, "linked": 0,
+            "pulled": 0, "pulled_bytes": 0, "failed": 0, "errors": [],
+        }
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._sync_device(serial, ip, stats), self.device_timeout)
+            stats["status"] = "ok" if not stats["failed"] else "partial"
+        except asyncio.TimeoutError:
+            stats["status"] = "timeout"
+            stats["errors"].append(f"timed out after {self.device_timeout:g} s")
+        except Exception as e:
+            stats["status"] = "failed"
+            stats["errors"].append(str(e))
+        seconds = time.perf_counter() - started
+        stats["seconds"] = round(seconds, 3)
+        stats["mb_per_s"] = round(stats["pulled_bytes"] / MB / seconds, 2) if seconds > 0 else None
+        return stats
+
+    async def _sync_device(self, serial: str, ip: str, stats: dict):
+        if not IP_PATTERN.match(ip):
+            raise ValueError(f"Invalid IP address format: {ip}")
+        files = parse_listing(await self._run(ip, list_command(self.remote_path, self.sudo)))
+        stats["listed"] = len(files)
+        for sha256, name in files:
+            # Known content is recorded without a transfer, as /check does
+            linked = await run_db(link_handshake_tx, serial, name, sha256)
+            if linked is not None:
+                if linked["duplicate"]:
+                    stats["present"] += 1
+                else:
+                    stats["linked"] += 1
+                    await publish_handshake_event(serial, linked)
+                continue
+            try:
+                result, size = await self._pull(serial, ip, name)
+            except RuntimeError as e:
+                stats["failed"] += 1
+                stats["errors"].append(f"{name}: {e}")
+                continue
+            if result["sha256"] != sha256:
+                logger.info(f"{serial}: {name} changed while syncing, stored its current content")
+            stats["pulled"] += 1
+            stats["pulled_bytes"] += size
+
+    async def run(self, targets: list) -> dict:
+        """Sync every (serial, ip) in targets, concurrency devices at a time."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+
+        async def limited(serial: str, ip: str) -> dict:
+            async with semaphore:
+                stats = await self.sync_device(serial, ip)
+                logger.info(
+                    f"{serial}: {stats['status']}, {stats['pulled']} pulled ({stats['pulled_bytes']} bytes, "
+                    f"{stats['mb_per_s']} MB/s), {stats['linked']} linked, {stats['present']} already present"
+                )
+                return stats
+
+        devices = await asyncio.gather(*(limited(serial, ip) for serial, ip in targets))
+        seconds = time.perf_counter() - started
+        pulled_bytes = sum(device["pulled_bytes"] for device in devices)
+        return {
+            "devices": devices,
+            "total": {
+                "devices": len(devices),
+                "ok": sum(1 for device in devices if device["status"] == "ok"),
+                "pulled": sum(device["pulled"] for device in devices),
+                "pulled_bytes": pulled_bytes,
+                "linked": sum(device["linked"] for device in devices),
+                "present": sum(device["present"] for device in devices),
+                "failed": sum(device["failed"] for device in devices),
+                "seconds": round(seconds, 3),
+                "mb_per_s": round(pulled_bytes / MB / seconds, 2) if seconds > 0 else None,
+            },
+        }
+
+
+async def sync_fleet(serials: Optional[list] = None, ssh_command: Optional[list] = None, **options) -> Optional[dict]:
+    """Sync the fleet under the fleet-sync lease; None if another run holds it."""
+    pool = get_pool()
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    # Long runs outlive the TTL; only overlapping starts need to be kept apart
+    ttl = max(SYNC_LOCK_TTL, options.get("device_timeout", SYNC_DEVICE_TIMEOUT) * 2)
+    if not await run_db(acquire_lease, SYNC_LOCK_NAME, owner, ttl):
+        return None
+    try:
+        targets = await run_db(_list_sync_targets, serials)
+        with tempfile.TemporaryDirectory(prefix="pwnhub-ssh-") as control_dir:
+            if ssh_command is None:
+                ssh_command = shlex.split(SYNC_SSH_COMMAND) if SYNC_SSH_COMMAND else default_ssh_command(control_dir)
+            return await FleetSync(ssh_command, **options).run(targets)
+    finally:
+        with pool.connection() as conn:
+            pool.run_with_retry(conn, release_lease, SYNC_LOCK_NAME, owner)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.fleet_sync",
+                                     description="Pull handshakes from every provisioned device over SSH.")
+    parser.add_argument("--serial", action="append", help="Only sync this device (repeatable)")
+    parser.add_argument("--concurrency", type=int, default=SYNC_CONCURRENCY)
+    parser.add_argument("--timeout", type=float, default=SYNC_DEVICE_TIMEOUT, help="Seconds allowed per device")
+    parser.add_argument("--user", default=SYNC_SSH_USER)
+    parser.add_argument("--remote-path", default=SYNC_REMOTE_PATH)
+    parser.add_argument("--no-sudo", action="store_true", help="Read the remote path without sudo")
+    parser.add_argument("--ssh-command", help="Command used instead of ssh (see SYNC_SSH_COMMAND)")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    init_pool(init_db())
+    try:
+        report = asyncio.run(sync_fleet(
+            args.serial,
+            ssh_command=shlex.split(args.ssh_command) if args.ssh_command else None,
+            user=args.user,
+            remote_path=args.remote_path,
+            sudo=SYNC_SUDO and not args.no_sudo,
+            concurrency=args.concurrency,
+            device_timeout=args.timeout,
+        ))
+    finally:
+        shutdown_executors()
+        close_pool()
+    if report is None:
+        print("Another fleet sync is running", file=sys.stderr)
+        return 2
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for device in report["devices"]:
+            print(f"{device['serial']} ({device['ip']}): {device['status']}, {device['listed']} files, "
+                  f"{device['pulled']} pulled ({device['pulled_bytes']} bytes in {device['seconds']} s, "
+                  f"{device['mb_per_s']} MB/s), {device['linked']} linked, {device['present']} present, "
+                  f"{device['failed']} failed")
+            for error in device["errors"]:
+                print(f"  {error}")
+        total = report["total"]
+        print(f"Total: {total['ok']}/{total['devices']} devices ok, {total['pulled']} files "
+              f"({total['pulled_bytes']} bytes) pulled in {total['seconds']} s ({total['mb_per_s']} MB/s)")
+    return 0 if all(device["status"] == "ok" for device in report["devices"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
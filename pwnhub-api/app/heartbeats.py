@@ -0,0 +1,244 @@
+"""Heartbeat ingestion buffer.
+
+Heartbeats are merged into an in-memory record per serial and written to
+SQLite by a background flusher in one batched transaction, instead of one
+commit (and fsync) per heartbeat. A heartbeat waits at most
+HEARTBEAT_FLUSH_MS before it is written, or less once HEARTBEAT_FLUSH_MAX
+devices are waiting. Reads of the device list overlay unflushed state, so
+the dashboard never shows an older last_seen than the hub has accepted.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import sqlite3
+import threading
+from typing import Optional
+from app.database import ConnectionPool
+from app.executors import run_io
+
+logger = logging.getLogger(__name__)
+
+# Durability bounds (see deploy/env.example); HEARTBEAT_FLUSH_MS=0 writes
+# every heartbeat before responding
+HEARTBEAT_FLUSH_MS = int(os.getenv("HEARTBEAT_FLUSH_MS", "1000"))
+HEARTBEAT_FLUSH_MAX = int(os.getenv("HEARTBEAT_FLUSH_MAX", "500"))
+
+# Interval suggested to agents in heartbeat replies, 0 = none; with
+# HEARTBEAT_MAX_RATE (heartbeats/second across the fleet) it is stretched
+# as the fleet grows (see deploy/env.example)
+HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "0"))
+HEARTBEAT_MAX_RATE = float(os.getenv("HEARTBEAT_MAX_RATE", "0"))
+
+# DeviceResponse field -> devices column, for everything a heartbeat can set
+HEARTBEAT_COLUMNS = {
+    "last_seen": "last_seen",
+    "last_ip": "last_ip",
+    "hostname": "hostname",
+    "ssh_fingerprint": "ssh_fp",
+    "image_gen": "image_gen",
+    "reported_handshake_count": "handshake_count",
+}
+
+
+def write_heartbeats(conn: sqlite3.Connection, states: list):
+    """Apply merged (serial, state) heartbeats with one executemany (no commit).
+
+    None leaves a column alone.
+    """
+    fields = list(HEARTBEAT_COLUMNS)
+    assignments = ", ".join(
+        f"{column} = COALESCE(?, {column})" for column in HEARTBEAT_COLUMNS.values()
+    )
+    conn.executemany(
+        f"UPDATE devices SET {assignments} WHERE serial = ?",
+        [[state.get(field) for field in fields] + [serial] for serial, state in states]
+    )
+
+
+def _write_heartbeats_tx(conn: sqlite3.Connection, states: list):
+    """Apply merged heartbeat states in one transaction."""
+    write_heartbeats(conn, states)
+    conn.commit()
+
+
+class HeartbeatBuffer:
+    """Latest heartbeat state per serial, flushed to the database in batches."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Fields set by heartbeats since the device last registered
+        self._state = {}
+        self._dirty = set()
+        self._flushing = set()
+        self._known = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self.generation = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def is_known(self, serial: str) -> bool:
+        with self._lock:
+            return serial in self._known
+
+    def mark_known(self, serial: str):
+        with self._lock:
+            self._known.add(serial)
+
+    def suggested_interval(self) -> Optional[int]:
+        """Seconds agents should wait between heartbeats, None to leave it to them.
+
+        The devices seen since startup stand in for the fleet size.
+        """
+        interval = HEARTBEAT_INTERVAL
+        if HEARTBEAT_MAX_RATE > 0:
+            with self._lock:
+                devices = len(self._known)
+            interval = max(interval, math.ceil(devices / HEARTBEAT_MAX_RATE))
+        return interval or None
+
+    def record(self, serial: str, fields: dict) -> dict:
+        """Merge a heartbeat (None = not sent) and return the device's heartbeat fields."""
+        with self._lock:
+            self._known.add(serial)
+            state = self._state.setdefault(serial, {})
+            state.update({key: value for key, value in fields.items() if value is not None})
+            self._dirty.add(serial)
+            self.generation += 1
+            full = len(self._dirty) >= HEARTBEAT_FLUSH_MAX
+            snapshot = {"serial": serial, **state}
+        if full and self._wakeup is not None:
+            self._wakeup.set()
+        return snapshot
+
+    def discard(self, serial: str):
+        """Forget buffered state for serial; register overwrites these columns itself.
+
+        Waits for an in-flight flush so it can't land after the register.
+        Blocking.
+        """
+        with self._flush_lock, self._lock:
+            self._state.pop(serial, None)
+            self._dirty.discard(serial)
+            self.generation += 1
+
+    def state(self, serial: str) -> dict:
+        """Heartbeat fields known for serial, as sent in heartbeat events."""
+        with self._lock:
+            return {"serial": serial, **self._state.get(serial, {})}
+
+    def forget(self, serials):
+        """Drop buffered state for serials that turned out not to exist."""
+        with self._lock:
+            for serial in serials:
+                self._state.pop(serial, None)
+                self._dirty.discard(serial)
+                self._known.discard(serial)
+
+    def write_through(self, pool: ConnectionPool, reset: list, heartbeats: list, tx):
+        """Write some heartbeats now, in a caller-supplied transaction. Blocking.
+
+        Buffered state for the serials in reset is dropped first (they are
+        being re-registered by tx). Each (serial, fields) in heartbeats is
+        merged into the buffer as record() would, and tx(conn, states) is
+        run with the merged [(serial, state)] so nothing older can be
+        flushed over it. Returns what tx returns.
+        """
+        with self._flush_lock:
+            with self._lock:
+                for serial in reset:
+                    self._state.pop(serial, None)
+                    self._dirty.discard(serial)
+                states = {}
+                for serial, fields in heartbeats:
+                    state = self._state.setdefault(serial, {})
+                    state.update({key: value for key, value in fields.items() if value is not None})
+                    states[serial] = dict(state)
+                    self._dirty.discard(serial)
+                self._flushing = set(states)
+                self.generation += 1
+            try:
+                with pool.connection() as conn:
+                    return pool.run_with_retry(conn, tx, list(states.items()))
+            except Exception:
+                with self._lock:
+                    self._dirty |= set(states)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = set()
+
+    def overlay(self, devices: list) -> list:
+        """Copy of device dicts with unflushed heartbeat state applied."""
+        with self._lock:
+            pending = {
+                serial: dict(self._state[serial])
+                for serial in self._dirty | self._flushing
+                if serial in self._state
+            }
+        if not pending:
+            return devices
+        return [{**device, **pending[device["serial"]]} if device["serial"] in pending else device
+                for device in devices]
+
+    def flush(self, pool: ConnectionPool) -> int:
+        """Write every dirty device in one transaction; returns rows written. Blocking."""
+        with self._flush_lock:
+            with self._lock:
+                serials, self._dirty = self._dirty, set()
+                self._flushing = serials
+                states = [(serial, dict(self._state.get(serial, {}))) for serial in serials]
+            try:
+                if states:
+                    with pool.connection() as conn:
+                        pool.run_with_retry(conn, _write_heartbeats_tx, states)
+                    self.flushes += 1
+                    self.flushed_rows += len(states)
+            except Exception:
+                with self._lock:
+                    # Retry on the next flush
+                    self._dirty |= serials
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = set()
+            return len(states)
+
+    async def run_flusher(self, pool: ConnectionPool):
+        """Flush every HEARTBEAT_FLUSH_MS, or early once HEARTBEAT_FLUSH_MAX devices are dirty.
+
+        With HEARTBEAT_FLUSH_MS=0 heartbeats are written by the request
+        itself, so this only wakes when HEARTBEAT_FLUSH_MAX is reached.
+        """
+        self._wakeup = asyncio.Event()
+        # None: no timeout, wait for a wakeup only
+        interval = HEARTBEAT_FLUSH_MS / 1000 if HEARTBEAT_FLUSH_MS > 0 else None
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._dirty:
+                try:
+                    await run_io(self.flush, pool)
+                except Exception as e:
+                    logger.error(f"Error flushing heartbeats: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._dirty),
+                "flushing": len(self._flushing),
+                "tracked_devices": len(self._state),
+                "flushes": self.flushes,
+                "flushed_rows": self.flushed_rows,
+                "flush_interval_ms": HEARTBEAT_FLUSH_MS,
+                "flush_max": HEARTBEAT_FLUSH_MAX,
+                "known_devices": len(self._known),
+            }
+
+
+heartbeat_buffer = HeartbeatBuffer()
@@ -0,0 +1,529 @@
+"""Hub-wide backups.
+
+A hub backup is a snapshot directory under HUB_BACKUP_DIR:
+
+    <YYYYMMDD_HHMMSS>/
+        pwnhub.db             online copy of the database
+        blobs/<aa>/<sha256>   every blob that copy refers to
+        keys/                 the hub's SSH keys
+        manifest.json         what was copied and verified, and how fast
+
+The database is copied first with SQLite's online backup API in a single
+step, i.e. under one read transaction: the copy is consistent and, with
+WAL, writers carry on while it is taken. The blob list is then read
+from the copy, so the files always match the database they belong to.
+
+Blobs are immutable and named by content, so a snapshot hardlinks every
+blob the previous one already holds and only copies new ones, hashing
+each copy against handshakes.sha256. Every snapshot is a complete tree
+that can be restored on its own, while the disk holds each blob once;
+rotating out old snapshots (HUB_BACKUP_KEEP) frees only the blobs no
+newer snapshot links to.
+
+Runs hold the "hub-backup" job lease, so the admin endpoint and the CLI
+never run at the same time:
+
+    python -m app.hub_backup [--dest DIR] [--keep N] [--verify-all]
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+from app.compression import IDENTITY, open_blob
+from app.database import (
+    ConnectionPool, acquire_lease, close_pool, get_backup_storage_path, get_blob_storage_path, get_lease,
+    init_db, init_pool, release_lease, renew_lease
+)
+from app.events import event_hub
+from app.storage import blob_path
+
+logger = logging.getLogger(__name__)
+
+# Where snapshots go (default storage/backups/hub), how many are kept and
+# how many blobs are copied at once (see deploy/env.example)
+HUB_BACKUP_DIR = os.getenv("HUB_BACKUP_DIR", "")
+HUB_BACKUP_KEEP = int(os.getenv("HUB_BACKUP_KEEP", "7"))
+HUB_BACKUP_WORKERS = int(os.getenv("HUB_BACKUP_WORKERS", "4"))
+
+HUB_BACKUP_LOCK_TTL = 300
+HUB_BACKUP_LOCK_NAME = "hub-backup"
+
+SNAPSHOT_NAME = re.compile(r"^\d{8}_\d{6}(-\d+)?$")
+DATABASE_FILE = "pwnhub.db"
+MANIFEST_FILE = "manifest.json"
+COPY_BUFFER_SIZE = 1024 * 1024
+# Blob rows handed to the copy workers at a time
+BLOB_BATCH_SIZE = 256
+
+MB = 1024 * 1024
+
+
+def hub_backup_dir() -> Path:
+    return Path(HUB_BACKUP_DIR) if HUB_BACKUP_DIR else get_backup_storage_path() / "hub"
+
+
+def list_snapshots(directory: Path) -> list:
+    """Names of the completed snapshots in directory, oldest first."""
+    if not directory.is_dir():
+        return []
+    return sorted(p.name for p in directory.iterdir() if p.is_dir() and SNAPSHOT_NAME.match(p.name))
+
+
+def read_manifest(snapshot: Path) -> Optional[dict]:
+    try:
+        with open(snapshot / MANIFEST_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _rate(size: int, seconds: float) -> Optional[float]:
+    """MB/s, rounded for reports."""
+    return round(size / MB / seconds, 2) if seconds > 0 else None
+
+
+def _fsync(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_database(pool: ConnectionPool, target: Path) -> dict:
+    """Take an online copy of the hub database at target and check it."""
+    started = time.perf_counter()
+    dst = sqlite3.connect(str(target))
+    try:
+        with pool.connection() as conn:
+            # One step: a single read transaction, so the copy is consistent
+            # and isn't restarted by writes made while it runs
+            conn.backup(dst, pages=-1)
+        # A self-contained file, without a -wal next to it
+        dst.execute("PRAGMA journal_mode=DELETE")
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        dst.close()
+    if check != "ok":
+        raise RuntimeError(f"Database copy failed quick_check: {check}")
+    _fsync(target)
+    seconds = time.perf_counter() - started
+    size = target.stat().st_size
+    return {"bytes": size, "seconds": round(seconds, 3), "mb_per_s": _rate(size, seconds)}
+
+
+def _content_sha256(path: Path, encoding: str) -> str:
+    sha256 = hashlib.sha256()
+    with open_blob(path, encoding) as f:
+        for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _copy_blob(source: Path, target: Path, encoding: str) -> Optional[str]:
+    """Copy a blob file; returns the sha256 of its content if that was computed on the way."""
+    sha256 = hashlib.sha256() if encoding == IDENTITY else None
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        for block in iter(lambda: src.read(COPY_BUFFER_SIZE), b""):
+            dst.write(block)
+            if sha256 is not None:
+                sha256.update(block)
+        dst.flush()
+        os.fsync(dst.fileno())
+    return sha256.hexdigest() if sha256 is not None else None
+
+
+def place_blob(snapshot: Path, previous: Optional[Path], sha256: str, encoding: str,
+               stored_bytes: int, verify_all: bool) -> tuple:
+    """Link or copy one blob into snapshot; returns (action, bytes, verified).
+
+    action is "linked", "copied" or "missing"; verified is None when the
+    content wasn't hashed (a link without verify_all).
+    """
+    relative = Path("blobs") / sha256[:2] / sha256
+    target = snapshot / relative
+    target.parent.mkdir(parents=True, exist_ok=True)
+
+    if previous is not None:
+        linked = previous / relative
+        try:
+            # A different size means the blob was deleted and stored again
+            # with another encoding since the previous snapshot
+            if linked.stat().st_size == stored_bytes:
+                os.link(linked, target)
+                verified = _content_sha256(target, encoding) == sha256 if verify_all else None
+                return "linked", stored_bytes, verified
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # No hardlinks on this filesystem (or too many); copy instead
+            logger.debug(f"Can't link {linked}: {e}")
+
+    try:
+        content_sha256 = _copy_blob(blob_path(sha256), target, encoding)
+    except FileNotFoundError:
+        # Deleted by retention after the database was copied
+        target.unlink(missing_ok=True)
+        return "missing", 0, None
+    if content_sha256 is None:
+        content_sha256 = _content_sha256(target, encoding)
+    return "copied", target.stat().st_size, content_sha256 == sha256
+
+
+def rotate_snapshots(directory: Path, keep: int) -> list:
+    """Delete all but the newest keep snapshots; returns the names removed."""
+    snapshots = list_snapshots(directory)
+    removed = snapshots[:-keep] if keep > 0 else []
+    for name in removed:
+        shutil.rmtree(directory / name)
+    return removed
+
+
+class HubBackupCancelled(Exception):
+    """Raised between batches when a run is asked to stop or loses its lease."""
+
+
+class HubBackupWorker:
+    """Runs hub backups, one at a time across API workers and the CLI.
+
+    run_once() blocks; submit() starts one on the worker's own thread, so
+    a long backup never occupies the shared I/O pool. Progress and the
+    last run's stats are kept in memory for /api/admin/backup/status.
+    """
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pool = None
+        self._state = "idle"
+        self._phase = None
+        self._progress = None
+        self._started = None
+        self._lease_renewed = 0.0
+        self._last_run = None
+        self._last_error = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def submit(self, pool: ConnectionPool, directory: Optional[Path] = None, keep: Optional[int] = None,
+               verify_all: bool = False) -> Optional[Future]:
+        """Claim the lease and start a backup on the worker's own thread; None if one is running.
+
+        Blocks briefly for the lease, so two callers can't both be told
+        their backup started.
+        """
+        if not self._claim(pool):
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pwnhub-hub-backup-run")
+            future = self._executor.submit(self._run_claimed, pool, directory, keep, verify_all)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future: Future):
+        """Log a submitted run that failed.
+
+        A run cancelled before it started (at shutdown) gives up its claim
+        here; its lease is left to expire.
+        """
+        if future.cancelled():
+            with self._lock:
+                self._state = "idle"
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error("Hub backup failed", exc_info=error)
+            with self._lock:
+                self._last_error = str(error)
+
+    def stop(self):
+        """Stop a running backup at its next batch and wait for it; the partial snapshot is removed."""
+        self._stop.set()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def is_running(self) -> bool:
+        with self._lock:
+            return self._state == "running"
+
+    def run_once(self, pool: ConnectionPool, directory: Optional[Path] = None, keep: Optional[int] = None,
+                 verify_all: bool = False) -> Optional[dict]:
+        """Take a snapshot and rotate old ones; returns its manifest, or None if another run holds the lease."""
+        if not self._claim(pool):
+            return None
+        return self._run_claimed(pool, directory, keep, verify_all)
+
+    def _claim(self, pool: ConnectionPool) -> bool:
+        """Mark a run as started here and take the lease; False if either is already taken."""
+        with self._lock:
+            # The lease is ours again if we ask twice, so check locally first
+            if self._state == "running":
+                return False
+            self._state = "running"
+            self._pool = pool
+            self._phase = "database"
+            self._progress = None
+            self._started = time.monotonic()
+            self._lease_renewed = self._started
+        acquired = False
+        try:
+            with pool.connection() as conn:
+                acquired = pool.run_with_retry(conn, acquire_lease, HUB_BACKUP_LOCK_NAME, self.owner,
+                                               HUB_BACKUP_LOCK_TTL)
+        finally:
+            if not acquired:
+                with self._lock:
+                    self._state = "idle"
+                    self._phase = None
+        if not acquired:
+            logger.info("Hub backup already running elsewhere, skipping")
+            return False
+        with self._lock:
+            self._last_error = None
+        return True
+
+    def _run_claimed(self, pool: ConnectionPool, directory: Optional[Path], keep: Optional[int],
+                     verify_all: bool) -> Optional[dict]:
+        manifest = None
+        try:
+            manifest = self._run(pool, Path(directory) if directory else hub_backup_dir(),
+                                 HUB_BACKUP_KEEP if keep is None else keep, verify_all)
+            return manifest
+        except HubBackupCancelled:
+            logger.info("Hub backup stopped before finishing")
+            return None
+        except Exception as e:
+            with self._lock:
+                self._last_error = str(e)
+            raise
+        finally:
+            duration = time.monotonic() - self._started
+            with self._lock:
+                self._last_run = {
+                    "finished_at": datetime.now(timezone.utc).isoformat(),
+                    "duration_s": round(duration, 3),
+                    "completed": manifest is not None,
+                    "snapshot": manifest["snapshot"] if manifest else None,
+                    "stats": manifest["stats"] if manifest else self._progress,
+                }
+                self._state = "idle"
+                self._phase = None
+                self._progress = None
+            with pool.connection() as conn:
+                pool.run_with_retry(conn, release_lease, HUB_BACKUP_LOCK_NAME, self.owner)
+            event_hub.publish("hub_backup_finished", {
+                "completed": manifest is not None,
+                "snapshot": manifest["snapshot"] if manifest else None,
+                "duration_s": round(duration, 3),
+            })
+
+    def _checkpoint(self, phase: str, progress: Optional[dict] = None):
+        """Between batches: record progress, keep the lease, honour stop()."""
+        with self._lock:
+            self._phase = phase
+            if progress is not None:
+                self._progress = dict(progress)
+        if self._stop.is_set():
+            raise HubBackupCancelled()
+        now = time.monotonic()
+        if now - self._lease_renewed > HUB_BACKUP_LOCK_TTL / 3:
+            with self._pool.connection() as conn:
+                if not self._pool.run_with_retry(conn, renew_lease, HUB_BACKUP_LOCK_NAME, self.owner,
+                                                 HUB_BACKUP_LOCK_TTL):
+                    logger.warning("Lost the hub backup lease to another worker")
+                    raise HubBackupCancelled()
+            self._lease_renewed = now
+
+    def _run(self, pool: ConnectionPool, directory: Path, keep: int, verify_all: bool) -> dict:
+        started = time.perf_counter()
+        created = datetime.now(timezone.utc)
+        directory.mkdir(parents=True, exist_ok=True)
+        # Leftovers of runs that died; safe to remove while we hold the lease
+        for stale in directory.glob(".*.part"):
+            shutil.rmtree(stale, ignore_errors=True)
+
+        snapshots = list_snapshots(directory)
+        previous = directory / snapshots[-1] if snapshots else None
+        name = created.strftime("%Y%m%d_%H%M%S")
+        suffix = 0
+        while (directory / name).exists():
+            suffix += 1
+            name = f"{created.strftime('%Y%m%d_%H%M%S')}-{suffix}"
+        part = directory / f".{name}.part"
+        part.mkdir()
+
+        try:
+            database = copy_database(pool, part / DATABASE_FILE)
+            blobs = self._place_blobs(part, previous, verify_all)
+            keys = get_blob_storage_path().parent / "keys"
+            if keys.is_dir():
+                shutil.copytree(keys, part / "keys")
+
+            stats = {
+                "database": database,
+                "blobs": blobs,
+                "total_s": round(time.perf_counter() - started, 3),
+            }
+            manifest = {
+                "snapshot": name,
+                "created_at": created.isoformat(),
+                "previous": previous.name if previous else None,
+                "verify_all": verify_all,
+                "stats": stats,
+                "missing": blobs.pop("missing_sha256"),
+                "corrupt": blobs.pop("corrupt_sha256"),
+            }
+            with open(part / MANIFEST_FILE, "w") as f:
+                json.dump(manifest, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(part, directory / name)
+            _fsync(directory)
+        except BaseException:
+            shutil.rmtree(part, ignore_errors=True)
+            raise
+
+        manifest["rotated"] = rotate_snapshots(directory, keep)
+        if manifest["corrupt"]:
+            logger.warning(f"Hub backup {name}: {len(manifest['corrupt'])} blobs didn't match their sha256")
+        logger.info(
+            f"Hub backup {name}: database {database['bytes']} bytes at {database['mb_per_s']} MB/s, "
+            f"{blobs['copied']} blobs copied ({blobs['copied_bytes']} bytes at {blobs['copy_mb_per_s']} MB/s), "
+            f"{blobs['linked']} linked, {stats['total_s']} s total"
+        )
+        return manifest
+
+    def _place_blobs(self, snapshot: Path, previous: Optional[Path], verify_all: bool) -> dict:
+        """Link or copy every blob the snapshot's database refers to."""
+        stats = {
+            "files": 0, "linked": 0, "linked_bytes": 0, "copied": 0, "copied_bytes": 0,
+            "missing": 0, "corrupt": 0, "verified": 0,
+        }
+        missing, corrupt = [], []
+        self._checkpoint("blobs", stats)
+        started = time.perf_counter()
+        # The list comes from the copy, not the live database
+        db = sqlite3.connect(f"file:{snapshot / DATABASE_FILE}?mode=ro", uri=True)
+        try:
+            cursor = db.execute("""
+                SELECT h.sha256, COALESCE(b.encoding, ?), COALESCE(b.stored_bytes, b.bytes, MAX(h.bytes))
+                FROM handshakes h LEFT JOIN blobs b ON b.sha256 = h.sha256
+                GROUP BY h.sha256
+            """, (IDENTITY,))
+            with ThreadPoolExecutor(max_workers=max(1, HUB_BACKUP_WORKERS),
+                                    thread_name_prefix="pwnhub-hub-backup") as executor:
+                while True:
+                    rows = cursor.fetchmany(BLOB_BATCH_SIZE)
+                    if not rows:
+                        break
+                    results = executor.map(
+                        lambda row: place_blob(snapshot, previous, *row, verify_all), rows
+                    )
+                    for (sha256, _, _), (action, size, verified) in zip(rows, results):
+                        stats["files"] += 1
+                        stats[action] += 1
+                        if action == "missing":
+                            missing.append(sha256)
+                            continue
+                        stats[f"{action}_bytes"] += size
+                        if verified is not None:
+                            stats["verified"] += 1
+                            if not verified:
+                                stats["corrupt"] += 1
+                                corrupt.append(sha256)
+                    self._checkpoint("blobs", stats)
+        finally:
+            db.close()
+        seconds = time.perf_counter() - started
+        stats["seconds"] = round(seconds, 3)
+        stats["copy_mb_per_s"] = _rate(stats["copied_bytes"], seconds)
+        stats["files_per_s"] = round(stats["files"] / seconds, 1) if seconds > 0 else None
+        stats["missing_sha256"] = missing
+        stats["corrupt_sha256"] = corrupt
+        return stats
+
+    def status(self, pool: ConnectionPool, directory: Optional[Path] = None) -> dict:
+        """Progress of a running backup, the last run here and the snapshots on disk."""
+        directory = Path(directory) if directory else hub_backup_dir()
+        with pool.connection() as conn:
+            lease = get_lease(conn, HUB_BACKUP_LOCK_NAME)
+        snapshots = list_snapshots(directory)
+        # The newest manifest covers runs made by the CLI or another worker too
+        latest = read_manifest(directory / snapshots[-1]) if snapshots else None
+        with self._lock:
+            current = None
+            if self._state == "running":
+                current = {
+                    "phase": self._phase,
+                    "elapsed_s": round(time.monotonic() - self._started, 3),
+                    "blobs": self._progress,
+                }
+            return {
+                "state": self._state,
+                "worker": self.owner,
+                "lock_holder": lease["owner"] if lease else None,
+                "directory": str(directory),
+                "keep": HUB_BACKUP_KEEP,
+                "current": current,
+                "last_run": self._last_run,
+                "last_error": self._last_error,
+                "snapshots": snapshots,
+                "latest": {key: latest[key] for key in ("snapshot", "created_at", "stats")} if latest else None,
+            }
+
+
+hub_backup_worker = HubBackupWorker()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.hub_backup", description="Back up the whole hub.")
+    parser.add_argument("--dest", help=f"Snapshot directory (default: HUB_BACKUP_DIR or {hub_backup_dir()})")
+    parser.add_argument("--keep", type=int, default=None, help=f"Snapshots to keep (default: {HUB_BACKUP_KEEP})")
+    parser.add_argument("--verify-all", action="store_true",
+                        help="Also re-hash blobs linked from the previous snapshot")
+    parser.add_argument("--json", action="store_true", help="Print the manifest as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    pool = init_pool(init_db())
+    try:
+        manifest = hub_backup_worker.run_once(pool, directory=args.dest, keep=args.keep, verify_all=args.verify_all)
+    finally:
+        close_pool()
+    if manifest is None:
+        print("Another hub backup is running", file=sys.stderr)
+        return 2
+    if args.json:
+        print(json.dumps(manifest, indent=2))
+    else:
+        stats = manifest["stats"]
+        print(f"Snapshot: {Path(args.dest) if args.dest else hub_backup_dir()}/{manifest['snapshot']}")
+        print(f"Database: {stats['database']['bytes']} bytes in {stats['database']['seconds']} s "
+              f"({stats['database']['mb_per_s']} MB/s)")
+        blobs = stats["blobs"]
+        print(f"Blobs: {blobs['files']} ({blobs['copied']} copied, {blobs['linked']} linked, "
+              f"{blobs['missing']} missing, {blobs['corrupt']} corrupt) in {blobs['seconds']} s, "
+              f"copied at {blobs['copy_mb_per_s']} MB/s")
+        print(f"Total: {stats['total_s']} s; rotated out: {', '.join(manifest['rotated']) or 'none'}")
+    return 1 if manifest["corrupt"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
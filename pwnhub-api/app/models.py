@@ -32,6 +32,45 @@ class DeviceResponse(BaseModel):
     last_seen: Optional[int] = None
     last_ip: Optional[str] = None
     ssh_provisioned: bool = False
+    # Storage aggregates from device_stats; handshake_count above is the hub's
+    # count, reported_handshake_count what the agent last said it holds.
+    # total_stored_bytes is the space used on disk after compression
+    reported_handshake_count: int = 0
+    total_bytes: int = 0
+    oldest_upload: Optional[str] = None
+    newest_upload: Optional[str] = None
+    total_stored_bytes: int = 0
 
     class Config:
         from_attributes = True
+
+
+class DeviceBatchResult(BaseModel):
+    """Outcome of one item of a batch register/heartbeat request."""
+    index: int
+    type: Optional[str] = None
+    serial: Optional[str] = None
+    status: str  # ok, invalid or not_found
+    detail: Optional[str] = None
+
+
+class DeviceBatchResponse(BaseModel):
+    """Response model for POST /api/devices/batch."""
+    applied: int
+    failed: int
+    results: list[DeviceBatchResult]
+
+
+class HandshakeCheckRequest(BaseModel):
+    """Request model for the pre-upload dedup check."""
+    serial: str
+    filename: str
+    sha256: str
+
+
+class UploadSessionRequest(BaseModel):
+    """Request model for starting a resumable upload."""
+    serial: str
+    filename: str
+    size: int
+    sha256: str
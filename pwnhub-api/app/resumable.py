@@ -0,0 +1,290 @@
+"""Resumable chunked uploads.
+
+A device declares a file (serial, filename, size, sha256) and gets an
+upload id back, then PUTs the bytes in chunks at explicit offsets. The
+partial file is written next to the blob store and every chunk's sha256
+is recorded, so after a dropped connection the agent can fetch the
+session, compare chunk hashes with its own copy and carry on from the
+first byte the hub doesn't have. Finalize hashes the whole file and hands
+it to ingest_handshake like any other upload.
+
+Sessions live in the upload_sessions and upload_chunks tables rather
+than in memory, so any API worker can accept the next chunk. A chunk is
+written and fsynced before the short transaction that records it, so the
+SQLite writer lock is never held across disk I/O. Instead a lock on the
+partial file keeps chunk writes and finalize for one upload apart.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import secrets
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+from fastapi import HTTPException
+from app.executors import run_cpu, run_db
+from app.storage import blob_temp_dir, ingest_handshake
+
+logger = logging.getLogger(__name__)
+
+# Largest chunk accepted per PUT, also suggested to agents (see deploy/env.example)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Sessions with no chunk for this long are deleted with their partial file
+UPLOAD_SESSION_TTL_HOURS = float(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24"))
+
+# Partial files sit in the blob staging directory under this prefix
+PARTIAL_PREFIX = ".resumable-"
+HASH_READ_SIZE = 1024 * 1024
+
+
+def partial_path(upload_id: str) -> Path:
+    """Where the bytes received so far for upload_id are kept."""
+    return blob_temp_dir() / f"{PARTIAL_PREFIX}{upload_id}.part"
+
+
+def hash_file(path: str) -> str:
+    """sha256 of a file; top-level so it can run on the process pool."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _session_ttl() -> float:
+    return UPLOAD_SESSION_TTL_HOURS * 3600
+
+
+def _purge_expired(conn: sqlite3.Connection) -> int:
+    """Delete sessions idle for longer than the TTL and their partial files (no commit)."""
+    cursor = conn.cursor()
+    cursor.execute(
+        "DELETE FROM upload_sessions WHERE updated_at < ? RETURNING id",
+        (time.time() - _session_ttl(),)
+    )
+    expired = [row[0] for row in cursor.fetchall()]
+    for upload_id in expired:
+        cursor.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+        partial_path(upload_id).unlink(missing_ok=True)
+    return len(expired)
+
+
+def create_session_tx(conn: sqlite3.Connection, serial: str, filename: str, size: int, sha256: str) -> dict:
+    """Start an upload session with an empty partial file.
+
+    Expired sessions are cleaned up here, so abandoned uploads don't need
+    a job of their own.
+    """
+    purged = _purge_expired(conn)
+    upload_id = secrets.token_hex(16)
+    now = time.time()
+    conn.execute("""
+        INSERT INTO upload_sessions (id, serial, filename, size, sha256, received, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+    """, (upload_id, serial, filename, size, sha256, now, now))
+
+    path = partial_path(upload_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+
+    conn.commit()
+    if purged:
+        logger.info(f"Removed {purged} expired upload sessions")
+    return {
+        "upload_id": upload_id,
+        "offset": 0,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "expires_at": now + _session_ttl(),
+    }
+
+
+def get_session(conn: sqlite3.Connection, upload_id: str, with_chunks: bool = True) -> Optional[dict]:
+    """Session state (and received chunks, in order), or None if unknown or expired."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT serial, filename, size, sha256, received, updated_at
+        FROM upload_sessions WHERE id = ? AND updated_at >= ?
+    """, (upload_id, time.time() - _session_ttl()))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    serial, filename, size, sha256, received, updated_at = row
+    session = {
+        "upload_id": upload_id,
+        "serial": serial,
+        "filename": filename,
+        "size": size,
+        "sha256": sha256,
+        "offset": received,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "expires_at": updated_at + _session_ttl(),
+    }
+    if with_chunks:
+        cursor.execute(
+            "SELECT start, length, sha256 FROM upload_chunks WHERE upload_id = ? ORDER BY start",
+            (upload_id,)
+        )
+        session["chunks"] = [
+            {"offset": start, "length": length, "sha256": chunk_sha256}
+            for start, length, chunk_sha256 in cursor.fetchall()
+        ]
+    return session
+
+
+def _lock_partial(upload_id: str, flags: int) -> Optional[int]:
+    """Open the partial file and lock it exclusively; None if it is missing or already locked.
+
+    The lock keeps chunk writes and finalize for one upload from
+    overlapping. It is never waited for, so it can be taken on the loop.
+    """
+    try:
+        fd = os.open(partial_path(upload_id), flags)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _partial_unavailable(conn: sqlite3.Connection, upload_id: str) -> HTTPException:
+    """The error for a partial file _lock_partial couldn't take."""
+    session = get_session(conn, upload_id, with_chunks=False)
+    if session is None:
+        return HTTPException(status_code=404, detail=f"Upload not found: {upload_id}")
+    return HTTPException(
+        status_code=409,
+        detail=f"Upload {upload_id} is busy with another chunk or finalize, or its partial file is missing",
+        headers={"Upload-Offset": str(session["offset"])}
+    )
+
+
+def write_chunk_tx(conn: sqlite3.Connection, upload_id: str, offset: int, data: bytes, chunk_sha256: str) -> int:
+    """Write data at offset and record its hash; returns the new offset.
+
+    offset may be anywhere up to the bytes received so far. Writing before
+    the end replaces everything from offset on, which is how a client
+    rewinds to a chunk that didn't match its copy.
+    """
+    end = offset + len(data)
+    fd = _lock_partial(upload_id, os.O_WRONLY)
+    if fd is None:
+        raise _partial_unavailable(conn, upload_id)
+    try:
+        session = get_session(conn, upload_id, with_chunks=False)
+        if session is None:
+            raise HTTPException(status_code=404, detail=f"Upload not found: {upload_id}")
+        size, received = session["size"], session["offset"]
+        if offset > received:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Offset {offset} is past the {received} bytes received",
+                headers={"Upload-Offset": str(received)}
+            )
+        if end > size:
+            raise HTTPException(status_code=413, detail=f"Chunk ends at {end}, past the declared size {size}")
+
+        # The recorded offset must never run ahead of what's on disk, so
+        # a rewind only shrinks the file once it has been recorded
+        os.pwrite(fd, data, offset)
+        os.fsync(fd)
+
+        # The writer lock is held from here until commit
+        now = time.time()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE upload_sessions SET received = ?, updated_at = ?
+            WHERE id = ? AND received = ? AND updated_at >= ?
+        """, (end, now, upload_id, received, now - _session_ttl()))
+        if cursor.rowcount != 1:
+            # Deleted or expired since the check above
+            conn.rollback()
+            raise HTTPException(status_code=404, detail=f"Upload not found: {upload_id}")
+        cursor.execute("DELETE FROM upload_chunks WHERE upload_id = ? AND start >= ?", (upload_id, offset))
+        cursor.execute(
+            "INSERT INTO upload_chunks (upload_id, start, length, sha256) VALUES (?, ?, ?, ?)",
+            (upload_id, offset, len(data), chunk_sha256)
+        )
+        conn.commit()
+        if end < received:
+            os.ftruncate(fd, end)
+    finally:
+        os.close(fd)
+    return end
+
+
+def delete_session_tx(conn: sqlite3.Connection, upload_id: str) -> bool:
+    """Forget a session and remove its partial file; False if it didn't exist."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+    existed = cursor.rowcount == 1
+    cursor.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+    partial_path(upload_id).unlink(missing_ok=True)
+    conn.commit()
+    return existed
+
+
+class PartialUpload:
+    """A finished session's partial file, shaped like HashingFileWriter for ingest_handshake."""
+
+    def __init__(self, path: Path, size: int, sha256: str):
+        self.temp_path = path
+        self.size = size
+        self._sha256 = sha256
+
+    def hexdigest(self) -> str:
+        return self._sha256
+
+    def commit(self, final_path: Path):
+        os.replace(self.temp_path, final_path)
+
+    def abort(self):
+        # The file belongs to the session until finalize succeeds or it
+        # expires, so a failed ingest can simply be finalized again
+        pass
+
+
+async def finalize_upload(upload_id: str) -> dict:
+    """Verify a complete session against its declared sha256 and ingest it.
+
+    The partial file stays locked until the session is gone, so no chunk
+    can change it after it was hashed and a second finalize gets a 409.
+    """
+    fd = _lock_partial(upload_id, os.O_RDWR)
+    if fd is None:
+        raise await run_db(_partial_unavailable, upload_id)
+    try:
+        session = await run_db(get_session, upload_id, with_chunks=False)
+        if session is None:
+            raise HTTPException(status_code=404, detail=f"Upload not found: {upload_id}")
+        if session["offset"] != session["size"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload incomplete: {session['offset']} of {session['size']} bytes received",
+                headers={"Upload-Offset": str(session["offset"])}
+            )
+        # Drop anything a crash left between a rewind's commit and its truncate
+        os.ftruncate(fd, session["size"])
+
+        path = partial_path(upload_id)
+        sha256 = await run_cpu(hash_file, str(path))
+        if sha256 != session["sha256"]:
+            # Kept, so the client can check chunk hashes and re-send from the first bad one
+            raise HTTPException(
+                status_code=422,
+                detail=f"sha256 mismatch: declared {session['sha256']}, received {sha256}"
+            )
+
+        result = await ingest_handshake(
+            session["serial"], session["filename"], PartialUpload(path, session["size"], sha256)
+        )
+        await run_db(delete_session_tx, upload_id)
+    finally:
+        # Not awaited, so a dropped client can't leave the file locked
+        os.close(fd)
+    return result
@@ -0,0 +1,434 @@
+"""Retention engine.
+
+Old and over-cap handshakes are picked with set-based SQL and deleted
+device by device in batches of RETENTION_BATCH_SIZE rows, each batch its
+own short transaction so uploads can interleave with a long cleanup:
+
+- age: range deletes on the (serial, uploaded_at) index, oldest first
+- size cap: a per-device running total (newest first) over the rows that
+  survive the age pass; everything past the cap is deleted
+
+Blob references are released in the same transaction as the row deletes,
+with unreferenced blob files unlinked in parallel on a small worker pool.
+
+Scheduled runs go through RetentionWorker. It runs the engine on a
+thread of its own rather than the shared request I/O pool, holds a
+database lease so only one API worker cleans up at a time, paces the
+run to an I/O budget and can stop it between batches.
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from app.database import ConnectionPool, acquire_lease, get_lease, release_lease, renew_lease
+from app.events import event_hub
+from app.storage import get_device_stats, release_blobs
+
+logger = logging.getLogger(__name__)
+
+# Rows per delete transaction and blob unlink parallelism (see deploy/env.example)
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_UNLINK_WORKERS = int(os.getenv("RETENTION_UNLINK_WORKERS", "8"))
+
+# I/O budget for scheduled runs, in blob files and MB removed per second (0 = unlimited)
+RETENTION_MAX_FILES_PER_SEC = float(os.getenv("RETENTION_MAX_FILES_PER_SEC", "0"))
+RETENTION_MAX_MB_PER_SEC = float(os.getenv("RETENTION_MAX_MB_PER_SEC", "0"))
+
+# How long a worker's claim on a run lasts without being renewed
+RETENTION_LOCK_TTL = float(os.getenv("RETENTION_LOCK_TTL", "300"))
+RETENTION_LOCK_NAME = "retention"
+
+# Which size the per-device cap counts: handshakes.bytes (original) or
+# stored_bytes (on disk, after compression), with the matching device total
+SIZE_BASES = {
+    "original": ("bytes", "total_bytes"),
+    "stored": ("COALESCE(stored_bytes, bytes)", "total_stored_bytes"),
+}
+
+# Rows newer than the cutoff that fall outside their device's size cap,
+# keeping the newest rows whose running total still fits
+OVER_CAP_SQL = """
+    SELECT id, serial FROM (
+        SELECT id, serial, SUM(COALESCE({size}, 0)) OVER (
+            PARTITION BY serial ORDER BY uploaded_at DESC, id DESC
+            ROWS UNBOUNDED PRECEDING
+        ) AS kept_bytes
+        FROM handshakes
+        WHERE uploaded_at >= :cutoff AND serial IN (
+            -- Every device that can be over the cap, from the maintained totals
+            SELECT serial FROM device_stats WHERE {total} > :max_bytes
+        )
+    )
+    WHERE kept_bytes > :max_bytes
+"""
+
+
+def over_cap_sql(size_basis: str) -> str:
+    size, total = SIZE_BASES[size_basis]
+    return OVER_CAP_SQL.format(size=size, total=total)
+
+
+def get_retention_policy() -> dict:
+    """Current retention settings, read from the environment on every run."""
+    return {
+        "enabled": os.getenv("RETENTION_ENABLED", "true").lower() == "true",
+        "days": int(os.getenv("RETENTION_DAYS", "90")),
+        "max_bytes_per_device": int(float(os.getenv("RETENTION_MAX_GB_PER_DEVICE", "10")) * 1024 ** 3),
+        "size_basis": os.getenv("RETENTION_SIZE_BASIS", "original").lower(),
+    }
+
+
+def retention_cutoff(days: int) -> str:
+    """uploaded_at cutoff for an age limit; uploaded_at is CURRENT_TIMESTAMP, i.e. UTC."""
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _new_stats(dry_run: bool, cutoff: str, max_bytes: int, size_basis: str) -> dict:
+    return {
+        "dry_run": dry_run,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "cutoff": cutoff,
+        "max_bytes_per_device": max_bytes,
+        "size_basis": size_basis,
+        "handshakes": 0,
+        "handshake_bytes": 0,
+        "blobs": 0,
+        "blob_bytes": 0,
+        "batches": 0,
+        "devices": {},
+        "timings_ms": {},
+    }
+
+
+def _tally(stats: dict, rows: list, removed: list):
+    """Add a batch of deleted (serial, sha256, bytes) rows and removed blobs to stats."""
+    stats["batches"] += 1
+    stats["handshakes"] += len(rows)
+    stats["handshake_bytes"] += sum(size or 0 for _, _, size in rows)
+    stats["blobs"] += len(removed)
+    stats["blob_bytes"] += sum(size or 0 for _, size in removed)
+    for serial, _, _ in rows:
+        stats["devices"][serial] = stats["devices"].get(serial, 0) + 1
+
+
+def _finish_delete(conn: sqlite3.Connection, rows: list, unlink_executor) -> list:
+    """Release blobs for deleted rows, then commit (device_stats is updated by trigger)."""
+    removed = release_blobs(conn, [sha256 for _, sha256, _ in rows], unlink_executor)
+    conn.commit()
+    return removed
+
+
+def _delete_aged_batch_tx(conn: sqlite3.Connection, serial: str, cutoff: str, limit: int,
+                          unlink_executor) -> tuple:
+    """Delete up to limit of a device's oldest rows before cutoff; returns (rows, removed blobs)."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        DELETE FROM handshakes WHERE id IN (
+            SELECT id FROM handshakes
+            WHERE serial = ? AND uploaded_at < ?
+            ORDER BY uploaded_at, id
+            LIMIT ?
+        )
+        RETURNING serial, sha256, bytes
+    """, (serial, cutoff, limit))
+    rows = cursor.fetchall()
+    if not rows:
+        return rows, []
+    return rows, _finish_delete(conn, rows, unlink_executor)
+
+
+def _delete_ids_tx(conn: sqlite3.Connection, ids: list, unlink_executor) -> tuple:
+    """Delete handshakes by id; returns (rows, removed blobs)."""
+    cursor = conn.cursor()
+    placeholders = ", ".join("?" * len(ids))
+    cursor.execute(
+        f"DELETE FROM handshakes WHERE id IN ({placeholders}) RETURNING serial, sha256, bytes",
+        ids
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return rows, []
+    return rows, _finish_delete(conn, rows, unlink_executor)
+
+
+def _preview_tx(conn: sqlite3.Connection, cutoff: str, max_bytes: int, size_basis: str, stats: dict):
+    """Fill stats with what a real run would delete, without changing anything."""
+    doomed = f"""
+        WITH doomed AS (
+            SELECT id FROM handshakes WHERE uploaded_at < :cutoff
+            UNION ALL
+            SELECT id FROM ({over_cap_sql(size_basis)})
+        )
+    """
+    params = {"cutoff": cutoff, "max_bytes": max_bytes}
+    cursor = conn.cursor()
+    cursor.execute(doomed + """
+        SELECT h.serial, COUNT(*), COALESCE(SUM(h.bytes), 0)
+        FROM handshakes h JOIN doomed d ON d.id = h.id
+        GROUP BY h.serial
+    """, params)
+    for serial, count, size in cursor.fetchall():
+        stats["devices"][serial] = count
+        stats["handshakes"] += count
+        stats["handshake_bytes"] += size
+
+    # A blob is freed only if every reference to it is being deleted
+    cursor.execute(doomed + """
+        SELECT COUNT(*), COALESCE(SUM(COALESCE(b.stored_bytes, b.bytes)), 0)
+        FROM (
+            SELECT h.sha256, COUNT(*) AS refs
+            FROM handshakes h JOIN doomed d ON d.id = h.id
+            GROUP BY h.sha256
+        ) f
+        JOIN blobs b ON b.sha256 = f.sha256
+        WHERE b.refcount <= f.refs
+    """, params)
+    stats["blobs"], stats["blob_bytes"] = cursor.fetchone()
+
+
+def run_retention(pool: ConnectionPool, dry_run: bool = False, days: int = None,
+                  max_bytes_per_device: int = None, batch_size: int = RETENTION_BATCH_SIZE,
+                  checkpoint=None, size_basis: str = None) -> dict:
+    """Apply the retention policy and return per-run stats.
+
+    days, max_bytes_per_device and size_basis ("original" or "stored")
+    default to the configured policy. With
+    dry_run nothing is deleted and the stats describe what would be freed.
+    checkpoint(stats, phase, serial), if given, is called before every
+    delete batch; it may sleep to pace the run or raise to stop it. A
+    pooled connection is taken per batch, never across a checkpoint.
+    Blocking; run it off the event loop.
+    """
+    policy = get_retention_policy()
+    days = policy["days"] if days is None else days
+    max_bytes = policy["max_bytes_per_device"] if max_bytes_per_device is None else max_bytes_per_device
+    size_basis = policy["size_basis"] if size_basis is None else size_basis
+    if size_basis not in SIZE_BASES:
+        raise ValueError(f"Unknown retention size basis: {size_basis}")
+    cutoff = retention_cutoff(days)
+    stats = _new_stats(dry_run, cutoff, max_bytes, size_basis)
+    started = time.perf_counter()
+
+    # A connection per step: nothing is held across checkpoint() sleeps
+    if dry_run:
+        with pool.connection() as conn:
+            pool.run_with_retry(conn, _preview_tx, cutoff, max_bytes, size_basis, stats)
+        stats["timings_ms"]["preview"] = round((time.perf_counter() - started) * 1000, 3)
+    else:
+        # Blob files are unlinked in parallel on a pool of the run's own
+        with ThreadPoolExecutor(max_workers=RETENTION_UNLINK_WORKERS,
+                                thread_name_prefix="pwnhub-retention") as unlink_executor:
+            # Age pass: per device, range deletes until a short batch says it's done
+            with pool.connection() as conn:
+                aged = [row[0] for row in conn.execute(
+                    "SELECT serial FROM device_stats WHERE oldest_upload < ?", (cutoff,)
+                )]
+                conn.commit()
+            for serial in aged:
+                while True:
+                    if checkpoint:
+                        checkpoint(stats, "age", serial)
+                    with pool.connection() as conn:
+                        rows, removed = pool.run_with_retry(
+                            conn, _delete_aged_batch_tx, serial, cutoff, batch_size, unlink_executor
+                        )
+                    if rows:
+                        _tally(stats, rows, removed)
+                    if len(rows) < batch_size:
+                        break
+            age_done = time.perf_counter()
+            stats["timings_ms"]["age"] = round((age_done - started) * 1000, 3)
+
+            # Size cap pass: pick every over-cap row in one query, delete per device in batches
+            over_cap = {}
+            with pool.connection() as conn:
+                for handshake_id, serial in conn.execute(over_cap_sql(size_basis), {"cutoff": cutoff, "max_bytes": max_bytes}):
+                    over_cap.setdefault(serial, []).append(handshake_id)
+                conn.commit()
+            for serial, ids in over_cap.items():
+                for i in range(0, len(ids), batch_size):
+                    if checkpoint:
+                        checkpoint(stats, "size_cap", serial)
+                    with pool.connection() as conn:
+                        rows, removed = pool.run_with_retry(
+                            conn, _delete_ids_tx, ids[i:i + batch_size], unlink_executor
+                        )
+                    if rows:
+                        _tally(stats, rows, removed)
+            stats["timings_ms"]["size_cap"] = round((time.perf_counter() - age_done) * 1000, 3)
+
+    stats["timings_ms"]["total"] = round((time.perf_counter() - started) * 1000, 3)
+    return stats
+
+
+class RetentionCancelled(Exception):
+    """Raised from a checkpoint to stop a run between batches."""
+
+
+class RetentionWorker:
+    """Runs scheduled retention off the event loop, one run at a time across workers.
+
+    run_once() blocks; submit() runs it on the worker's own thread, so a
+    run paced to take minutes never occupies the shared I/O pool. Progress
+    and the last run's stats are kept in memory for
+    /api/admin/retention/status.
+    """
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pool = None
+        self._state = "idle"
+        self._phase = None
+        self._device = None
+        self._current = None
+        self._started = None
+        self._lease_renewed = 0.0
+        self._last_run = None
+        self._last_error = None
+        self._skipped = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def submit(self, func, *args) -> Future:
+        """Run func(*args) on the worker's own thread."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pwnhub-retention-run")
+            return self._executor.submit(func, *args)
+
+    def stop(self):
+        """Stop a running cleanup at its next batch boundary and wait for it."""
+        self._stop.set()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def run_once(self, pool: ConnectionPool) -> Optional[dict]:
+        """Run a throttled cleanup if no other worker is; returns its stats or None."""
+        with pool.connection() as conn:
+            if not pool.run_with_retry(conn, acquire_lease, RETENTION_LOCK_NAME, self.owner, RETENTION_LOCK_TTL):
+                with self._lock:
+                    self._skipped += 1
+                logger.info("Retention cleanup already running on another worker, skipping")
+                return None
+
+        with self._lock:
+            self._pool = pool
+            self._state = "running"
+            self._started = time.monotonic()
+            self._lease_renewed = self._started
+            self._last_error = None
+        stats = None
+        try:
+            stats = run_retention(pool, checkpoint=self._checkpoint)
+            return stats
+        except RetentionCancelled:
+            logger.info("Retention cleanup stopped before finishing")
+            return None
+        except Exception as e:
+            with self._lock:
+                self._last_error = str(e)
+            raise
+        finally:
+            duration = time.monotonic() - self._started
+            with self._lock:
+                last_run = {
+                    "finished_at": datetime.now(timezone.utc).isoformat(),
+                    "duration_s": round(duration, 3),
+                    "completed": stats is not None,
+                    "stats": stats or self._current,
+                }
+                self._last_run = last_run
+                self._state = "idle"
+                self._phase = None
+                self._device = None
+                self._current = None
+            with pool.connection() as conn:
+                pool.run_with_retry(conn, release_lease, RETENTION_LOCK_NAME, self.owner)
+                if event_hub.has_subscribers():
+                    run_stats = last_run["stats"] or {}
+                    devices = get_device_stats(conn, list(run_stats.get("devices", {})))
+                    event_hub.publish("retention_finished", {
+                        "completed": last_run["completed"],
+                        "duration_s": last_run["duration_s"],
+                        "handshakes": run_stats.get("handshakes", 0),
+                        "blob_bytes": run_stats.get("blob_bytes", 0),
+                        "devices": devices,
+                    })
+
+    def _checkpoint(self, stats: dict, phase: str, serial: str):
+        """Between batches: publish progress, keep the lease, stay within the I/O budget."""
+        with self._lock:
+            self._current = stats
+            self._phase = phase
+            self._device = serial
+        event_hub.publish("retention_progress", {
+            "phase": phase,
+            "device": serial,
+            "handshakes": stats["handshakes"],
+            "blob_bytes": stats["blob_bytes"],
+        }, key="run")
+
+        if self._stop.is_set():
+            raise RetentionCancelled()
+
+        now = time.monotonic()
+        if now - self._lease_renewed > RETENTION_LOCK_TTL / 3:
+            with self._pool.connection() as conn:
+                if not self._pool.run_with_retry(conn, renew_lease, RETENTION_LOCK_NAME, self.owner,
+                                                 RETENTION_LOCK_TTL):
+                    logger.warning("Lost the retention lease to another worker")
+                    raise RetentionCancelled()
+            self._lease_renewed = now
+
+        # Sleep until the work done so far fits the budget
+        elapsed = now - self._started
+        wait = 0.0
+        if RETENTION_MAX_FILES_PER_SEC > 0:
+            wait = max(wait, stats["blobs"] / RETENTION_MAX_FILES_PER_SEC - elapsed)
+        if RETENTION_MAX_MB_PER_SEC > 0:
+            wait = max(wait, stats["blob_bytes"] / (RETENTION_MAX_MB_PER_SEC * 1024 * 1024) - elapsed)
+        if wait > 0 and self._stop.wait(wait):
+            raise RetentionCancelled()
+
+    def status(self, pool: ConnectionPool) -> dict:
+        """Progress of the current run (if any) and the last run's outcome."""
+        with pool.connection() as conn:
+            lease = get_lease(conn, RETENTION_LOCK_NAME)
+        with self._lock:
+            current = None
+            if self._state == "running" and self._current is not None:
+                current = {
+                    "phase": self._phase,
+                    "device": self._device,
+                    "elapsed_s": round(time.monotonic() - self._started, 3),
+                    "handshakes": self._current["handshakes"],
+                    "blobs": self._current["blobs"],
+                    "blob_bytes": self._current["blob_bytes"],
+                    "batches": self._current["batches"],
+                }
+            return {
+                "state": self._state,
+                "worker": self.owner,
+                "lock_holder": lease["owner"] if lease else None,
+                "current": current,
+                "last_run": self._last_run,
+                "last_error": self._last_error,
+                "skipped_runs": self._skipped,
+                "budget": {
+                    "max_files_per_sec": RETENTION_MAX_FILES_PER_SEC,
+                    "max_mb_per_sec": RETENTION_MAX_MB_PER_SEC,
+                },
+            }
+
+
+retention_worker = RetentionWorker()
@@ -0,0 +1,59 @@
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query
+from app.database import get_pool
+from app.executors import loop_lag_stats, run_io
+from app.heartbeats import heartbeat_buffer
+from app.hub_backup import hub_backup_dir, hub_backup_worker
+from app.retention import retention_worker, run_retention
+
+router = APIRouter()
+
+
+@router.get("/db/pool")
+async def db_pool_stats():
+    """Connection pool metrics: checkouts, wait times and busy retries."""
+    return get_pool().stats()
+
+
+@router.get("/loop-lag")
+async def loop_lag():
+    """Event loop lag observed while each route was being served."""
+    return loop_lag_stats.snapshot()
+
+
+@router.get("/heartbeats")
+async def heartbeat_buffer_stats():
+    """Heartbeat buffer: devices waiting to be written and flush counters."""
+    return heartbeat_buffer.stats()
+
+
+@router.get("/retention/preview")
+async def retention_preview(
+    days: Optional[int] = Query(None, ge=0),
+    max_gb_per_device: Optional[float] = Query(None, ge=0),
+    size_basis: Optional[str] = Query(None, pattern="^(original|stored)$")
+):
+    """Dry-run the retention policy: what a cleanup would delete and free."""
+    max_bytes = int(max_gb_per_device * 1024 ** 3) if max_gb_per_device is not None else None
+    return await run_io(run_retention, get_pool(), dry_run=True, days=days, max_bytes_per_device=max_bytes,
+                        size_basis=size_basis)
+
+
+@router.get("/retention/status")
+async def retention_status():
+    """Progress of a running retention cleanup and the last run's duration and stats."""
+    return await run_io(retention_worker.status, get_pool())
+
+
+@router.post("/backup", status_code=202)
+async def start_hub_backup(verify_all: bool = False):
+    """Start a hub-wide backup in the background; poll /backup/status for the result."""
+    if await run_io(hub_backup_worker.submit, get_pool(), verify_all=verify_all) is None:
+        raise HTTPException(status_code=409, detail="A hub backup is already running")
+    return {"status": "started", "directory": str(hub_backup_dir()), "verify_all": verify_all}
+
+
+@router.get("/backup/status")
+async def hub_backup_status():
+    """Progress of a running hub backup, the last run's stats and the snapshots kept."""
+    return await run_io(hub_backup_worker.status, get_pool())
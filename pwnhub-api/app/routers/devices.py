@@ -1,10 +1,32 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
 import time
-from fastapi import APIRouter, HTTPException, Request
-from app.database import get_conn
-from app.models import DeviceRegisterRequest, DeviceHeartbeatRequest, DeviceResponse
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from app.archives import archive_type, stream_archive
+from app.backups import backup_engine, create_backup_job_tx, get_backup_job, list_backup_jobs
+from app.database import get_data_version, get_db, get_pool
+from app.events import event_hub
+from app.executors import run_db, run_io, run_subprocess
+from app.heartbeats import HEARTBEAT_FLUSH_MS, heartbeat_buffer, write_heartbeats
+from app.routers.handshakes import attachment_header, build_handshake_filters
+from app.models import (
+    DeviceBatchResponse, DeviceBatchResult, DeviceRegisterRequest, DeviceHeartbeatRequest, DeviceResponse
+)
 
 router = APIRouter()
 
+# Most records accepted by one POST /batch (see deploy/env.example)
+DEVICE_BATCH_MAX_ITEMS = int(os.getenv("DEVICE_BATCH_MAX_ITEMS", "1000"))
+
 
 def get_client_ip(request: Request) -> str:
     """Extract client IP from request, handling proxies."""
@@ -17,6 +39,18 @@ def get_client_ip(request: Request) -> str:
     return request.client.host if request.client else "unknown"
 
 
+# Device columns in row_to_device_response order; counts and sizes come
+# from the trigger-maintained device_stats row rather than COUNT(*)
+DEVICE_SELECT = """
+    SELECT d.id, d.serial, d.name, d.hostname, d.ssh_fp, d.image_gen,
+           COALESCE(s.handshake_count, 0), d.last_seen, d.last_ip, d.ssh_provisioned,
+           d.handshake_count, COALESCE(s.total_bytes, 0), s.oldest_upload, s.newest_upload,
+           COALESCE(s.total_stored_bytes, 0)
+    FROM devices d
+    LEFT JOIN device_stats s ON s.serial = d.serial
+"""
+
+
 def row_to_device_response(row: tuple) -> DeviceResponse:
     """Convert database row tuple to DeviceResponse model."""
     return DeviceResponse(
@@ -29,165 +63,343 @@ def row_to_device_response(row: tuple) -> DeviceResponse:
         handshake_count=row[6] or 0,
         last_seen=row[7],
         last_ip=row[8],
-        ssh_provisioned=bool(row[9] if len(row) > 9 else 0)
+        ssh_provisioned=bool(row[9] if len(row) > 9 else 0),
+        reported_handshake_count=row[10] or 0,
+        total_bytes=row[11] or 0,
+        oldest_upload=row[12],
+        newest_upload=row[13],
+        total_stored_bytes=row[14] or 0
     )
 
 
+def _fetch_devices(conn: sqlite3.Connection) -> list:
+    """Fetch all device rows, ordered by last_seen descending."""
+    cursor = conn.cursor()
+    cursor.execute(DEVICE_SELECT + "ORDER BY d.last_seen DESC")
+    return cursor.fetchall()
+
+
+class DeviceListSnapshot:
+    """Serialized device list, rebuilt only when the devices data version changes.
+
+    Checking the version is a single primary-key lookup, so polling
+    dashboards cost almost nothing while no device changes. Buffered
+    heartbeats are overlaid on the cached rows without touching the
+    database.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.devices = []
+        self.key = None
+        self.body = b"[]"
+        self.etag = None
+
+    def get(self, conn: sqlite3.Connection) -> tuple:
+        """(body, etag) for the current device list. Blocking."""
+        # Read the version before the rows: a concurrent write can only
+        # make the cached body newer than its version, never older
+        version = get_data_version(conn, "devices")
+        key = (version, heartbeat_buffer.generation)
+        with self._lock:
+            if key == self.key:
+                return self.body, self.etag
+            devices = self.devices if version == self.version else None
+
+        if devices is None:
+            devices = [row_to_device_response(row).model_dump() for row in _fetch_devices(conn)]
+        merged = heartbeat_buffer.overlay(devices)
+        if merged is not devices:
+            # Unflushed heartbeats can change the last_seen order
+            merged.sort(key=lambda device: device["last_seen"] or 0, reverse=True)
+        body = json.dumps(merged).encode()
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        with self._lock:
+            self.version, self.devices, self.key = version, devices, key
+            self.body, self.etag = body, etag
+        return body, etag
+
+
+device_list_snapshot = DeviceListSnapshot()
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """True if an If-None-Match header value matches etag."""
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        # If-None-Match uses the weak comparison
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
 @router.get("/", response_model=list[DeviceResponse])
-async def list_devices():
-    """List all registered devices, ordered by last_seen descending."""
-    conn = get_conn()
+async def list_devices(request: Request, conn: sqlite3.Connection = Depends(get_db)):
+    """List all registered devices, ordered by last_seen descending.
+
+    Served from a cached snapshot with a strong ETag; send If-None-Match
+    to get 304 Not Modified while nothing has changed.
+    """
+    body, etag = await run_io(device_list_snapshot.get, conn)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# Register as a single UPSERT: no read-then-write race between workers
+REGISTER_UPSERT_SQL = """
+    INSERT INTO devices
+    (serial, name, hostname, ssh_fp, image_gen, handshake_count, last_seen, last_ip, ssh_provisioned)
+    VALUES (?, NULL, ?, ?, ?, ?, ?, ?, 0)
+    ON CONFLICT(serial) DO UPDATE SET
+        hostname = excluded.hostname,
+        ssh_fp = excluded.ssh_fp,
+        image_gen = excluded.image_gen,
+        handshake_count = excluded.handshake_count,
+        last_seen = excluded.last_seen,
+        last_ip = excluded.last_ip
+"""
+
+
+def _register_params(request_body: DeviceRegisterRequest, client_ip: str, current_time: int) -> tuple:
+    """Positional parameters for REGISTER_UPSERT_SQL."""
+    return (
+        request_body.serial,
+        request_body.hostname,
+        request_body.ssh_fingerprint,
+        request_body.image_gen or 0,
+        request_body.handshake_count or 0,
+        current_time,
+        client_ip,
+    )
+
+
+# The registered row in DEVICE_SELECT order, from the same statement
+REGISTER_RETURNING = """
+    RETURNING id, serial, name, hostname, ssh_fp, image_gen,
+        COALESCE((SELECT s.handshake_count FROM device_stats s WHERE s.serial = devices.serial), 0),
+        last_seen, last_ip, ssh_provisioned, handshake_count,
+        COALESCE((SELECT s.total_bytes FROM device_stats s WHERE s.serial = devices.serial), 0),
+        (SELECT s.oldest_upload FROM device_stats s WHERE s.serial = devices.serial),
+        (SELECT s.newest_upload FROM device_stats s WHERE s.serial = devices.serial),
+        COALESCE((SELECT s.total_stored_bytes FROM device_stats s WHERE s.serial = devices.serial), 0)
+"""
+
+
+def _register_device_tx(conn: sqlite3.Connection, request_body: DeviceRegisterRequest,
+                        client_ip: str, current_time: int):
+    """Insert or update a device row in one statement; returns the device row."""
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, serial, name, hostname, ssh_fp, image_gen, 
-               handshake_count, last_seen, last_ip, ssh_provisioned
-        FROM devices
-        ORDER BY last_seen DESC
-    """)
-    rows = cursor.fetchall()
-    conn.close()
-    return [row_to_device_response(row) for row in rows]
+    cursor.execute(
+        REGISTER_UPSERT_SQL + REGISTER_RETURNING,
+        _register_params(request_body, client_ip, current_time)
+    )
+    row = cursor.fetchone()
+    conn.commit()
+    return row
 
 
 @router.post("/register", response_model=DeviceResponse)
-async def register_device(request_body: DeviceRegisterRequest, request: Request):
+async def register_device(
+    request_body: DeviceRegisterRequest,
+    request: Request,
+    conn: sqlite3.Connection = Depends(get_db)
+):
     """Register a new device or update existing device by serial."""
     client_ip = get_client_ip(request)
     current_time = int(time.time())
     
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    # Check if device exists
-    cursor.execute("SELECT id FROM devices WHERE serial = ?", (request_body.serial,))
-    existing = cursor.fetchone()
-    
-    if existing:
-        # Update existing device
-        cursor.execute("""
-            UPDATE devices 
-            SET hostname = ?, ssh_fp = ?, image_gen = ?, handshake_count = ?,
-                last_seen = ?, last_ip = ?
-            WHERE serial = ?
-        """, (
-            request_body.hostname,
-            request_body.ssh_fingerprint,
-            request_body.image_gen or 0,
-            request_body.handshake_count or 0,
-            current_time,
-            client_ip,
-            request_body.serial
-        ))
-    else:
-        # Insert new device
-        cursor.execute("""
-            INSERT INTO devices 
-            (serial, name, hostname, ssh_fp, image_gen, handshake_count, last_seen, last_ip, ssh_provisioned)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            request_body.serial,
-            None,  # name (can be set later)
-            request_body.hostname,
-            request_body.ssh_fingerprint,
-            request_body.image_gen or 0,
-            request_body.handshake_count or 0,
-            current_time,
-            client_ip,
-            0  # ssh_provisioned = false by default
-        ))
-    
-        # Get the updated/inserted device
-        cursor.execute("""
-            SELECT id, serial, name, hostname, ssh_fp, image_gen, 
-                   handshake_count, last_seen, last_ip, ssh_provisioned
-            FROM devices
-            WHERE serial = ?
-        """, (request_body.serial,))
-    
-    row = cursor.fetchone()
-    conn.commit()
-    conn.close()
+    # Buffered heartbeats predate this and must not overwrite it
+    await run_io(heartbeat_buffer.discard, request_body.serial)
+    row = await run_io(get_pool().run_with_retry, conn, _register_device_tx, request_body, client_ip, current_time)
     
     if not row:
         raise HTTPException(status_code=500, detail="Failed to register device")
     
-    return row_to_device_response(row)
+    device = row_to_device_response(row)
+    event_hub.publish("device_registered", device.model_dump(), key=device.serial)
+    return device
+
+
+def _heartbeat_fields(request_body: DeviceHeartbeatRequest, client_ip: str, current_time: int) -> dict:
+    """Heartbeat buffer fields for a heartbeat (None = not sent)."""
+    return {
+        "last_seen": current_time,
+        "last_ip": client_ip,
+        "hostname": request_body.hostname,
+        "ssh_fingerprint": request_body.ssh_fingerprint,
+        "image_gen": request_body.image_gen,
+        "reported_handshake_count": request_body.handshake_count,
+    }
 
 
 @router.post("/heartbeat")
 async def heartbeat(request_body: DeviceHeartbeatRequest, request: Request):
-    """Receive heartbeat from device and update last_seen and optional fields."""
+    """Receive heartbeat from device and update last_seen and optional fields.
+
+    The update is buffered and written in a batch by the heartbeat flusher
+    (at most HEARTBEAT_FLUSH_MS later); reads see it immediately. If
+    HEARTBEAT_INTERVAL or HEARTBEAT_MAX_RATE is set, the reply tells the
+    agent when to send the next one (heartbeat_interval, seconds).
+    """
     client_ip = get_client_ip(request)
     current_time = int(time.time())
-    
-    conn = get_conn()
+    serial = request_body.serial
+    
+    # Check if device exists (cached once seen)
+    if not heartbeat_buffer.is_known(serial):
+        if not await run_db(_device_exists, serial):
+            raise HTTPException(status_code=404, detail=f"Device with serial {serial} not found")
+        heartbeat_buffer.mark_known(serial)
+    
+    state = heartbeat_buffer.record(serial, _heartbeat_fields(request_body, client_ip, current_time))
+    if HEARTBEAT_FLUSH_MS <= 0:
+        # Write-through: durable before we answer
+        await run_io(heartbeat_buffer.flush, get_pool())
+    event_hub.publish("heartbeat", state, key=serial)
+    
+    interval = heartbeat_buffer.suggested_interval()
+    if interval is None:
+        return {"status": "ok"}
+    return {"status": "ok", "heartbeat_interval": interval}
+
+
+def _apply_batch_tx(conn: sqlite3.Connection, heartbeat_states: list, register_rows: list) -> set:
+    """Upsert registers, then apply heartbeats to existing devices, in one transaction.
+
+    Returns the heartbeat serials that have no device row.
+    """
     cursor = conn.cursor()
+    cursor.executemany(REGISTER_UPSERT_SQL, register_rows)
+
+    serials = [serial for serial, _ in heartbeat_states]
+    existing = set()
+    # Stay well under SQLite's bound-parameter limit
+    for i in range(0, len(serials), 500):
+        chunk = serials[i:i + 500]
+        cursor.execute(
+            f"SELECT serial FROM devices WHERE serial IN ({', '.join('?' * len(chunk))})", chunk
+        )
+        existing.update(row[0] for row in cursor.fetchall())
+    write_heartbeats(conn, [(serial, state) for serial, state in heartbeat_states if serial in existing])
+    conn.commit()
+    return set(serials) - existing
+
+
+def _fetch_devices_by_serial(conn: sqlite3.Connection, serials: list) -> list:
+    """Device rows for the given serials."""
+    cursor = conn.cursor()
+    cursor.execute(DEVICE_SELECT + f"WHERE d.serial IN ({', '.join('?' * len(serials))})", serials)
+    return cursor.fetchall()
+
+
+BATCH_MODELS = {"register": DeviceRegisterRequest, "heartbeat": DeviceHeartbeatRequest}
+
+
+@router.post("/batch", response_model=DeviceBatchResponse)
+async def batch_update(items: list[dict], request: Request):
+    """Apply many register and heartbeat records (e.g. from a site relay) in one transaction.
+
+    Each item is a register or heartbeat body plus "type": "register" or
+    "heartbeat". Items are validated one by one and invalid ones are
+    reported without failing the rest. Registers are applied before
+    heartbeats; last_ip is the address the batch came from.
+    """
+    if len(items) > DEVICE_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {DEVICE_BATCH_MAX_ITEMS} items per batch")
     
-    # Check if device exists
-    cursor.execute("SELECT id FROM devices WHERE serial = ?", (request_body.serial,))
-    device = cursor.fetchone()
-    
-    if not device:
-        raise HTTPException(status_code=404, detail=f"Device with serial {request_body.serial} not found")
-    
-    # Build update query dynamically based on provided fields
-    update_fields = ["last_seen = ?", "last_ip = ?"]
-    update_values = [current_time, client_ip]
-    
-    if request_body.hostname is not None:
-        update_fields.append("hostname = ?")
-        update_values.append(request_body.hostname)
-    
-    if request_body.ssh_fingerprint is not None:
-        update_fields.append("ssh_fp = ?")
-        update_values.append(request_body.ssh_fingerprint)
-    
-    if request_body.image_gen is not None:
-        update_fields.append("image_gen = ?")
-        update_values.append(request_body.image_gen)
-    
-    if request_body.handshake_count is not None:
-        update_fields.append("handshake_count = ?")
-        update_values.append(request_body.handshake_count)
-    
-    update_values.append(request_body.serial)
+    client_ip = get_client_ip(request)
+    current_time = int(time.time())
     
-    query = f"""
+    results = []
+    registers = []
+    heartbeats = []
+    for index, item in enumerate(items):
+        kind = item.get("type")
+        model = BATCH_MODELS.get(kind)
+        if model is None:
+            results.append(DeviceBatchResult(index=index, type=kind, serial=item.get("serial"), status="invalid",
+                                             detail="type must be 'register' or 'heartbeat'"))
+            continue
+        try:
+            body = model.model_validate({key: value for key, value in item.items() if key != "type"})
+        except ValidationError as e:
+            error = e.errors()[0]
+            results.append(DeviceBatchResult(index=index, type=kind, serial=item.get("serial"), status="invalid",
+                                             detail=f"{'.'.join(map(str, error['loc']))}: {error['msg']}"))
+            continue
+        results.append(DeviceBatchResult(index=index, type=kind, serial=body.serial, status="ok"))
+        (registers if kind == "register" else heartbeats).append(body)
+    
+    # Heartbeats go through the buffer's write-through path so a buffered,
+    # older heartbeat can't be flushed over what this batch writes
+    tx = functools.partial(
+        _apply_batch_tx,
+        register_rows=[_register_params(body, client_ip, current_time) for body in registers]
+    )
+    missing = await run_io(
+        heartbeat_buffer.write_through,
+        get_pool(),
+        [body.serial for body in registers],
+        [(body.serial, _heartbeat_fields(body, client_ip, current_time)) for body in heartbeats],
+        tx
+    )
+    heartbeat_buffer.forget(missing)
+    
+    for result in results:
+        if result.type == "heartbeat" and result.serial in missing:
+            result.status = "not_found"
+            result.detail = f"Device with serial {result.serial} not found"
+    
+    # Change events for the dashboard
+    for serial in {body.serial for body in heartbeats} - missing:
+        heartbeat_buffer.mark_known(serial)
+        event_hub.publish("heartbeat", heartbeat_buffer.state(serial), key=serial)
+    if registers and event_hub.has_subscribers():
+        rows = await run_db(_fetch_devices_by_serial, list({body.serial for body in registers}))
+        for row in rows:
+            device = row_to_device_response(row)
+            event_hub.publish("device_registered", device.model_dump(), key=device.serial)
+    
+    applied = sum(1 for result in results if result.status == "ok")
+    return DeviceBatchResponse(applied=applied, failed=len(results) - applied, results=results)
+
+
+def _get_device_ip(conn: sqlite3.Connection, serial: str):
+    """Fetch (id, serial, last_ip) for a device, or None."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, serial, last_ip FROM devices WHERE serial = ?
+    """, (serial,))
+    return cursor.fetchone()
+
+
+def _mark_ssh_provisioned(conn: sqlite3.Connection, serial: str):
+    """Set ssh_provisioned = 1 for a device."""
+    conn.execute("""
         UPDATE devices 
-        SET {', '.join(update_fields)}
+        SET ssh_provisioned = 1
         WHERE serial = ?
-    """
-    
-    cursor.execute(query, update_values)
+    """, (serial,))
     conn.commit()
-    conn.close()
-    
-    return {"status": "ok"}
 
 
 @router.post("/{serial}/provision-ssh")
 async def provision_ssh(serial: str):
     """Provision SSH key to device by pushing public key via ssh-copy-id."""
-    import subprocess
     from pathlib import Path
     
-    conn = get_conn()
-    cursor = conn.cursor()
-    
     # Get device from database
-    cursor.execute("""
-        SELECT id, serial, last_ip FROM devices WHERE serial = ?
-    """, (serial,))
-    device = cursor.fetchone()
+    device = await run_db(_get_device_ip, serial)
     
     if not device:
-        conn.close()
         raise HTTPException(status_code=404, detail=f"Device with serial {serial} not found")
     
     device_ip = device[2]  # last_ip
     
     if not device_ip:
-        conn.close()
         raise HTTPException(status_code=400, detail=f"Device {serial} has no IP address. Device must send a heartbeat first.")
     
     # Validate SSH public key exists
@@ -196,7 +408,6 @@ async def provision_ssh(serial: str):
         ssh_pub_key = Path("./storage/keys/pwnhub_id_ed25519.pub")
     
     if not ssh_pub_key.exists():
-        conn.close()
         raise HTTPException(
             status_code=500,
             detail=f"SSH public key not found at {ssh_pub_key}. Please generate SSH key pair first."
@@ -206,7 +417,6 @@ async def provision_ssh(serial: str):
     import re
     ip_pattern = re.compile(r'^(\d{1,3}\.){3}\d{1,3}$')
     if not ip_pattern.match(device_ip):
-        conn.close()
         raise HTTPException(status_code=400, detail=f"Invalid IP address format: {device_ip}")
     
     # Call helper script for ssh-copy-id
@@ -216,115 +426,98 @@ async def provision_ssh(serial: str):
         script_path = Path("./scripts/provision-ssh-key.sh")
     
     if not script_path.exists():
-        conn.close()
         raise HTTPException(status_code=500, detail="Provision script not found")
     
     try:
-        # Execute provision script with timeout
-        result = subprocess.run(
+        # Execute provision script with timeout, without blocking the event loop
+        returncode, stdout, stderr = await run_subprocess(
             [str(script_path), device_ip, ssh_username],
-            capture_output=True,
-            text=True,
-            timeout=30,
-            check=False
+            timeout=30
         )
         
-        if result.returncode != 0:
-            error_msg = result.stderr.strip() or result.stdout.strip() or "ssh-copy-id failed"
-            conn.close()
+        if returncode != 0:
+            error_msg = stderr.strip() or stdout.strip() or "ssh-copy-id failed"
             raise HTTPException(
                 status_code=500,
                 detail=f"Failed to provision SSH key: {error_msg}"
             )
         
         # Update database: set ssh_provisioned = 1
-        cursor.execute("""
-            UPDATE devices 
-            SET ssh_provisioned = 1
-            WHERE serial = ?
-        """, (serial,))
-        
-        conn.commit()
-        conn.close()
+        await run_db(_mark_ssh_provisioned, serial)
         
         return {"status": "ok", "message": "SSH key provisioned successfully"}
         
-    except subprocess.TimeoutExpired:
-        conn.close()
+    except asyncio.TimeoutError:
         raise HTTPException(status_code=500, detail="SSH provisioning timed out")
     except Exception as e:
-        conn.close()
         raise HTTPException(status_code=500, detail=f"Error during SSH provisioning: {str(e)}")
 
 
-@router.post("/{serial}/backup")
-async def backup_device(serial: str):
-    """Create a backup tarball of all handshake files for a device."""
-    import tarfile
-    from datetime import datetime
-    from app.database import get_backup_storage_path, get_handshake_storage_path
-    
-    conn = get_conn()
+def _device_exists(conn: sqlite3.Connection, serial: str) -> bool:
+    """Return True if a device with this serial is registered."""
     cursor = conn.cursor()
-    
-    # Get device from database
     cursor.execute("SELECT id, serial FROM devices WHERE serial = ?", (serial,))
-    device = cursor.fetchone()
-    
-    if not device:
-        conn.close()
+    return cursor.fetchone() is not None
+
+
+@router.post("/{serial}/backup", status_code=202)
+async def backup_device(serial: str, full: bool = False):
+    """Start a backup of a device's handshake files and return its job right away.
+
+    Backups are incremental (only handshakes added since the last one)
+    unless full=true. Poll GET /{serial}/backup/{job_id} for the result.
+    If the device already has a backup in progress, that job is returned.
+    """
+    # Get device from database
+    if not await run_db(_device_exists, serial):
         raise HTTPException(status_code=404, detail=f"Device with serial {serial} not found")
     
-    # Get handshake directory for device
-    storage_base = get_handshake_storage_path()
-    device_handshakes_dir = storage_base / serial
-    
-    if not device_handshakes_dir.exists():
-        conn.close()
-        raise HTTPException(status_code=400, detail=f"No handshakes found for device {serial}")
-    
-    # Get list of files to backup
-    handshake_files = list(device_handshakes_dir.iterdir())
-    handshake_files = [f for f in handshake_files if f.is_file()]
-    
-    if not handshake_files:
-        conn.close()
-        raise HTTPException(status_code=400, detail=f"No handshake files found for device {serial}")
-    
-    # Create backup directory
-    backup_base = get_backup_storage_path()
-    device_backup_dir = backup_base / serial
-    device_backup_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Generate backup filename: YYYYMMDD.tar.gz
-    timestamp = datetime.now().strftime("%Y%m%d")
-    backup_filename = f"{timestamp}.tar.gz"
-    backup_path = device_backup_dir / backup_filename
-    
-    try:
-        # Create tarball
-        with tarfile.open(backup_path, "w:gz") as tar:
-            for handshake_file in handshake_files:
-                # Add file to tarball with relative path
-                arcname = handshake_file.name
-                tar.add(handshake_file, arcname=arcname)
-        
-        # Get backup file size
-        backup_size = backup_path.stat().st_size
-        
-        conn.close()
-        
-        return {
-            "status": "ok",
-            "backup_path": str(backup_path),
-            "size_bytes": backup_size,
-            "filename": backup_filename
-        }
-        
-    except Exception as e:
-        # Clean up partial backup if created
-        if backup_path.exists():
-            backup_path.unlink()
-        conn.close()
-        raise HTTPException(status_code=500, detail=f"Error creating backup: {str(e)}")
+    job, created = await run_db(create_backup_job_tx, serial, full)
+    if created:
+        backup_engine.submit(get_pool(), job["job_id"])
+    return job
+
+
+@router.get("/{serial}/backups")
+async def list_device_backups(serial: str, limit: int = Query(20, ge=1, le=200)):
+    """A device's backup jobs, newest first."""
+    return await run_db(list_backup_jobs, serial, limit)
+
 
+@router.get("/{serial}/backup/{job_id}")
+async def get_backup_status(serial: str, job_id: str):
+    """Status and progress of a backup job."""
+    job = await run_db(get_backup_job, job_id)
+    if job is None or job["serial"] != serial:
+        raise HTTPException(status_code=404, detail=f"Backup job not found: {job_id}")
+    return job
+
+
+@router.get("/{serial}/archive")
+async def download_device_archive(
+    serial: str,
+    format: str = Query("tar", pattern="^(tar|zip)$"),
+    compression: str = Query("none", pattern="^(none|gzip|zstd)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """Stream a tar or zip of a device's handshake files, built on the fly.
+
+    Nothing is written to disk. compression=gzip or zstd compresses a tar
+    as a whole; for zip, gzip deflates each entry. since/until select by
+    upload time like the handshake listing.
+    """
+    content_type = archive_type(format, compression)
+    if content_type is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported archive: format={format}, compression={compression}")
+    if not await run_db(_device_exists, serial):
+        raise HTTPException(status_code=404, detail=f"Device with serial {serial} not found")
+
+    media_type, extension = content_type
+    clauses, params = build_handshake_filters(serial, since, until)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
+    return StreamingResponse(
+        stream_archive(clauses, params, format, compression),
+        media_type=media_type,
+        headers={"Content-Disposition": attachment_header(f"{serial}-{stamp}.{extension}")}
+    )
@@ -0,0 +1,42 @@
+import time
+from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
+from app.events import (
+    EVENTS_KEEPALIVE_SECONDS,
+    EVENTS_MAX_STREAM_SECONDS,
+    event_hub,
+    format_sse,
+)
+
+router = APIRouter()
+
+
+@router.get("/")
+async def stream_events():
+    """Server-Sent Events stream of device and job changes for the dashboard.
+
+    Events: device_registered, heartbeat, handshake_uploaded,
+    retention_progress, retention_finished, backup_finished, and resync
+    (reload the device list). The stream ends after a while and the
+    browser's EventSource reconnects on its own.
+    """
+    async def stream():
+        # Subscribed only once the body starts, so a client that leaves
+        # before then never leaves a subscription behind
+        subscription = event_hub.subscribe()
+        try:
+            # Reconnect delay for EventSource, in ms
+            yield "retry: 2000\n\n"
+            deadline = time.monotonic() + EVENTS_MAX_STREAM_SECONDS
+            while (remaining := deadline - time.monotonic()) > 0:
+                messages = await subscription.get(min(EVENTS_KEEPALIVE_SECONDS, remaining))
+                yield format_sse(messages) if messages else ": keepalive\n\n"
+        finally:
+            event_hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        # X-Accel-Buffering: stop nginx holding events back in its buffer
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
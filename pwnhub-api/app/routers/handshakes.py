@@ -1,188 +1,480 @@
+import base64
+import csv
 import hashlib
-import time
-from datetime import datetime
-from pathlib import Path
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import FileResponse
-from app.database import get_conn, get_handshake_storage_path
+import io
+import json
+import sqlite3
+from datetime import datetime, timezone
+from typing import Optional
+from urllib.parse import quote
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from app.compression import IDENTITY, UPLOAD_ENCODINGS, accepts_encoding, open_blob
+from app.database import get_db
+from app.executors import run_db, run_io
+from app.models import HandshakeCheckRequest, UploadSessionRequest
+from app.resumable import (
+    UPLOAD_CHUNK_SIZE, create_session_tx, delete_session_tx, finalize_upload, get_session, write_chunk_tx
+)
+from app.storage import (
+    blob_exists, blob_temp_dir, ensure_device, ingest_handshake, link_handshake_tx,
+    publish_handshake_event, resolve_handshake, validate_serial, validate_sha256
+)
+from app.uploads import UPLOAD_MAX_SIZE, decoded_body, stream_multipart_upload
 
 router = APIRouter()
 
 
-def compute_sha256(file_path: Path) -> str:
-    """Compute SHA256 hash of a file."""
-    sha256_hash = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        # Read file in chunks to handle large files
-        for chunk in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(chunk)
-    return sha256_hash.hexdigest()
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["serial", "file"],
+                    "properties": {
+                        "serial": {"type": "string"},
+                        "file": {"type": "string", "format": "binary"},
+                    },
+                }
+            }
+        },
+    }
+}
 
 
-@router.post("/upload")
-async def upload_handshake(
-    serial: str = Form(...),
-    file: UploadFile = File(...)
-):
-    """Upload a handshake file from a device."""
-    conn = get_conn()
-    cursor = conn.cursor()
+@router.post("/upload", openapi_extra=UPLOAD_OPENAPI)
+async def upload_handshake(request: Request):
+    """Upload a handshake file from a device (multipart form: serial, file).
+
+    The body is parsed straight from the request stream: the file is hashed
+    and sized while it is written to a temp file, then moved into the
+    content-addressed blob store. Content the hub already holds is stored
+    only once, and re-uploads by the same device return the existing entry.
+    """
+    upload = await stream_multipart_upload(request, "file", blob_temp_dir())
+    
+    serial = upload.fields.get("serial")
+    if not serial:
+        await run_io(upload.writer.abort)
+        raise HTTPException(status_code=422, detail="Missing form field: serial")
     
     try:
-        # Check if device exists, create if not
-        cursor.execute("SELECT id FROM devices WHERE serial = ?", (serial,))
-        device = cursor.fetchone()
-        
-        if not device:
-            # Create pending device record
-            current_time = int(time.time())
-            cursor.execute("""
-                INSERT INTO devices (serial, name, hostname, ssh_fp, image_gen, 
-                                   handshake_count, last_seen, last_ip)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (serial, None, None, None, 0, 0, current_time, None))
-            conn.commit()
-        
-        # Get storage path for this device
-        storage_base = get_handshake_storage_path()
-        device_dir = storage_base / serial
-        device_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Generate timestamped filename: YYYYMMDD_HHMMSS_<original>
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        original_filename = file.filename or "handshake"
-        # Preserve file extension
-        if "." in original_filename:
-            name, ext = original_filename.rsplit(".", 1)
-            timestamped_filename = f"{timestamp}_{name}.{ext}"
-        else:
-            timestamped_filename = f"{timestamp}_{original_filename}"
-        
-        file_path = device_dir / timestamped_filename
-        
-        # Save file to disk
-        file_size = 0
-        with open(file_path, "wb") as f:
-            # Read file in chunks
-            while True:
-                chunk = await file.read(8192)
-                if not chunk:
-                    break
-                f.write(chunk)
-                file_size += len(chunk)
-        
-        # Compute SHA256 hash
-        sha256 = compute_sha256(file_path)
-        
-        # Insert metadata into handshakes table
-        cursor.execute("""
-            INSERT INTO handshakes (serial, filename, bytes, sha256, uploaded_at)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """, (serial, timestamped_filename, file_size, sha256))
-        
-        # Increment handshake_count for device
-        cursor.execute("""
-            UPDATE devices 
-            SET handshake_count = handshake_count + 1
-            WHERE serial = ?
-        """, (serial,))
-        
-        conn.commit()
-        
-        return {
-            "status": "ok",
-            "filename": timestamped_filename,
-            "sha256": sha256
-        }
-        
+        result = await ingest_handshake(serial, upload.filename, upload.writer)
+    except HTTPException:
+        raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"Error uploading handshake: {str(e)}")
-    finally:
-        conn.close()
+    
+    return {"status": "ok", **result}
 
 
-@router.get("/")
-async def list_handshakes():
-    """List all handshake files."""
-    conn = get_conn()
+@router.post("/uploads")
+async def create_upload(request_body: UploadSessionRequest):
+    """Start a resumable upload; returns the upload_id to send chunks to."""
+    validate_serial(request_body.serial)
+    sha256 = validate_sha256(request_body.sha256)
+    if request_body.size < 0:
+        raise HTTPException(status_code=400, detail="Invalid size")
+    if request_body.size > UPLOAD_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {UPLOAD_MAX_SIZE} bytes")
+    return await run_db(
+        create_session_tx, request_body.serial, request_body.filename, request_body.size, sha256
+    )
+
+
+@router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """Bytes received so far and the sha256 of every stored chunk, for resuming."""
+    session = await run_db(get_session, upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Upload not found: {upload_id}")
+    return session
+
+
+@router.put("/uploads/{upload_id}")
+async def put_upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    x_chunk_sha256: Optional[str] = Header(None)
+):
+    """Write the raw request body at offset (at most UPLOAD_CHUNK_SIZE bytes).
+
+    The body may be gzip or zstd compressed (Content-Encoding); offsets,
+    the size limit and X-Chunk-SHA256 refer to the decompressed bytes.
+    If X-Chunk-SHA256 is sent the chunk is rejected unless it matches.
+    A 409 carries the offset to resume from in the Upload-Offset header.
+    """
+    data = bytearray()
+    sha256 = hashlib.sha256()
+    async for chunk in decoded_body(request, UPLOAD_CHUNK_SIZE):
+        data += chunk
+        sha256.update(chunk)
+    chunk_sha256 = sha256.hexdigest()
+    if x_chunk_sha256 is not None and x_chunk_sha256.lower() != chunk_sha256:
+        raise HTTPException(status_code=422, detail="Chunk sha256 mismatch")
+    
+    received = await run_db(write_chunk_tx, upload_id, offset, bytes(data), chunk_sha256)
+    return {"upload_id": upload_id, "offset": received, "sha256": chunk_sha256}
+
+
+@router.post("/uploads/{upload_id}/finalize")
+async def finalize_upload_session(upload_id: str):
+    """Check the complete file against the declared sha256 and store it as a handshake."""
+    try:
+        result = await finalize_upload(upload_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error finalizing upload: {str(e)}")
+    return {"status": "ok", **result}
+
+
+@router.delete("/uploads/{upload_id}")
+async def delete_upload(upload_id: str):
+    """Abandon a resumable upload and discard its partial file."""
+    if not await run_db(delete_session_tx, upload_id):
+        raise HTTPException(status_code=404, detail=f"Upload not found: {upload_id}")
+    return {"status": "ok"}
+
+
+@router.post("/check")
+async def check_handshake(request_body: HandshakeCheckRequest):
+    """Pre-upload dedup check.
+
+    If the hub already holds content with this sha256, the handshake is
+    recorded for the device right away and the agent can skip sending the
+    bytes ("exists": true). Otherwise nothing changes and the agent uploads,
+    compressed with one of "accept_encoding" if it likes.
+    """
+    validate_serial(request_body.serial)
+    sha256 = validate_sha256(request_body.sha256)
+    
+    await run_db(ensure_device, request_body.serial)
+    result = await run_db(link_handshake_tx, request_body.serial, request_body.filename, sha256)
+    
+    if result is None:
+        return {"exists": False, "sha256": sha256, "accept_encoding": list(UPLOAD_ENCODINGS)}
+    await publish_handshake_event(request_body.serial, result)
+    return {"exists": True, **result}
+
+
+@router.head("/blobs/{sha256}")
+async def head_blob(sha256: str):
+    """200 with Content-Length if the hub holds content with this sha256, else 404."""
+    sha256 = validate_sha256(sha256)
+    size = await run_db(blob_exists, sha256)
+    if size is None:
+        return Response(status_code=404)
+    return Response(status_code=200, headers={"Content-Length": str(size)})
+
+
+HANDSHAKE_FIELDS = ("id", "serial", "filename", "bytes", "stored_bytes", "sha256", "uploaded_at")
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def parse_fields(fields: Optional[str]) -> tuple:
+    """Validate a comma-separated fields= projection (default: all fields)."""
+    if not fields:
+        return HANDSHAKE_FIELDS
+    requested = tuple(f.strip() for f in fields.split(",") if f.strip())
+    unknown = [f for f in requested if f not in HANDSHAKE_FIELDS]
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(HANDSHAKE_FIELDS)}"
+        )
+    return requested
+
+
+def encode_cursor(uploaded_at: str, handshake_id: int) -> str:
+    """Opaque keyset cursor for the row (uploaded_at, id)."""
+    raw = json.dumps([uploaded_at, handshake_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Inverse of encode_cursor; 400 on anything malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        uploaded_at, handshake_id = json.loads(raw)
+        return str(uploaded_at), int(handshake_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def format_timestamp(value: datetime) -> str:
+    """Format a datetime the way SQLite's CURRENT_TIMESTAMP stores it (UTC)."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def build_handshake_filters(
+    serial: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    min_bytes: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    sha256: Optional[str] = None
+) -> tuple:
+    """Build (WHERE clauses, params) for the handshake catalog filters."""
+    clauses = []
+    params = []
+    if serial is not None:
+        clauses.append("serial = ?")
+        params.append(serial)
+    if since is not None:
+        clauses.append("uploaded_at >= ?")
+        params.append(format_timestamp(since))
+    if until is not None:
+        clauses.append("uploaded_at < ?")
+        params.append(format_timestamp(until))
+    if min_bytes is not None:
+        clauses.append("bytes >= ?")
+        params.append(min_bytes)
+    if max_bytes is not None:
+        clauses.append("bytes <= ?")
+        params.append(max_bytes)
+    if sha256 is not None:
+        clauses.append("sha256 = ?")
+        params.append(sha256.lower())
+    return clauses, params
+
+
+def _fetch_handshake_page(conn: sqlite3.Connection, clauses: list, params: list,
+                          fields: tuple, after: Optional[tuple], limit: int) -> list:
+    """Fetch one page, newest first, as (json text, uploaded_at, id) rows.
+
+    Rows are serialized by SQLite's json_object() so no per-row Python dicts
+    are built. Keyset pagination on (uploaded_at, id) is served by the
+    composite indexes created in init_db.
+    """
+    clauses = list(clauses)
+    params = list(params)
+    if after is not None:
+        clauses.append("(uploaded_at, id) < (?, ?)")
+        params.extend(after)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    # fields are validated against HANDSHAKE_FIELDS, so they're safe to inline
+    projection = ", ".join(f"'{field}', {field}" for field in fields)
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, serial, filename, bytes, sha256, uploaded_at
+    cursor.execute(f"""
+        SELECT json_object({projection}), uploaded_at, id
         FROM handshakes
-        ORDER BY uploaded_at DESC
-    """)
-    rows = cursor.fetchall()
-    conn.close()
+        {where}
+        ORDER BY uploaded_at DESC, id DESC
+        LIMIT ?
+    """, (*params, limit))
+    return cursor.fetchall()
+
+
+async def _handshake_page_response(conn: sqlite3.Connection, clauses: list, params: list,
+                                   fields: Optional[str], cursor: Optional[str], limit: int) -> Response:
+    """Run a paginated catalog query and return {"handshakes": [...], "next_cursor": ...}."""
+    projection = parse_fields(fields)
+    after = decode_cursor(cursor) if cursor else None
+    # One extra row tells us whether there is a next page
+    rows = await run_io(_fetch_handshake_page, conn, clauses, params, projection, after, limit + 1)
     
-    handshakes = []
-    for row in rows:
-        handshakes.append({
-            "id": row[0],
-            "serial": row[1],
-            "filename": row[2],
-            "bytes": row[3],
-            "sha256": row[4],
-            "uploaded_at": row[5]
-        })
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][2])
     
-    return {"handshakes": handshakes}
+    body = '{"handshakes":[' + ",".join(row[0] for row in rows) + '],"next_cursor":' + json.dumps(next_cursor) + "}"
+    return Response(content=body, media_type="application/json")
 
 
-@router.get("/{serial}/list")
-async def list_device_handshakes(serial: str):
-    """List all handshake files for a specific device."""
-    conn = get_conn()
+@router.get("/")
+async def list_handshakes(
+    serial: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    min_bytes: Optional[int] = Query(None, ge=0),
+    max_bytes: Optional[int] = Query(None, ge=0),
+    sha256: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Comma-separated subset of: " + ", ".join(HANDSHAKE_FIELDS)),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    conn: sqlite3.Connection = Depends(get_db)
+):
+    """List handshake files, newest first, one page at a time.
+
+    Pass the returned next_cursor back as cursor= to get the following page;
+    it is null on the last page.
+    """
+    clauses, params = build_handshake_filters(serial, since, until, min_bytes, max_bytes, sha256)
+    return await _handshake_page_response(conn, clauses, params, fields, cursor, limit)
+
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def _fetch_export_batch(conn: sqlite3.Connection, clauses: list, params: list,
+                       fields: tuple, after_id: Optional[int], export_format: str) -> list:
+    """Up to EXPORT_BATCH_SIZE (id, row) pairs after after_id, oldest id first."""
+    clauses = list(clauses)
+    params = list(params)
+    if after_id is not None:
+        clauses.append("id > ?")
+        params.append(after_id)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    # fields are validated against HANDSHAKE_FIELDS, so they're safe to inline
+    if export_format == "ndjson":
+        columns = "json_object(" + ", ".join(f"'{field}', {field}" for field in fields) + ")"
+    else:
+        columns = ", ".join(fields)
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, serial, filename, bytes, sha256, uploaded_at
+    cursor.execute(f"""
+        SELECT id, {columns}
         FROM handshakes
-        WHERE serial = ?
-        ORDER BY uploaded_at DESC
-    """, (serial,))
-    rows = cursor.fetchall()
-    conn.close()
-    
-    handshakes = []
-    for row in rows:
-        handshakes.append({
-            "id": row[0],
-            "serial": row[1],
-            "filename": row[2],
-            "bytes": row[3],
-            "sha256": row[4],
-            "uploaded_at": row[5]
-        })
+        {where}
+        ORDER BY id ASC
+        LIMIT ?
+    """, params + [EXPORT_BATCH_SIZE])
+    return [(row[0], row[1:]) for row in cursor.fetchall()]
+
+
+async def _stream_export(clauses: list, params: list, fields: tuple,
+                         after_id: Optional[int], export_format: str):
+    """Yield the export a batch at a time; memory use is bounded by one batch.
+
+    Each batch is a keyset query (id > last id) on its own short-lived
+    pooled connection, so a slow or vanished client never holds a pool
+    slot or a read transaction that would stall WAL checkpoints.
+    """
+    if export_format == "csv":
+        yield ",".join(fields) + "\r\n"
+    while True:
+        rows = await run_db(_fetch_export_batch, clauses, params, fields, after_id, export_format)
+        if not rows:
+            break
+        after_id = rows[-1][0]
+        if export_format == "ndjson":
+            yield "".join(row[0] + "\n" for _, row in rows)
+        else:
+            out = io.StringIO()
+            csv.writer(out).writerows(row for _, row in rows)
+            yield out.getvalue()
+
+
+@router.get("/export")
+async def export_handshakes(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    after_id: Optional[int] = Query(None, ge=0, description="Resume after the last id of a previous export"),
+    serial: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    min_bytes: Optional[int] = Query(None, ge=0),
+    max_bytes: Optional[int] = Query(None, ge=0),
+    sha256: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Stream the whole handshake catalog as NDJSON or CSV, in id order.
+
+    id is always included so the last row's id can be passed back as
+    after_id to fetch only what was added since.
+    """
+    projection = parse_fields(fields)
+    if "id" not in projection:
+        projection = ("id",) + projection
+    clauses, params = build_handshake_filters(serial, since, until, min_bytes, max_bytes, sha256)
     
-    return {"handshakes": handshakes}
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    return StreamingResponse(
+        _stream_export(clauses, params, projection, after_id, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="handshakes.{format}"'}
+    )
+
+
+@router.get("/{serial}/list")
+async def list_device_handshakes(
+    serial: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    min_bytes: Optional[int] = Query(None, ge=0),
+    max_bytes: Optional[int] = Query(None, ge=0),
+    sha256: Optional[str] = None,
+    fields: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    conn: sqlite3.Connection = Depends(get_db)
+):
+    """List handshake files for a specific device, paginated like GET /api/handshakes/."""
+    clauses, params = build_handshake_filters(serial, since, until, min_bytes, max_bytes, sha256)
+    return await _handshake_page_response(conn, clauses, params, fields, cursor, limit)
+
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+
+def attachment_header(filename: str) -> str:
+    """Content-Disposition for a download, as FileResponse builds it."""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+async def _stream_decompressed(file_path, encoding: str):
+    """Yield a compressed blob's original bytes, one chunk at a time."""
+    reader = await run_io(open_blob, file_path, encoding)
+    try:
+        while True:
+            chunk = await run_io(reader.read, DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await run_io(reader.close)
 
 
 @router.get("/{serial}/download/{filename}")
-async def download_handshake(serial: str, filename: str):
-    """Download a handshake file for a specific device."""
+async def download_handshake(serial: str, filename: str, request: Request):
+    """Download a handshake file for a specific device.
+
+    Compressed blobs are sent as stored, with Content-Encoding, when the
+    client accepts that encoding, and decompressed on the fly otherwise.
+    """
     # Validate filename to prevent directory traversal
     if ".." in filename or "/" in filename or "\\" in filename:
         raise HTTPException(status_code=400, detail="Invalid filename")
     
-    # Get file path
-    storage_base = get_handshake_storage_path()
-    device_dir = storage_base / serial
-    file_path = device_dir / filename
+    # Look up the blob holding this file's content
+    found = await run_db(resolve_handshake, serial, filename)
     
     # Validate file exists
-    if not file_path.exists():
+    if found is None or not await run_io(found[0].exists):
         raise HTTPException(status_code=404, detail=f"Handshake file not found: {filename}")
+    file_path, encoding, size = found
     
-    # Validate file is within device directory (security check)
-    try:
-        file_path.resolve().relative_to(device_dir.resolve())
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid file path")
+    if encoding == IDENTITY:
+        # Return file response
+        return FileResponse(
+            path=str(file_path),
+            filename=filename,
+            media_type='application/octet-stream'
+        )
+    
+    if accepts_encoding(request.headers.get("accept-encoding", ""), encoding):
+        return FileResponse(
+            path=str(file_path),
+            filename=filename,
+            media_type='application/octet-stream',
+            headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+        )
     
-    # Return file response
-    return FileResponse(
-        path=str(file_path),
-        filename=filename,
-        media_type='application/octet-stream'
+    return StreamingResponse(
+        _stream_decompressed(file_path, encoding),
+        media_type='application/octet-stream',
+        headers={
+            "Content-Disposition": attachment_header(filename),
+            "Content-Length": str(size),
+            "Vary": "Accept-Encoding",
+        }
     )
-
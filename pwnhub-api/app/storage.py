@@ -0,0 +1,368 @@
+"""Content-addressed handshake store.
+
+Each distinct file content is stored once at blobs/<aa>/<sha256>, with a
+row in the blobs table counting how many handshakes rows point at it.
+handshakes rows keep the per-device, timestamped filename as a logical
+name; the bytes are always found through handshakes.sha256.
+
+File operations on the blob store happen inside the database transaction
+that changes the refcount (after the first write statement, so the writer
+lock is held). That serializes them with retention deleting the same blob.
+
+Blobs may be stored compressed (see app.compression); blobs.encoding says
+how, and bytes/stored_bytes on blobs and handshakes hold the original and
+on-disk sizes.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+from fastapi import HTTPException
+from app.compression import IDENTITY, STORAGE_ENCODING, compress_file
+from app.database import get_blob_storage_path, get_handshake_storage_path
+from app.events import event_hub
+from app.executors import run_cpu, run_db, run_io
+
+logger = logging.getLogger(__name__)
+
+SHA256_HEX_LENGTH = 64
+
+
+def validate_serial(serial: str):
+    """Reject serials that can't safely be used as a directory name."""
+    if not serial or ".." in serial or "/" in serial or "\\" in serial or serial.startswith("."):
+        raise HTTPException(status_code=400, detail="Invalid serial")
+
+
+def validate_sha256(sha256: str) -> str:
+    """Normalize and validate a hex sha256 digest."""
+    sha256 = (sha256 or "").lower()
+    if len(sha256) != SHA256_HEX_LENGTH or any(c not in "0123456789abcdef" for c in sha256):
+        raise HTTPException(status_code=400, detail="Invalid sha256")
+    return sha256
+
+
+def make_stored_filename(original_filename: str) -> str:
+    """Generate timestamped filename: YYYYMMDD_HHMMSS_<original>."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # Only keep the basename of whatever the client sent
+    original_filename = Path(original_filename or "handshake").name or "handshake"
+    # Preserve file extension
+    if "." in original_filename:
+        name, ext = original_filename.rsplit(".", 1)
+        return f"{timestamp}_{name}.{ext}"
+    return f"{timestamp}_{original_filename}"
+
+
+def blob_path(sha256: str) -> Path:
+    """Path of the blob holding the content with this sha256."""
+    return get_blob_storage_path() / sha256[:2] / sha256
+
+
+def blob_temp_dir() -> Path:
+    """Staging directory for in-progress uploads, on the blob filesystem."""
+    return get_blob_storage_path() / ".tmp"
+
+
+def ensure_device(conn: sqlite3.Connection, serial: str):
+    """Create a pending device record for serial if it doesn't exist yet."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM devices WHERE serial = ?", (serial,))
+    device = cursor.fetchone()
+
+    if not device:
+        # Create pending device record
+        current_time = int(time.time())
+        cursor.execute("""
+            INSERT INTO devices (serial, name, hostname, ssh_fp, image_gen,
+                               handshake_count, last_seen, last_ip)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (serial, None, None, None, 0, 0, current_time, None))
+        conn.commit()
+
+
+def find_device_handshake(conn: sqlite3.Connection, serial: str, sha256: str) -> Optional[str]:
+    """Filename of this device's existing handshake with this content, if any."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT filename FROM handshakes
+        WHERE serial = ? AND sha256 = ?
+        ORDER BY id DESC LIMIT 1
+    """, (serial, sha256))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class StagedBlob:
+    """Compressed copy of an upload, committed to the blob store in place of the raw file."""
+
+    def __init__(self, path: Path, encoding: str, size: int):
+        self.path = path
+        self.encoding = encoding
+        self.size = size
+
+    def commit(self, final_path: Path):
+        os.replace(self.path, final_path)
+
+    def abort(self):
+        self.path.unlink(missing_ok=True)
+
+
+async def compress_upload(writer) -> Optional[StagedBlob]:
+    """Compress an upload for at-rest storage, if configured and worth it.
+
+    Returns None (store the raw file) when compression is off, the hub
+    already holds the content, or compressing didn't make it smaller.
+    """
+    if STORAGE_ENCODING == IDENTITY or writer.size == 0:
+        return None
+    if await run_db(blob_exists, writer.hexdigest()) is not None:
+        return None
+    staged = StagedBlob(writer.temp_path.with_name(f"{writer.temp_path.name}.{STORAGE_ENCODING}"),
+                        STORAGE_ENCODING, 0)
+    try:
+        staged.size = await run_cpu(compress_file, str(writer.temp_path), str(staged.path), STORAGE_ENCODING)
+    except BaseException:
+        await run_io(staged.abort)
+        raise
+    if staged.size >= writer.size:
+        await run_io(staged.abort)
+        return None
+    return staged
+
+
+def _add_reference(conn: sqlite3.Connection, serial: str, filename: str, size: int, sha256: str,
+                   blob=None) -> int:
+    """Insert a handshakes row and take a reference on its blob (no commit).
+
+    If blob (a HashingFileWriter or StagedBlob) is given and the blob file
+    doesn't exist yet, it is moved into place. Returns the stored size
+    recorded for the row. device_stats is updated by trigger.
+    """
+    encoding = getattr(blob, "encoding", IDENTITY)
+    stored_size = blob.size if blob is not None else size
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO blobs (sha256, bytes, stored_bytes, encoding, refcount)
+        VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1
+        RETURNING stored_bytes
+    """, (sha256, size, stored_size, encoding))
+    stored_bytes = cursor.fetchone()[0]
+
+    # The writer lock is held from here until commit
+    if blob is not None:
+        target = blob_path(sha256)
+        if not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            blob.commit(target)
+            cursor.execute("UPDATE blobs SET stored_bytes = ?, encoding = ? WHERE sha256 = ?",
+                           (stored_size, encoding, sha256))
+            stored_bytes = stored_size
+
+    cursor.execute("""
+        INSERT INTO handshakes (serial, filename, bytes, sha256, uploaded_at, stored_bytes)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
+    """, (serial, filename, size, sha256, stored_bytes))
+    return stored_bytes
+
+
+def store_handshake_tx(conn: sqlite3.Connection, serial: str, original_filename: str, writer,
+                       staged: Optional[StagedBlob] = None) -> dict:
+    """Record an uploaded file for serial, moving its bytes into the blob store.
+
+    writer is a HashingFileWriter holding the bytes in a temp file; staged,
+    if given, is its compressed copy and is stored instead. If the device
+    already has this content the upload is a no-op retry; if another
+    device does, only a new reference is added. The caller aborts the
+    writer (and staged) afterwards in case their temp files weren't used.
+    """
+    sha256 = writer.hexdigest()
+    existing = find_device_handshake(conn, serial, sha256)
+    if existing:
+        return {"filename": existing, "sha256": sha256, "duplicate": True}
+
+    filename = make_stored_filename(original_filename)
+    _add_reference(conn, serial, filename, writer.size, sha256, staged or writer)
+
+    conn.commit()
+    return {"filename": filename, "sha256": sha256, "duplicate": False}
+
+
+def link_handshake_tx(conn: sqlite3.Connection, serial: str, original_filename: str, sha256: str) -> Optional[dict]:
+    """Record a handshake for serial whose content the hub already holds.
+
+    Returns None (and changes nothing) if the blob isn't stored.
+    """
+    existing = find_device_handshake(conn, serial, sha256)
+    if existing:
+        return {"filename": existing, "sha256": sha256, "duplicate": True}
+
+    cursor = conn.cursor()
+    cursor.execute("SELECT bytes FROM blobs WHERE sha256 = ?", (sha256,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+
+    filename = make_stored_filename(original_filename)
+    _add_reference(conn, serial, filename, row[0], sha256)
+
+    # Checked under the writer lock, after taking the reference
+    if not blob_path(sha256).exists():
+        conn.rollback()
+        return None
+
+    conn.commit()
+    return {"filename": filename, "sha256": sha256, "duplicate": False}
+
+
+def release_blobs(conn: sqlite3.Connection, sha256s: list, unlink_executor=None) -> list:
+    """Drop one reference per entry in sha256s and delete unreferenced blobs (no commit).
+
+    Must be called after the handshakes rows have been deleted in the same
+    transaction. Blob files are unlinked before returning, in parallel on
+    unlink_executor if one is given. Returns (sha256, stored bytes) for
+    every blob that was removed.
+    """
+    cursor = conn.cursor()
+    cursor.executemany(
+        "UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?",
+        [(sha256,) for sha256 in sha256s]
+    )
+    unique = list(set(sha256s))
+    if not unique:
+        return []
+    placeholders = ", ".join("?" * len(unique))
+    cursor.execute(
+        f"DELETE FROM blobs WHERE refcount <= 0 AND sha256 IN ({placeholders}) "
+        "RETURNING sha256, COALESCE(stored_bytes, bytes)",
+        unique
+    )
+    removed = cursor.fetchall()
+
+    paths = [blob_path(sha256) for sha256, _ in removed]
+    if unlink_executor is not None:
+        # list() waits for every unlink (and surfaces errors) before commit
+        list(unlink_executor.map(_unlink_blob, paths))
+    else:
+        for path in paths:
+            _unlink_blob(path)
+    return removed
+
+
+def _unlink_blob(path: Path):
+    path.unlink(missing_ok=True)
+
+
+def blob_exists(conn: sqlite3.Connection, sha256: str) -> Optional[int]:
+    """Size of the stored blob with this sha256, or None if the hub doesn't hold it."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT bytes FROM blobs WHERE sha256 = ? AND refcount > 0", (sha256,))
+    row = cursor.fetchone()
+    if not row or not blob_path(sha256).exists():
+        return None
+    return row[0]
+
+
+def resolve_handshake(conn: sqlite3.Connection, serial: str, filename: str) -> Optional[tuple]:
+    """(blob path, encoding, original size) for a device's handshake filename, or None if unknown."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT h.sha256, COALESCE(b.encoding, 'identity'), h.bytes
+        FROM handshakes h LEFT JOIN blobs b ON b.sha256 = h.sha256
+        WHERE h.serial = ? AND h.filename = ?
+        ORDER BY h.id DESC LIMIT 1
+    """, (serial, filename))
+    row = cursor.fetchone()
+    return (blob_path(row[0]), row[1], row[2]) if row else None
+
+
+def get_device_stats(conn: sqlite3.Connection, serials: list) -> list:
+    """device_stats for each serial, keyed like DeviceResponse, for change events."""
+    if not serials:
+        return []
+    placeholders = ", ".join("?" * len(serials))
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT serial, handshake_count, total_bytes, oldest_upload, newest_upload, total_stored_bytes
+        FROM device_stats WHERE serial IN ({placeholders})
+    """, list(serials))
+    return [
+        {"serial": serial, "handshake_count": count, "total_bytes": total_bytes,
+         "oldest_upload": oldest, "newest_upload": newest, "total_stored_bytes": total_stored_bytes}
+        for serial, count, total_bytes, oldest, newest, total_stored_bytes in cursor.fetchall()
+    ]
+
+
+async def publish_handshake_event(serial: str, result: dict):
+    """Tell dashboards about a new handshake, with the device's updated totals."""
+    if result["duplicate"] or not event_hub.has_subscribers():
+        return
+    stats = await run_db(get_device_stats, [serial])
+    event_hub.publish("handshake_uploaded", {
+        "filename": result["filename"],
+        "sha256": result["sha256"],
+        **(stats[0] if stats else {"serial": serial}),
+    }, key=serial)
+
+
+async def ingest_handshake(serial: str, original_filename: str, writer) -> dict:
+    """Store the bytes held by writer as a handshake for serial.
+
+    This is the single ingest path for every way a capture reaches the hub.
+    """
+    staged = None
+    try:
+        validate_serial(serial)
+        await run_db(ensure_device, serial)
+        staged = await compress_upload(writer)
+        result = await run_db(store_handshake_tx, serial, original_filename, writer, staged)
+    finally:
+        # No-ops if the temp files were moved into the blob store
+        if staged is not None:
+            await run_io(staged.abort)
+        await run_io(writer.abort)
+    await publish_handshake_event(serial, result)
+    return result
+
+
+def migrate_legacy_handshakes(conn: sqlite3.Connection) -> int:
+    """Move files from the old handshakes/<serial>/<filename> layout into the blob store.
+
+    Runs once per database (tracked with PRAGMA user_version). The sha256
+    column recorded at upload time is trusted; duplicate content is kept
+    once. Returns the number of rows migrated.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= 1:
+        return 0
+
+    legacy_base = get_handshake_storage_path()
+    cursor = conn.cursor()
+    cursor.execute("SELECT serial, filename, bytes, sha256 FROM handshakes")
+    rows = cursor.fetchall()
+
+    for serial, filename, size, sha256 in rows:
+        legacy_path = legacy_base / serial / filename
+        target = blob_path(sha256)
+        if legacy_path.exists():
+            if target.exists():
+                legacy_path.unlink()
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(legacy_path, target)
+        cursor.execute("""
+            INSERT INTO blobs (sha256, bytes, stored_bytes, refcount)
+            VALUES (?, ?, ?, 1)
+            ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1
+        """, (sha256, size, size))
+
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    if rows:
+        logger.info(f"Migrated {len(rows)} handshakes into the blob store")
+    return len(rows)
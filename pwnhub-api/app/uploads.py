@@ -0,0 +1,239 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+from fastapi import HTTPException, Request
+from multipart.multipart import MultipartParser, parse_options_header
+from app.compression import DECODE_ERRORS, UPLOAD_ENCODINGS, stream_decoder
+from app.executors import run_io
+
+# Size of the reusable write buffer per upload (see deploy/env.example)
+UPLOAD_BUFFER_SIZE = int(os.getenv("UPLOAD_BUFFER_SIZE", str(1024 * 1024)))
+# Largest upload accepted, after decompression (see deploy/env.example)
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", str(256 * 1024 * 1024)))
+
+# Non-file form fields are tiny (serial etc.); cap them so a bogus request
+# can't make us buffer an arbitrary amount of memory
+MAX_FIELD_SIZE = 64 * 1024
+
+# Prefix for in-progress files; directory listings skip dotfiles
+TEMP_PREFIX = ".upload-"
+
+
+class HashingFileWriter:
+    """Writes a stream to a temp file, hashing and counting bytes in the same pass.
+
+    The temp file lives in the destination filesystem so commit() is an
+    atomic os.replace(); readers never see a partially written file.
+    All methods block and are meant to run on the I/O thread pool.
+    """
+
+    def __init__(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX, suffix=".part")
+        self.temp_path = Path(temp_path)
+        # The caller batches writes itself, so skip Python's own buffering
+        self._file = os.fdopen(fd, "wb", buffering=0)
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._sha256.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
+
+    def commit(self, final_path: Path):
+        """Close the temp file and atomically move it into place."""
+        self._file.close()
+        os.replace(self.temp_path, final_path)
+
+    def abort(self):
+        """Close and delete the temp file."""
+        self._file.close()
+        self.temp_path.unlink(missing_ok=True)
+
+
+async def decoded_body(request: Request, max_size: int):
+    """Yield the request body with its Content-Encoding (gzip or zstd) undone.
+
+    An unsupported encoding is refused with 415 and the supported ones in
+    Accept-Encoding, as RFC 7694 describes; a corrupt or truncated
+    compressed body is a 400. Output is inflated a bounded piece at a
+    time and counted as it goes: past max_size bytes the request is a 413.
+    """
+    encoding = request.headers.get("content-encoding", "")
+    try:
+        decoder = stream_decoder(encoding)
+    except ValueError:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported Content-Encoding: {encoding}",
+            headers={"Accept-Encoding": ", ".join(UPLOAD_ENCODINGS)}
+        )
+    too_large = HTTPException(status_code=413, detail=f"Body is larger than {max_size} bytes")
+    received = 0
+    if decoder is None:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_size:
+                raise too_large
+            yield chunk
+        return
+
+    async for chunk in request.stream():
+        if not chunk:
+            continue
+        if decoder.eof:
+            raise HTTPException(status_code=400, detail=f"Unexpected data after the {encoding} body")
+        pieces = decoder.decompress(chunk, UPLOAD_BUFFER_SIZE)
+        while True:
+            try:
+                data = next(pieces, None)
+            except DECODE_ERRORS as e:
+                raise HTTPException(status_code=400, detail=f"Invalid {encoding} body: {e}")
+            if data is None:
+                break
+            received += len(data)
+            if received > max_size:
+                raise too_large
+            yield data
+        if decoder.unused_data:
+            raise HTTPException(status_code=400, detail=f"Unexpected data after the {encoding} body")
+    if not decoder.eof:
+        raise HTTPException(status_code=400, detail=f"Truncated {encoding} body")
+
+
+class StreamedUpload:
+    """Result of streaming a multipart upload straight to disk."""
+
+    def __init__(self, fields: dict, filename: Optional[str], writer: Optional[HashingFileWriter]):
+        self.fields = fields
+        self.filename = filename
+        self.writer = writer
+
+    @property
+    def size(self) -> int:
+        return self.writer.size
+
+    @property
+    def sha256(self) -> str:
+        return self.writer.hexdigest()
+
+
+async def stream_multipart_upload(request: Request, file_field: str, temp_dir: Path) -> StreamedUpload:
+    """Parse a multipart body from the raw request stream, writing file_field to disk.
+
+    Unlike UploadFile this never spools the file to a SpooledTemporaryFile:
+    bytes go from the socket into one reusable buffer, and each full buffer
+    is hashed and written to a temp file in temp_dir on the I/O pool.
+    temp_dir should be on the same filesystem as the file's final location
+    so that committing it is a rename.
+
+    The body may be gzip or zstd compressed as a whole (Content-Encoding);
+    it is decompressed as it arrives, and refused with 413 once it passes
+    UPLOAD_MAX_SIZE.
+    """
+    content_type = request.headers.get("content-type", "")
+    _, params = parse_options_header(content_type)
+    boundary = params.get(b"boundary")
+    if not content_type.startswith("multipart/form-data") or not boundary:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+
+    fields = {}
+    filename = None
+    writer = None
+
+    # Parser callbacks are synchronous, so they only record what they saw;
+    # the I/O happens below between parser.write() calls
+    part = {}
+    events = []
+
+    def on_part_begin():
+        part.clear()
+        part.update(headers={}, header_name=b"", header_value=b"", data=b"", is_file=False)
+
+    def on_header_field(data, start, end):
+        part["header_name"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["header_value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["header_name"].lower()] = part["header_value"]
+        part["header_name"] = b""
+        part["header_value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise HTTPException(status_code=400, detail="Multipart part is missing a field name")
+        part["name"] = options[b"name"].decode("utf-8", errors="replace")
+        part["is_file"] = part["name"] == file_field and b"filename" in options
+        if part["is_file"]:
+            events.append(("file_begin", options[b"filename"].decode("utf-8", errors="replace")))
+
+    def on_part_data(data, start, end):
+        if part["is_file"]:
+            events.append(("file_data", memoryview(data)[start:end]))
+        else:
+            part["data"] += data[start:end]
+            if len(part["data"]) > MAX_FIELD_SIZE:
+                raise HTTPException(status_code=413, detail=f"Form field {part['name']} is too large")
+
+    def on_part_end():
+        if part["is_file"]:
+            events.append(("file_end", None))
+        else:
+            fields[part["name"]] = part["data"].decode("utf-8", errors="replace")
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+    })
+
+    buffer = bytearray(UPLOAD_BUFFER_SIZE)
+    view = memoryview(buffer)
+    filled = 0
+
+    try:
+        async for chunk in decoded_body(request, UPLOAD_MAX_SIZE):
+            parser.write(chunk)
+            for event, value in events:
+                if event == "file_begin":
+                    if writer is not None:
+                        raise HTTPException(status_code=400, detail=f"Only one {file_field} part is allowed")
+                    filename = value
+                    writer = await run_io(HashingFileWriter, temp_dir)
+                elif event == "file_data":
+                    # Copy into the reusable buffer; write it out whenever it fills
+                    while value:
+                        n = min(len(value), UPLOAD_BUFFER_SIZE - filled)
+                        view[filled:filled + n] = value[:n]
+                        filled += n
+                        value = value[n:]
+                        if filled == UPLOAD_BUFFER_SIZE:
+                            await run_io(writer.write, view)
+                            filled = 0
+                elif event == "file_end" and filled:
+                    await run_io(writer.write, view[:filled])
+                    filled = 0
+            events.clear()
+        parser.finalize()
+    except BaseException:
+        if writer is not None:
+            await run_io(writer.abort)
+        raise
+
+    if writer is None:
+        raise HTTPException(status_code=400, detail=f"Missing file field: {file_field}")
+
+    return StreamedUpload(fields, filename, writer)
@@ -1,16 +1,37 @@
 #!/bin/bash
-# Backup all hub data to a timestamped archive
-# Usage: ./backup_all.sh [backup_directory]
+# Back up all hub data (database, handshake files, SSH keys) as a snapshot
+# Usage: ./backup_all.sh [backup_directory] [--keep N] [--verify-all]
+#
+# Each run adds a snapshot directory to backup_directory (default:
+# HUB_BACKUP_DIR, or storage/backups/hub). Files the previous snapshot
+# already holds are hardlinked rather than copied, new ones are checked
+# against their sha256, and all but the newest HUB_BACKUP_KEEP snapshots
+# (or --keep N) are removed. Safe to run while the hub is in use.
+#
+# With the Docker deployment the command runs inside the pwnhub-api
+# container, so backup_directory must be a path in the container, e.g.
+# under /srv/pwnhub or a NAS share mounted into it.
 
-# TODO: Implement backup functionality
-# - Create timestamped tarball of /srv/pwnhub
-# - Include database and handshake files
-# - Rotate old backups if configured
-# - Support external storage/NAS targets
+set -e
 
-BACKUP_DIR="${1:-./backups}"
-TIMESTAMP=$(date +%Y%m%d_%H%M%S)
+SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
+DEPLOY_DIR="${PWNHUB_DEPLOY_DIR:-${SCRIPT_DIR}/../deploy}"
+API_DIR="${SCRIPT_DIR}/../pwnhub-api"
 
-echo "Creating backup: ${BACKUP_DIR}/pwnhub_backup_${TIMESTAMP}.tar.gz"
-echo "TODO: Implement backup functionality"
+ARGS=()
+if [ -n "$1" ] && [ "${1#--}" = "$1" ]; then
+    ARGS+=(--dest "$1")
+    shift
+fi
+ARGS+=("$@")
 
+if command -v docker-compose >/dev/null 2>&1 && \
+   [ -n "$(cd "$DEPLOY_DIR" && docker-compose ps -q pwnhub-api 2>/dev/null)" ]; then
+    cd "$DEPLOY_DIR"
+    exec docker-compose exec -T pwnhub-api python3 -m app.hub_backup "${ARGS[@]}"
+fi
+
+# Not running under Docker: use the local checkout (run from the directory
+# holding data/ and storage/, as the API is)
+export PYTHONPATH="${API_DIR}${PYTHONPATH:+:$PYTHONPATH}"
+exec python3 -m app.hub_backup "${ARGS[@]}"
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Load test for POST /api/devices/register with concurrent duplicate serials.
+
+Many threads register a small pool of serials at once, so most requests
+race on the same rows. Every request must succeed, and afterwards the hub
+must hold exactly one device per serial with the last registered fields.
+
+Usage: ./loadtest_register.py [--url http://localhost:5000] [--requests 5000]
+                              [--concurrency 64] [--serials 20]
+
+Only uses the standard library, so it runs on a bare Pi or relay.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def post_json(url: str, body: dict, timeout: float) -> tuple:
+    """POST body as JSON; returns (status, parsed response or error text)."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode(errors="replace")
+    except Exception as e:
+        return 0, str(e)
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:5000", help="hub base URL")
+    parser.add_argument("--requests", type=int, default=5000, help="total register calls")
+    parser.add_argument("--concurrency", type=int, default=64, help="parallel clients")
+    parser.add_argument("--serials", type=int, default=20, help="distinct serials to fight over")
+    parser.add_argument("--prefix", default=f"loadtest-{int(time.time())}-", help="serial prefix")
+    parser.add_argument("--timeout", type=float, default=30, help="per-request timeout, seconds")
+    args = parser.parse_args()
+
+    register_url = args.url.rstrip("/") + "/api/devices/register"
+    lock = threading.Lock()
+    latencies = []
+    failures = []
+    # Highest image_gen each serial was sent; the hub must end up on some value we sent
+    sent = {}
+
+    def worker(i: int):
+        serial = f"{args.prefix}{i % args.serials}"
+        body = {"serial": serial, "hostname": f"host-{i}", "image_gen": i, "handshake_count": i}
+        started = time.perf_counter()
+        status, response = post_json(register_url, body, args.timeout)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            sent.setdefault(serial, set()).add(i)
+            if status != 200 or not isinstance(response, dict) or response.get("serial") != serial:
+                failures.append((serial, status, response))
+
+    print(f"Registering {args.serials} serials {args.requests} times with {args.concurrency} clients...")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, range(args.requests)))
+    wall = time.perf_counter() - started
+
+    print(f"  {args.requests / wall:.1f} req/s over {wall:.2f}s")
+    print(f"  latency p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p95={percentile(latencies, 95) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms "
+          f"max={max(latencies) * 1000:.1f}ms")
+    print(f"  failures: {len(failures)}")
+    for serial, status, response in failures[:10]:
+        print(f"    {serial}: {status} {str(response)[:200]}")
+
+    # One row per serial, holding one of the values that serial was sent
+    with urllib.request.urlopen(args.url.rstrip("/") + "/api/devices/", timeout=args.timeout) as response:
+        devices = [d for d in json.loads(response.read()) if d["serial"].startswith(args.prefix)]
+    problems = []
+    by_serial = {}
+    for device in devices:
+        by_serial.setdefault(device["serial"], []).append(device)
+    if len(by_serial) != args.serials:
+        problems.append(f"expected {args.serials} serials, hub has {len(by_serial)}")
+    for serial, rows in by_serial.items():
+        if len(rows) != 1:
+            problems.append(f"{serial}: {len(rows)} rows")
+        elif rows[0]["image_gen"] not in sent.get(serial, ()):
+            problems.append(f"{serial}: image_gen {rows[0]['image_gen']} was never sent for it")
+    for problem in problems:
+        print(f"  consistency: {problem}")
+
+    if failures or problems:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,24 @@
 #!/bin/bash
 # Sync handshakes from all devices to hub
-# Usage: ./sync_all.sh
+# Usage: ./sync_all.sh [--serial SERIAL ...] [--concurrency N] [--timeout SECONDS] [--json]
+#
+# Pulls captures over SSH from every registered device with the hub's key
+# provisioned, several devices at a time, skipping files whose sha256 the
+# hub already has. See SYNC_* in deploy/env.example for settings.
 
-# TODO: Implement handshake synchronization
-# - Iterate through all registered devices
-# - Use rsync or SSH to pull handshakes
-# - Store in /srv/pwnhub/handshakes/<serial>/
+set -e
 
-echo "Syncing handshakes from all devices..."
-echo "TODO: Implement sync functionality"
+SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
+DEPLOY_DIR="${PWNHUB_DEPLOY_DIR:-${SCRIPT_DIR}/../deploy}"
+API_DIR="${SCRIPT_DIR}/../pwnhub-api"
 
+if command -v docker-compose >/dev/null 2>&1 && \
+   [ -n "$(cd "$DEPLOY_DIR" && docker-compose ps -q pwnhub-api 2>/dev/null)" ]; then
+    cd "$DEPLOY_DIR"
+    exec docker-compose exec -T pwnhub-api python3 -m app.fleet_sync "$@"
+fi
+
+# Not running under Docker: use the local checkout (run from the directory
+# holding data/ and storage/, as the API is)
+export PYTHONPATH="${API_DIR}${PYTHONPATH:+:$PYTHONPATH}"
+exec python3 -m app.fleet_sync "$@"
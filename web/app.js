@@ -10,14 +10,28 @@ const API_BASE = window.location.hostname === 'localhost' || window.location.hos
     ? 'http://localhost:5000'
     : `http://${window.location.hostname}:5000`;
 
+// ETag of the device list currently on screen
+let devicesEtag = null;
+
+// Device list currently on screen, kept up to date by server events
+let currentDevices = [];
+
 // Fetch devices from API
 async function loadDevices() {
     try {
-        const response = await fetch(`${API_BASE}/api/devices`);
+        // Revalidate ourselves instead of letting the browser cache do it,
+        // so an unchanged list comes back as an empty 304
+        const headers = devicesEtag ? { 'If-None-Match': devicesEtag } : {};
+        const response = await fetch(`${API_BASE}/api/devices/`, { headers, cache: 'no-store' });
+        if (response.status === 304) {
+            return;
+        }
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
         const devices = await response.json(); // API returns list directly
+        devicesEtag = response.headers.get('ETag');
+        currentDevices = devices;
         displayDevices(devices);
     } catch (error) {
         console.error('Error loading devices:', error);
@@ -58,6 +72,13 @@ function displayDevices(devices) {
         const hostname = device.hostname || 'Unknown';
         const lastSeen = formatLastSeen(device.last_seen);
         const handshakeCount = device.handshake_count || 0;
+        const storage = formatBytes(device.total_bytes);
+        const uploadRange = device.oldest_upload
+            ? `Uploads from ${device.oldest_upload} to ${device.newest_upload} (UTC)`
+            : 'No uploads';
+        const onDisk = device.total_stored_bytes != null && device.total_stored_bytes !== device.total_bytes
+            ? ` – ${formatBytes(device.total_stored_bytes)} on disk`
+            : '';
         const sshProvisioned = device.ssh_provisioned || false;
         
         // Status icon for provisioned devices
@@ -81,6 +102,7 @@ function displayDevices(devices) {
                 <td>${hostname}</td>
                 <td>${lastSeen}</td>
                 <td>${handshakeCount}</td>
+                <td title="${uploadRange}${onDisk}">${storage}</td>
                 <td>${statusIcon}</td>
                 <td>
                     ${provisionButton}
@@ -110,15 +132,73 @@ async function viewHandshakes(serial) {
         const data = await response.json();
         const handshakes = data.handshakes || [];
         
-        // Create modal for handshake list
-        showHandshakeModal(serial, handshakes);
+        // Create modal for handshake list (first page; more via "Load more")
+        showHandshakeModal(serial, handshakes, data.next_cursor);
+    } catch (error) {
+        console.error('Error loading handshakes:', error);
+        showToast(`Error loading handshakes: ${error.message}`, 'error');
+    }
+}
+
+// Render one row of the handshake modal table
+function renderHandshakeRow(serial, h) {
+    // Format date
+    function formatDate(dateStr) {
+        if (!dateStr) return 'Unknown';
+        const date = new Date(dateStr);
+        return date.toLocaleString();
+    }
+    
+    return `
+        <tr>
+            <td style="padding: 8px; border-bottom: 1px solid #ddd;">${h.filename}</td>
+            <td style="padding: 8px; border-bottom: 1px solid #ddd;">${formatBytes(h.bytes)}</td>
+            <td style="padding: 8px; border-bottom: 1px solid #ddd;">${formatDate(h.uploaded_at)}</td>
+            <td style="padding: 8px; border-bottom: 1px solid #ddd; font-family: monospace; font-size: 10px;">${(h.sha256 || '').substring(0, 16)}...</td>
+            <td style="padding: 8px; border-bottom: 1px solid #ddd;">
+                <a href="${API_BASE}/api/handshakes/${encodeURIComponent(serial)}/download/${encodeURIComponent(h.filename)}" 
+                   download="${h.filename}"
+                   style="color: #4CAF50; text-decoration: none;">Download</a>
+            </td>
+        </tr>
+    `;
+}
+
+// Fetch the next page of a device's handshakes and append it to the open modal
+async function loadMoreHandshakes(serial, cursor) {
+    try {
+        const url = `${API_BASE}/api/handshakes/${encodeURIComponent(serial)}/list?cursor=${encodeURIComponent(cursor)}`;
+        const response = await fetch(url);
+        if (!response.ok) {
+            const error = await response.json();
+            throw new Error(error.detail || `HTTP error! status: ${response.status}`);
+        }
+        
+        const data = await response.json();
+        const tbody = document.getElementById('handshake-rows');
+        if (tbody) {
+            tbody.insertAdjacentHTML('beforeend', (data.handshakes || []).map(h => renderHandshakeRow(serial, h)).join(''));
+        }
+        setLoadMoreButton(serial, data.next_cursor);
     } catch (error) {
         console.error('Error loading handshakes:', error);
         showToast(`Error loading handshakes: ${error.message}`, 'error');
     }
 }
 
-function showHandshakeModal(serial, handshakes) {
+// Show the "Load more" button for the next page, or hide it on the last page
+function setLoadMoreButton(serial, cursor) {
+    const button = document.getElementById('handshake-load-more');
+    if (!button) return;
+    if (cursor) {
+        button.style.display = 'inline-block';
+        button.onclick = () => loadMoreHandshakes(serial, cursor);
+    } else {
+        button.style.display = 'none';
+    }
+}
+
+function showHandshakeModal(serial, handshakes, nextCursor) {
     // Create modal overlay
     const modal = document.createElement('div');
     modal.id = 'handshake-modal';
@@ -135,22 +215,6 @@ function showHandshakeModal(serial, handshakes) {
         justify-content: center;
     `;
     
-    // Format file size
-    function formatBytes(bytes) {
-        if (!bytes) return '0 B';
-        const k = 1024;
-        const sizes = ['B', 'KB', 'MB', 'GB'];
-        const i = Math.floor(Math.log(bytes) / Math.log(k));
-        return Math.round(bytes / Math.pow(k, i) * 100) / 100 + ' ' + sizes[i];
-    }
-    
-    // Format date
-    function formatDate(dateStr) {
-        if (!dateStr) return 'Unknown';
-        const date = new Date(dateStr);
-        return date.toLocaleString();
-    }
-    
     const modalContent = document.createElement('div');
     modalContent.style.cssText = `
         background: white;
@@ -165,6 +229,10 @@ function showHandshakeModal(serial, handshakes) {
     modalContent.innerHTML = `
         <h2>Handshakes for Device: ${serial}</h2>
         <button onclick="closeHandshakeModal()" style="float: right; margin-bottom: 10px;">Close</button>
+        ${handshakes.length === 0 ? '' : `
+            <a href="${API_BASE}/api/devices/${encodeURIComponent(serial)}/archive?format=zip&compression=gzip"
+               style="float: right; margin: 0 10px 10px 0;">Download all (.zip)</a>
+        `}
         ${handshakes.length === 0 
             ? '<p>No handshakes found for this device.</p>'
             : `
@@ -178,27 +246,17 @@ function showHandshakeModal(serial, handshakes) {
                         <th style="text-align: left; padding: 8px; border-bottom: 1px solid #ddd;">Action</th>
                     </tr>
                 </thead>
-                <tbody>
-                    ${handshakes.map(h => `
-                        <tr>
-                            <td style="padding: 8px; border-bottom: 1px solid #ddd;">${h.filename}</td>
-                            <td style="padding: 8px; border-bottom: 1px solid #ddd;">${formatBytes(h.bytes)}</td>
-                            <td style="padding: 8px; border-bottom: 1px solid #ddd;">${formatDate(h.uploaded_at)}</td>
-                            <td style="padding: 8px; border-bottom: 1px solid #ddd; font-family: monospace; font-size: 10px;">${(h.sha256 || '').substring(0, 16)}...</td>
-                            <td style="padding: 8px; border-bottom: 1px solid #ddd;">
-                                <a href="${API_BASE}/api/handshakes/${encodeURIComponent(serial)}/download/${encodeURIComponent(h.filename)}" 
-                                   download="${h.filename}"
-                                   style="color: #4CAF50; text-decoration: none;">Download</a>
-                            </td>
-                        </tr>
-                    `).join('')}
+                <tbody id="handshake-rows">
+                    ${handshakes.map(h => renderHandshakeRow(serial, h)).join('')}
                 </tbody>
             </table>
+            <button id="handshake-load-more" style="display: none; margin-top: 10px;">Load more</button>
         `}
     `;
     
     modal.appendChild(modalContent);
     document.body.appendChild(modal);
+    setLoadMoreButton(serial, nextCursor);
     
     // Close on background click
     modal.addEventListener('click', (e) => {
@@ -216,7 +274,7 @@ function closeHandshakeModal() {
 }
 
 async function backupDevice(serial) {
-    if (!confirm(`Create backup for device ${serial}? This will create a tarball of all handshake files.`)) {
+    if (!confirm(`Create backup for device ${serial}? This will archive the handshake files added since the last backup.`)) {
         return;
     }
     
@@ -233,10 +291,27 @@ async function backupDevice(serial) {
             throw new Error(error.detail || `HTTP error! status: ${response.status}`);
         }
         
-        const result = await response.json();
+        // The backup runs in the background; follow its job until it's done
+        let job = await response.json();
+        showToast(`Backup started for ${serial}`, 'success');
+        const statusUrl = `${API_BASE}/api/devices/${encodeURIComponent(serial)}/backup/${job.job_id}`;
+        while (job.status === 'queued' || job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, 2000));
+            const statusResponse = await fetch(statusUrl, { cache: 'no-store' });
+            if (!statusResponse.ok) {
+                throw new Error(`HTTP error! status: ${statusResponse.status}`);
+            }
+            job = await statusResponse.json();
+        }
         
-        // Show success toast
-        showToast(`Backup created: ${result.filename} (${formatBytes(result.size_bytes)})`, 'success');
+        if (job.status !== 'done') {
+            throw new Error(job.error || job.status);
+        }
+        if (job.archive) {
+            showToast(`Backup created: ${job.archive} (${job.files} files, ${formatBytes(job.archive_bytes)})`, 'success');
+        } else {
+            showToast(`No new handshakes to back up for ${serial}`, 'success');
+        }
         
     } catch (error) {
         console.error('Error creating backup:', error);
@@ -315,9 +390,61 @@ async function provisionDevice(serial) {
     }
 }
 
+// Merge a device change event into the list on screen
+function applyDeviceDelta(delta) {
+    const device = currentDevices.find(d => d.serial === delta.serial);
+    if (!device) {
+        // New device: fetch the full list rather than guess its other fields
+        loadDevices();
+        return;
+    }
+    Object.assign(device, delta);
+    scheduleRender();
+}
+
+// Render at most once per frame however many events arrive together
+let renderScheduled = false;
+function scheduleRender() {
+    if (renderScheduled) return;
+    renderScheduled = true;
+    requestAnimationFrame(() => {
+        renderScheduled = false;
+        currentDevices.sort((a, b) => (b.last_seen || 0) - (a.last_seen || 0));
+        displayDevices(currentDevices);
+    });
+}
+
+// Live updates over Server-Sent Events; polling is only a fallback
+let eventsConnected = false;
+function connectEvents() {
+    if (!window.EventSource) return;
+    const source = new EventSource(`${API_BASE}/api/events/`);
+    source.onopen = () => {
+        eventsConnected = true;
+        // Catch up on anything missed while disconnected (usually a 304)
+        loadDevices();
+    };
+    source.onerror = () => {
+        // EventSource reconnects by itself; poll until it does
+        eventsConnected = false;
+    };
+    ['device_registered', 'heartbeat', 'handshake_uploaded'].forEach(type => {
+        source.addEventListener(type, event => applyDeviceDelta(JSON.parse(event.data)));
+    });
+    source.addEventListener('retention_finished', event => {
+        JSON.parse(event.data).devices.forEach(applyDeviceDelta);
+    });
+    source.addEventListener('resync', () => loadDevices());
+}
+
 // Load devices on page load
-document.addEventListener('DOMContentLoaded', loadDevices);
+document.addEventListener('DOMContentLoaded', () => {
+    loadDevices();
+    connectEvents();
+});
 
-// Refresh every 5 seconds
-setInterval(loadDevices, 5000);
+// Poll every 5 seconds while the event stream is down
+setInterval(() => {
+    if (!eventsConnected) loadDevices();
+}, 5000);
 